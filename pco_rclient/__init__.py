@@ -1 +1,5 @@
 from pco_rclient.client.pco_client import PcoWriter
+from pco_rclient.client.pco_session import PcoSession
+from pco_rclient.client.pco_async import AsyncPcoWriter
+from pco_rclient.client.pco_polling import AdaptivePolling, FixedPolling
+from pco_rclient.client.pco_group import PcoWriterGroup
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio client to control the PCO writer.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import asyncio
+import functools
+
+from pco_rclient.client.pco_client import PcoWriter
+from pco_rclient.client.pco_core import Call, Parallel, Sleep
+
+
+async def run_steps_async(steps, executor=None):
+    """
+    Drive a step generator (see :mod:`pco_core`) from an asyncio event loop.
+
+    Blocking calls are run in `executor`, the calls of a :class:`Parallel`
+    step are run concurrently, and sleeps do not block the event loop.
+    Cancelling the awaiting task throws :class:`asyncio.CancelledError` into
+    the step generator.
+
+    Parameters
+    ----------
+    steps : generator
+        The generator yielding the steps of an operation.
+    executor : concurrent.futures.Executor, optional
+        The executor for the blocking calls. If None, the default executor of
+        the event loop is used. (default = None)
+
+    Returns
+    -------
+    result : object
+        The return value of the step generator.
+
+    """
+
+    loop = asyncio.get_event_loop()
+
+    def run_call(call):
+        return loop.run_in_executor(executor, call)
+
+    value = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                step = steps.send(value)
+            else:
+                step, error = steps.throw(error), None
+        except StopIteration as stop:
+            return stop.value
+        try:
+            if isinstance(step, Call):
+                value = await run_call(step)
+            elif isinstance(step, Sleep):
+                value = await asyncio.sleep(step.seconds)
+            elif isinstance(step, Parallel):
+                value = list(await asyncio.gather(
+                    *[run_call(call) for call in step.calls]))
+            else:
+                raise TypeError("Unknown step: {!r}".format(step))
+        except BaseException as e:
+            value, error = None, e
+
+
+class AsyncPcoWriter(object):
+    """
+    Asyncio proxy class to control the PCO writer.
+
+    The asynchronous client wraps a :class:`PcoWriter`, which holds the
+    configuration and the client status. All operations execute the same code
+    as their blocking counterparts, but await the REST requests in an executor
+    and sleep between polls without blocking the event loop.
+
+    Since the :class:`PcoWriter` constructor contacts the writer server, use
+    :meth:`create` to construct a new client from within a coroutine.
+
+    Examples
+    --------
+    >>> writer = await AsyncPcoWriter.create(output_file='/tmp/output.h5',
+    ...                                      dataset_name='data', n_frames=10)
+    >>> await writer.start()
+    >>> await writer.wait()
+
+    """
+
+    def __init__(self, writer, executor=None):
+        """
+        Initialize the asynchronous client.
+
+        Parameters
+        ----------
+        writer : PcoWriter
+            The blocking writer client to wrap.
+        executor : concurrent.futures.Executor, optional
+            The executor running the blocking requests. If None, the default
+            executor of the event loop is used. (default = None)
+
+        """
+
+        self.writer = writer
+        self.executor = executor
+
+    def __str__(self):
+        return "Asyncio proxy of: {}".format(self.writer)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _run(self, steps):
+        return await run_steps_async(steps, executor=self.executor)
+
+    async def close(self):
+        """
+        Close the pooled connections, see :meth:`PcoWriter.close`.
+        """
+
+        return await self._call(self.writer.close)
+
+    async def configure(self, **kwargs):
+        """
+        Configure the writer, see :meth:`PcoWriter.configure`.
+        """
+
+        return await self._call(self.writer.configure, **kwargs)
+
+    @classmethod
+    async def create(cls, executor=None, **kwargs):
+        """
+        Construct a new :class:`PcoWriter` without blocking the event loop.
+
+        Parameters
+        ----------
+        executor : concurrent.futures.Executor, optional
+            The executor running the blocking requests. (default = None)
+        **kwargs
+            Passed on to the :class:`PcoWriter` constructor.
+
+        Returns
+        -------
+        writer : AsyncPcoWriter
+            The asynchronous client wrapping the new writer object.
+
+        """
+
+        loop = asyncio.get_event_loop()
+        writer = await loop.run_in_executor(
+            executor, functools.partial(PcoWriter, **kwargs))
+        return cls(writer, executor=executor)
+
+    async def flush_cam_stream(self, timeout=500, verbose=False,
+                               summary=False, background=False):
+        """
+        Flush the ZMQ stream, see :meth:`PcoWriter.flush_cam_stream`.
+        """
+
+        return await self._call(self.writer.flush_cam_stream,
+                                timeout=timeout, verbose=verbose,
+                                summary=summary, background=background)
+
+    async def get_progress_message(self):
+        """
+        Return the progress message, see :meth:`PcoWriter.get_progress_message`.
+        """
+
+        return await self._run(self.writer._get_progress_message_steps())
+
+    async def get_snapshot(self):
+        """
+        Retrieve status and statistics, see :meth:`PcoWriter.get_snapshot`.
+        """
+
+        return await self._run(self.writer._get_snapshot_steps())
+
+    async def get_statistics(self, verbose=False):
+        """
+        Get the statistics of the writer, see :meth:`PcoWriter.get_statistics`.
+        """
+
+        return await self._run(
+            self.writer._get_statistics_steps(verbose=verbose))
+
+    async def get_status(self, verbose=False):
+        """
+        Return the client status, see :meth:`PcoWriter.get_status`.
+        """
+
+        return await self._call(self.writer.get_status, verbose=verbose)
+
+    async def get_throughput(self, window=5.0):
+        """
+        Estimate the throughput of the run, see :meth:`PcoWriter.get_throughput`.
+        """
+
+        return await self._call(self.writer.get_throughput, window=window)
+
+    async def get_written_frames(self):
+        """
+        Return the number of written frames, see
+        :meth:`PcoWriter.get_written_frames`.
+        """
+
+        return await self._run(self.writer._get_written_frames_steps())
+
+    async def is_connected(self):
+        """
+        Verify the server connection, see :meth:`PcoWriter.is_connected`.
+        """
+
+        return await self._call(self.writer.is_connected)
+
+    async def is_running(self):
+        """
+        Verify whether the writer is running, see :meth:`PcoWriter.is_running`.
+        """
+
+        return await self._call(self.writer.is_running)
+
+    async def kill(self, verbose=False):
+        """
+        Kill the writer process, see :meth:`PcoWriter.kill`.
+        """
+
+        return await self._call(self.writer.kill, verbose=verbose)
+
+    async def milestones(self, frame_counts, field='n_written_frames',
+                         interval=0.5):
+        """
+        Register frame-count milestones, see :meth:`PcoWriter.milestones`.
+
+        Returns
+        -------
+        futures : list of asyncio.Future
+            One awaitable future per frame count.
+
+        """
+
+        futures = await self._call(self.writer.milestones, frame_counts,
+                                   field=field, interval=interval)
+        return [asyncio.wrap_future(future) for future in futures]
+
+    async def monitor(self, interval=0.5):
+        """
+        Start a background statistics monitor, see :meth:`PcoWriter.monitor`.
+        """
+
+        return await self._call(self.writer.monitor, interval=interval)
+
+    async def reset(self, background_flush=False):
+        """
+        Reset the writer client object, see :meth:`PcoWriter.reset`.
+        """
+
+        return await self._call(self.writer.reset,
+                                background_flush=background_flush)
+
+    async def start(self, wait=True, timeout=10, verbose=False):
+        """
+        Start a new writer process, see :meth:`PcoWriter.start`.
+        """
+
+        return await self._run(self.writer._start_steps(
+            wait=wait, timeout=timeout, verbose=verbose))
+
+    async def stop(self, wait=True, timeout=10, verbose=False):
+        """
+        Stop the writer process, see :meth:`PcoWriter.stop`.
+        """
+
+        return await self._run(self.writer._stop_steps(
+            wait=wait, timeout=timeout, verbose=verbose))
+
+    async def wait(self, verbose=False):
+        """
+        Wait for the writer to finish, see :meth:`PcoWriter.wait`.
+        """
+
+        return await self._run(self.writer._wait_steps(verbose=verbose))
+
+    async def wait_nframes(self, nframes, inactivity_timeout=-1,
+                           verbose=False):
+        """
+        Wait for a number of written frames, see :meth:`PcoWriter.wait_nframes`.
+        """
+
+        return await self._run(self.writer._wait_nframes_steps(
+            nframes, inactivity_timeout=inactivity_timeout, verbose=verbose))
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the PCO writer client against a local stand-in server.
+
+Usage::
+
+    python -m pco_rclient.client.pco_benchmark [-n NCALLS]
+    python -m pco_rclient.client.pco_benchmark --suite [--json RESULT.json]
+        [--compare BASELINE.json]
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socketserver
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import requests
+
+from pco_rclient.client.pco_client import ROUTES, PcoWriter
+from pco_rclient.client.pco_emulator import WriterEmulator
+from pco_rclient.client.pco_session import PcoSession
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answer every route with a minimal, fixed JSON response.
+    """
+
+    # HTTP/1.1 is required for the client to keep the connection alive
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid Nagle/delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({"success": True, "status": "finished"}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Threaded local HTTP server answering with :class:`StandInHandler`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), StandInHandler)
+        self._thread = None
+
+    @property
+    def address(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def time_calls(func, n_calls):
+    """
+    Call a function repeatedly and return the mean duration per call [s].
+    """
+
+    t_start = time.perf_counter()
+    for _ in range(n_calls):
+        func()
+    return (time.perf_counter() - t_start) / n_calls
+
+
+def compare_sessions(address, n_calls=200, route="status"):
+    """
+    Compare the per-call latency of unpooled and pooled requests.
+
+    Parameters
+    ----------
+    address : str
+        The server base address, e.g. "http://127.0.0.1:9901".
+    n_calls : int, optional
+        The number of requests per variant. (default = 200)
+    route : str, optional
+        The name of the route to request, see ROUTES. (default = "status")
+
+    Returns
+    -------
+    result : dict
+        Mean latency [ms] per call for the "unpooled" (module-level
+        requests.get) and the "pooled" (:class:`PcoSession`) variants.
+
+    """
+
+    url = address + ROUTES[route]
+    session = PcoSession()
+    # warm up both variants (and open the pooled connection)
+    requests.get(url).json()
+    session.get(address, ROUTES[route]).json()
+    unpooled = time_calls(lambda: requests.get(url).json(), n_calls)
+    pooled = time_calls(
+        lambda: session.get(address, ROUTES[route]).json(), n_calls)
+    session.close()
+    return {"unpooled": unpooled * 1e3, "pooled": pooled * 1e3}
+
+
+def summarize(durations):
+    """
+    Return the latency distribution of a list of durations.
+
+    Parameters
+    ----------
+    durations : list of float
+        The measured durations [s].
+
+    Returns
+    -------
+    summary : dict
+        The number of samples "n" and the "mean", "min", "p50", "p90", "p99"
+        and "max" latencies [ms].
+
+    """
+
+    values = np.asarray(durations, dtype=np.float64) * 1e3
+    if len(values) == 0:
+        return {"n": 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"n": len(values), "mean": float(values.mean()),
+            "min": float(values.min()), "p50": float(p50),
+            "p90": float(p90), "p99": float(p99),
+            "max": float(values.max())}
+
+
+def close_writer(writer):
+    """
+    Close the connections of a writer client, if the client version can.
+    """
+
+    close = getattr(writer, 'close', None)
+    if close is not None:
+        close()
+
+
+def run_suite(n_runs=20, n_calls=200, latency=0.0, frame_rate=1000.0,
+              n_frames=200):
+    """
+    Measure the latency distribution of the PcoWriter operations.
+
+    The operations are run against a local :class:`WriterEmulator`, through
+    the public api only, so that the suite runs with every client version:
+
+    * "constructor": creating a PcoWriter (connection and state checks),
+    * "configure": configuring the next acquisition,
+    * "start_to_receiving": start() until the writer reports running,
+    * "wait_return": the time from the end of the run until wait() returns,
+    * "stop_to_finished": stop() until the writer has finished,
+    * "get_statistics", "is_running": single queries of a running writer,
+    * "wait_tick": the client-side cost of one poll of wait(), i.e. the
+      progress message of a running writer.
+
+    Every phase uses a new writer client.
+
+    Parameters
+    ----------
+    n_runs : int, optional
+        The number of acquisitions (and constructor/configure calls).
+        (default = 20)
+    n_calls : int, optional
+        The number of get_statistics, is_running and progress message calls.
+        (default = 200)
+    latency : float, optional
+        The response latency [s] of the emulator. (default = 0.0)
+    frame_rate : float, optional
+        The frame rate [frames/s] of the emulated acquisitions.
+        (default = 1000.0)
+    n_frames : int, optional
+        The number of frames per acquisition awaited with wait().
+        (default = 200)
+
+    Returns
+    -------
+    result : dict
+        The "parameters" and "environment" of the suite and the latency
+        "results" per operation, see :func:`summarize`.
+
+    """
+
+    durations = {name: [] for name in (
+        "constructor", "configure", "start_to_receiving", "wait_return",
+        "stop_to_finished", "get_statistics", "is_running", "wait_tick")}
+    config = {"output_file": '/tmp/pco_benchmark.h5',
+              "dataset_name": 'data', "n_frames": n_frames,
+              "connection_address": 'tcp://127.0.0.1:8080'}
+    with WriterEmulator(frame_rate=frame_rate, start_delay=0.0,
+                        stop_delay=0.0, latency=latency) as emulator:
+        config.update(flask_api_address=emulator.flask_api_address,
+                      writer_api_address=emulator.writer_api_address)
+
+        def time_queries(name, func):
+            for _ in range(n_calls):
+                t_start = time.perf_counter()
+                func()
+                durations[name].append(time.perf_counter() - t_start)
+
+        for _ in range(n_runs):
+            t_start = time.perf_counter()
+            writer = PcoWriter(**config)
+            durations["constructor"].append(time.perf_counter() - t_start)
+            close_writer(writer)
+
+        writer = PcoWriter(**config)
+        for _ in range(n_runs):
+            t_start = time.perf_counter()
+            writer.configure(output_file=config["output_file"],
+                             dataset_name=config["dataset_name"],
+                             n_frames=n_frames)
+            durations["configure"].append(time.perf_counter() - t_start)
+        close_writer(writer)
+
+        writer = PcoWriter(**config)
+        for _ in range(n_runs):
+            t_start = time.perf_counter()
+            writer.start()
+            durations["start_to_receiving"].append(
+                time.perf_counter() - t_start)
+            # the progress line is still formatted, but not shown
+            with contextlib.redirect_stdout(io.StringIO()):
+                writer.wait()
+            t_returned = time.time()
+            # the emulated run ends once all frames are received and written
+            t_end = (float(writer.get_statistics()['start_time']) +
+                     n_frames / frame_rate)
+            durations["wait_return"].append(t_returned - t_end)
+        close_writer(writer)
+
+        writer = PcoWriter(**dict(config, n_frames=0))
+        writer.start()
+        time_queries("get_statistics", writer.get_statistics)
+        time_queries("is_running", writer.is_running)
+        time_queries("wait_tick", writer.get_progress_message)
+        writer.stop()
+        close_writer(writer)
+
+        writer = PcoWriter(**dict(config, n_frames=0))
+        for _ in range(n_runs):
+            writer.start()
+            t_start = time.perf_counter()
+            writer.stop()
+            durations["stop_to_finished"].append(
+                time.perf_counter() - t_start)
+        close_writer(writer)
+
+    return {
+        "parameters": {"n_runs": n_runs, "n_calls": n_calls,
+                       "latency": latency, "frame_rate": frame_rate,
+                       "n_frames": n_frames},
+        "environment": {"python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "client_version": get_client_version(),
+                        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": {name: summarize(values)
+                    for name, values in durations.items()},
+    }
+
+
+def get_client_version():
+    """
+    Return the git commit of the client, or its installed version if the
+    client is not run from a git checkout, or None if unknown.
+
+    The commit is given as by `git describe --always --dirty`, e.g.
+    "c32b088-dirty" for a checkout with uncommitted changes.
+    """
+
+    try:
+        output = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except Exception:
+        pass
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('pco_rclient').version
+    except Exception:
+        return None
+
+
+def format_suite(result, baseline=None):
+    """
+    Return a table of the suite results, optionally compared to a baseline.
+    """
+
+    lines = ["{:<20} {:>6} {:>10} {:>10} {:>10}".format(
+        "operation", "n", "p50 [ms]", "p99 [ms]", "max [ms]")]
+    for name, summary in sorted(result["results"].items()):
+        if not summary["n"]:
+            continue
+        line = "{:<20} {:>6d} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            name, summary["n"], summary["p50"], summary["p99"],
+            summary["max"])
+        reference = (baseline or {}).get("results", {}).get(name)
+        if reference and reference.get("n"):
+            line += "   p50 x{:.2f}, p99 x{:.2f} vs. baseline".format(
+                summary["p50"] / reference["p50"],
+                summary["p99"] / reference["p99"])
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the PCO writer client against a local "
+                    "stand-in server.")
+    parser.add_argument('-n', '--n-calls', type=int, default=200,
+                        help="number of requests per variant")
+    parser.add_argument('--suite', action='store_true',
+                        help="measure the latency of the PcoWriter "
+                             "operations against the writer emulator")
+    parser.add_argument('--runs', type=int, default=20,
+                        help="number of acquisitions of the suite")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="response latency [s] of the emulator")
+    parser.add_argument('--json', default=None,
+                        help="write the suite results to this file")
+    parser.add_argument('--compare', default=None,
+                        help="compare the suite results with this file")
+    arguments = parser.parse_args()
+
+    if arguments.suite:
+        result = run_suite(n_runs=arguments.runs, n_calls=arguments.n_calls,
+                           latency=arguments.latency)
+        baseline = None
+        if arguments.compare:
+            with open(arguments.compare) as f:
+                baseline = json.load(f)
+        print(format_suite(result, baseline))
+        if arguments.json:
+            with open(arguments.json, 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+        return
+
+    server = StandInServer().start()
+    try:
+        result = compare_sessions(server.address, arguments.n_calls)
+    finally:
+        server.stop()
+    print("Mean latency per call ({} calls):".format(arguments.n_calls))
+    print("  unpooled (requests.get): {:.3f} ms".format(result["unpooled"]))
+    print("  pooled (PcoSession):     {:.3f} ms".format(result["pooled"]))
+    print("  speed-up:                {:.1f}x".format(
+        result["unpooled"] / result["pooled"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+"""
+Recording and replay of the raw camera stream.
+
+Usage::
+
+    python -m pco_rclient.client.pco_capture record tcp://pco-camera:8080
+        capture.seg [--duration 60]
+    python -m pco_rclient.client.pco_capture replay capture.seg tcp://*:8080
+        [--speed 2.0]
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import argparse
+import mmap
+import os
+import threading
+import time
+
+import numpy as np
+import zmq
+
+from pco_rclient.client.pco_recorder import _npy_header
+
+
+# Fields of the capture index, one record per frame.
+CAPTURE_INDEX_DTYPE = np.dtype([('timestamp', '<f8'),
+                                ('offset', '<i8'),
+                                ('header_size', '<i8'),
+                                ('data_size', '<i8')])
+
+# The segment file starts with a magic string, padded to _ALIGNMENT bytes.
+CAPTURE_MAGIC = b'PCOCAP01'
+
+# The headers and the image data are aligned in the segment file, so the image
+# data can be viewed as numpy arrays without copying.
+_ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def get_index_path(path):
+    """
+    Return the path of the index of the capture segment file `path`.
+    """
+
+    return path + '.index.npy'
+
+
+class Capture(object):
+    """
+    Read access to a recorded capture.
+
+    The segment file is memory-mapped read-only; the headers and the image
+    data of the frames are returned as memoryviews of the mapping, without
+    copying.
+    """
+
+    def __init__(self, path):
+        """
+        Open a capture.
+
+        Parameters
+        ----------
+        path : str
+            The path of the segment file.
+
+        Raises
+        ------
+        ValueError
+            If the file is not a capture segment file.
+
+        """
+
+        self.path = path
+        self.index = np.load(get_index_path(path))
+        with open(path, 'rb') as segment_file:
+            if segment_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError("Not a capture file: {}".format(path))
+            self._mmap = mmap.mmap(segment_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        """
+        Release the mapping of the segment file.
+        """
+
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # frames are still referenced (e.g. queued in a ZMQ socket); the
+            # mapping is released with the last reference
+            pass
+
+    @property
+    def duration(self):
+        """
+        The time [s] between the first and the last frame recorded.
+        """
+
+        if len(self.index) < 2:
+            return 0.0
+        return float(self.index['timestamp'][-1] -
+                     self.index['timestamp'][0])
+
+    def get_frame(self, index):
+        """
+        Return the header and the image data of a frame.
+
+        Parameters
+        ----------
+        index : int
+            The position of the frame in the capture.
+
+        Returns
+        -------
+        header : memoryview
+            The raw JSON header.
+        data : memoryview
+            The raw image data.
+
+        """
+
+        record = self.index[index]
+        offset = int(record['offset'])
+        header_size = int(record['header_size'])
+        data_offset = _align(offset + header_size)
+        return (self._view[offset:offset + header_size],
+                self._view[data_offset:data_offset + int(record['data_size'])])
+
+    @property
+    def n_bytes(self):
+        """
+        The number of bytes of image data recorded.
+        """
+
+        return int(self.index['data_size'].sum())
+
+
+class CaptureRecorder(object):
+    """
+    Append-only recorder of the raw camera stream.
+
+    The frames are copied straight from the ZMQ message buffers into a
+    memory-mapped segment file, which is grown by `chunk_size` bytes whenever
+    it is full and truncated to the recorded size on :meth:`close`. The index
+    records are buffered like the samples of a :class:`StatisticsRecorder`
+    and appended to the index file in blocks; its header is updated after
+    each block.
+
+    Like any receiver of the camera, a recorder connected to the camera takes
+    frames away from the writer. Record either without the writer running,
+    or from the forward address of a :class:`StreamTap`.
+    """
+
+    def __init__(self, path, address=None, chunk_size=256 * 1024**2,
+                 index_buffer_size=1024, context=None, rcvhwm=100000):
+        """
+        Create the capture files. Existing files are overwritten.
+
+        Parameters
+        ----------
+        path : str
+            The path of the segment file. The index is written next to it,
+            see :func:`get_index_path`.
+        address : str, optional
+            The address of the camera stream received by :meth:`start`. Not
+            needed if the frames are passed to :meth:`append`.
+            (default = None)
+        chunk_size : int, optional
+            The number of bytes by which the segment file is grown.
+            (default = 256 MiB)
+        index_buffer_size : int, optional
+            The number of index records kept in memory before they are
+            appended to the index file. (default = 1024)
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+        rcvhwm : int, optional
+            The receive high water mark [messages]. (default = 100000)
+
+        """
+
+        self.path = path
+        self.address = address
+        self.chunk_size = _align(max(int(chunk_size), _ALIGNMENT))
+        self.n_frames = 0
+        self.n_bytes = 0
+
+        self._index_buffer = np.zeros(max(int(index_buffer_size), 1),
+                                      dtype=CAPTURE_INDEX_DTYPE)
+        self._n_buffered = 0
+        self._end = _ALIGNMENT
+        self._pending_header = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._context = context
+        self._rcvhwm = rcvhwm
+        self.socket = None
+
+        self._file = open(path, 'w+b')
+        self._file.truncate(self.chunk_size)
+        self._mmap = mmap.mmap(self._file.fileno(), self.chunk_size)
+        self._mmap[:len(CAPTURE_MAGIC)] = CAPTURE_MAGIC
+        self._index_file = open(get_index_path(path), 'wb')
+        self._index_file.write(_npy_header(0, CAPTURE_INDEX_DTYPE))
+        self._index_file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self._stopping.is_set():
+            if not poller.poll(100):
+                continue
+            while True:
+                try:
+                    parts = self.socket.recv_multipart(flags=zmq.NOBLOCK,
+                                                       copy=False)
+                except zmq.Again:
+                    break
+                for part in parts:
+                    if self._pending_header is None:
+                        self._pending_header = part
+                    else:
+                        header, self._pending_header = \
+                            self._pending_header, None
+                        self.append(header.buffer, part.buffer)
+
+    def _write_index(self):
+        """
+        Append the buffered index records and update the index header.
+        """
+
+        if self._n_buffered:
+            self._index_file.seek(0, os.SEEK_END)
+            self._index_file.write(
+                self._index_buffer[:self._n_buffered].tobytes())
+            self._n_buffered = 0
+            self._index_file.seek(0)
+            self._index_file.write(_npy_header(self.n_frames,
+                                               CAPTURE_INDEX_DTYPE))
+        self._index_file.flush()
+
+    def append(self, header, data, timestamp=None):
+        """
+        Record a frame.
+
+        Parameters
+        ----------
+        header : bytes-like
+            The raw header of the frame.
+        data : bytes-like
+            The raw image data of the frame.
+        timestamp : float, optional
+            The reception time (seconds since the epoch). If None, the
+            current time. (default = None)
+
+        """
+
+        if timestamp is None:
+            timestamp = time.time()
+        header = memoryview(header).cast('B')
+        data = memoryview(data).cast('B')
+        with self._lock:
+            if self._closed:
+                return
+            offset = self._end
+            data_offset = _align(offset + len(header))
+            end = _align(data_offset + len(data))
+            if end > len(self._mmap):
+                self._mmap.resize(
+                    _align(end + self.chunk_size - end % self.chunk_size))
+            self._mmap[offset:offset + len(header)] = header
+            self._mmap[data_offset:data_offset + len(data)] = data
+            self._end = end
+            self._index_buffer[self._n_buffered] = (timestamp, offset,
+                                                    len(header), len(data))
+            self._n_buffered += 1
+            self.n_frames += 1
+            self.n_bytes += len(data)
+            if self._n_buffered == len(self._index_buffer):
+                self._write_index()
+
+    def close(self):
+        """
+        Stop recording, truncate the segment file and write the index.
+        """
+
+        self.stop()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._write_index()
+            self._index_file.close()
+            self._mmap.flush()
+            self._mmap.close()
+            self._file.truncate(self._end)
+            self._file.close()
+        if self.socket is not None:
+            self.socket.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def flush(self):
+        """
+        Write the recorded frames and the index to disk.
+        """
+
+        with self._lock:
+            if not self._closed:
+                self._mmap.flush()
+                self._write_index()
+
+    def start(self):
+        """
+        Connect to the stream and record in a background thread.
+
+        Returns
+        -------
+        recorder : CaptureRecorder
+            The recorder itself.
+
+        """
+
+        if self.socket is None:
+            context = self._context or zmq.Context.instance()
+            self.socket = context.socket(zmq.PULL)
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.setsockopt(zmq.RCVHWM, self._rcvhwm)
+            self.socket.connect(self.address)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop receiving frames.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class CaptureReplayer(object):
+    """
+    Replay of a capture on a ZMQ PUSH socket.
+
+    The frames are sent unchanged (same headers and frame ids) straight from
+    the memory-mapped segment file, without copying. They are scheduled on
+    the recorded time line divided by `speed`; a delayed frame is followed by
+    a burst that catches up with the schedule, as in
+    :meth:`StreamGenerator.run`.
+    """
+
+    def __init__(self, capture, address, speed=1.0, bind=True, block=True,
+                 context=None):
+        """
+        Open the stream socket.
+
+        Parameters
+        ----------
+        capture : Capture or str
+            The capture, or the path of its segment file.
+        address : str
+            The ZMQ address of the stream, e.g. "tcp://*:8080".
+        speed : float, optional
+            The replay speed relative to the recording: 1.0 reproduces the
+            original timing, 2.0 replays twice as fast. 0 sends as fast as
+            possible. (default = 1.0)
+        bind : bool, optional
+            Bind the PUSH socket to `address`, as the camera does, instead of
+            connecting to it. (default = True)
+        block : bool, optional
+            If True, sending blocks while no receiver is ready. Otherwise the
+            frame is dropped and counted in `n_dropped`, as the camera does.
+            (default = True)
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+
+        """
+
+        if not isinstance(capture, Capture):
+            capture = Capture(capture)
+        self.capture = capture
+        self.address = address
+        self.speed = float(speed)
+        self.block = block
+
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_bytes = 0
+        self.max_lag = 0.0
+        self._stopping = threading.Event()
+        self._thread = None
+
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.PUSH)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # blocking sends wake up regularly to check for stop()
+        self.socket.setsockopt(zmq.SNDTIMEO, 100)
+        if bind:
+            self.socket.bind(address)
+        else:
+            self.socket.connect(address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _send(self, index):
+        """
+        Send a frame of the capture.
+        """
+
+        header, data = self.capture.get_frame(index)
+        flags = zmq.SNDMORE if self.block else zmq.SNDMORE | zmq.NOBLOCK
+        while True:
+            try:
+                self.socket.send(header, flags=flags)
+                break
+            except zmq.Again:
+                if not self.block or self._stopping.is_set():
+                    self.n_dropped += 1
+                    return False
+        # the header is queued, so the data part can no longer be refused
+        self.socket.send(data, copy=False)
+        self.n_sent += 1
+        self.n_bytes += len(data)
+        return True
+
+    def close(self):
+        """
+        Stop a background replay, close the socket and the capture.
+        """
+
+        self.stop()
+        self.socket.close()
+        self.capture.close()
+
+    def run(self, repeat=1):
+        """
+        Replay the capture.
+
+        Parameters
+        ----------
+        repeat : int, optional
+            The number of times the capture is replayed. The repetitions
+            follow each other with the mean frame interval of the capture.
+            (default = 1)
+
+        Returns
+        -------
+        n_sent : int
+            The number of frames emitted, including dropped frames.
+
+        """
+
+        n_frames = len(self.capture)
+        if not n_frames:
+            return 0
+        timestamps = self.capture.index['timestamp']
+        offsets = timestamps - timestamps[0]
+        period = self.capture.duration * n_frames / max(n_frames - 1, 1)
+        t_start = time.perf_counter()
+        n_sent = 0
+        for repetition in range(int(repeat)):
+            for index in range(n_frames):
+                if self._stopping.is_set():
+                    return n_sent
+                if self.speed > 0:
+                    t_frame = t_start + (repetition * period +
+                                         offsets[index]) / self.speed
+                    delay = t_frame - time.perf_counter()
+                    if delay > 0 and self._stopping.wait(delay):
+                        return n_sent
+                    self.max_lag = max(self.max_lag, -delay)
+                self._send(index)
+                n_sent += 1
+        return n_sent
+
+    def start(self, repeat=1):
+        """
+        Replay the capture in a background thread, see :meth:`run`.
+
+        Returns
+        -------
+        replayer : CaptureReplayer
+            The replayer itself.
+
+        """
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run, args=(repeat,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop a background replay.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Record or replay the raw PCO camera stream.")
+    commands = parser.add_subparsers(dest='command')
+    record = commands.add_parser('record', help="record a stream")
+    record.add_argument('address', help="address of the camera stream")
+    record.add_argument('path', help="path of the capture segment file")
+    record.add_argument('--duration', type=float, default=None,
+                        help="stop after so many seconds (default: Ctrl-C)")
+    replay = commands.add_parser('replay', help="replay a capture")
+    replay.add_argument('path', help="path of the capture segment file")
+    replay.add_argument('address', help="ZMQ address, e.g. tcp://*:8080")
+    replay.add_argument('--speed', type=float, default=1.0,
+                        help="replay speed, 0 for as fast as possible")
+    replay.add_argument('--repeat', type=int, default=1)
+    replay.add_argument('--connect', action='store_true',
+                        help="connect to the address instead of binding")
+    arguments = parser.parse_args()
+
+    if arguments.command == 'record':
+        recorder = CaptureRecorder(arguments.path, arguments.address).start()
+        try:
+            time.sleep(arguments.duration or 1e9)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            recorder.close()
+        print("Recorded {} frames ({:.1f} MB) to {}".format(
+            recorder.n_frames, recorder.n_bytes / 1e6, arguments.path))
+    elif arguments.command == 'replay':
+        with CaptureReplayer(arguments.path, arguments.address,
+                             speed=arguments.speed,
+                             bind=not arguments.connect) as replayer:
+            t_start = time.perf_counter()
+            try:
+                replayer.run(repeat=arguments.repeat)
+            except KeyboardInterrupt:
+                pass
+            elapsed = time.perf_counter() - t_start
+        print("Sent {} frames ({:.1f} MB) in {:.2f} s: {:.1f} frames/s, "
+              "{:.1f} MB/s, max lag {:.3f} s".format(
+                  replayer.n_sent, replayer.n_bytes / 1e6, elapsed,
+                  replayer.n_sent / elapsed,
+                  replayer.n_bytes / 1e6 / elapsed, replayer.max_lag))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ __copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
 __docformat__ = 'restructuredtext en'
 
 
+import contextlib
 from enum import Enum
 import inspect
 import ipaddress
@@ -36,8 +37,24 @@ import pprint
 import re
 import requests
 import sys
+import threading
 import time
-import zmq
+
+from pco_rclient.client.pco_core import Call, Parallel, Sleep, run_steps
+from pco_rclient.client.pco_history import (StatisticsHistory,
+                                            format_throughput)
+from pco_rclient.client.pco_monitor import (StatisticsMonitor,
+                                            StatisticsSubscriber,
+                                            WriterSnapshot,
+                                            resolve_monitor_address)
+from pco_rclient.client.pco_polling import FixedPolling
+from pco_rclient.client.pco_recorder import (StatisticsRecorder,
+                                             get_record_path,
+                                             get_run_record_path)
+from pco_rclient.client.pco_session import PcoSession, ResponseCache
+from pco_rclient.client.pco_stream import (FlushHandle, FlushSummary,
+                                           StreamDrain)
+from pco_rclient.client.pco_trace import Tracer
 
 
 class NoTraceBackWithLineNumber(Exception):
@@ -231,57 +248,168 @@ class PcoWriter(object):
                  connection_address='tcp://129.129.99.104:8080',
                  flask_api_address = "http://xbl-daq-32:9901",
                  writer_api_address = "http://xbl-daq-32:9555",
-                 user_id=503, max_frames_per_file=20000, debug=False):
+                 user_id=503, max_frames_per_file=20000, debug=False,
+                 session=None, cache_ttl=0.0,
+                 statistics_monitor_address=None, polling_policy=None,
+                 record_statistics=None, connect='eager', trace=None):
         """
         Initialize the PCO Writer object.
+
+        Parameters
+        ----------
+        session : PcoSession, optional
+            The pooled HTTP session used to talk to the flask and writer
+            servers. Pass a configured :class:`PcoSession` to change the pool
+            size, keep-alive behavior or route timeouts, or to share the
+            connection pools between several writer objects. If None, a
+            default session is created and owned by this object.
+            (default = None)
+        cache_ttl : float, optional
+            If larger than zero, the status and statistics responses are
+            cached for so many seconds, and concurrent threads asking for the
+            same route share a single request. The cache is invalidated by all
+            calls changing the writer state (start, stop, kill, reset). The
+            hit/miss counters are available from `cache.get_info()`.
+            (default = 0.0, no caching)
+        statistics_monitor_address : str, optional
+            The address of the ZMQ statistics monitor of the writer (the
+            `statistics_monitor_address` of the writer configuration, e.g.
+            "tcp://*:8081", where a wildcard host stands for the writer host).
+            If set, wait() and wait_nframes() react to the statistics pushed
+            by the writer instead of polling the REST api, which is only
+            queried when the stream stays silent. (default = None)
+        polling_policy : object, optional
+            The policy deciding how long the start(), stop(), wait() and
+            wait_nframes() loops sleep between two polls, e.g. an
+            :class:`AdaptivePolling` instance. If None, a
+            :class:`FixedPolling` policy with the classic fixed intervals is
+            used. (default = None)
+        record_statistics : bool or str, optional
+            If set, the statistics retrieved during each run (by wait(),
+            wait_nframes(), get_snapshot(), get_progress_message() or a
+            running monitor) are recorded to a local .npy file per run, see
+            :class:`StatisticsRecorder`. With a string, the run number is
+            appended to it for the path of each recording (e.g.
+            "stats_001.npy" for "stats.npy"); if True, the recordings are
+            named after the output file and written to the current working
+            directory (e.g. "scan_statistics_001.npy" for "scan_%03d.h5").
+            start() raises a PcoError if the directory of the recordings does
+            not exist or is not writable. (default = None, no recording)
+        connect : str, optional
+            When the writer server is contacted to check the connection and
+            whether a writer process is running (which prevents applying the
+            configuration). 'eager' waits for both checks in the constructor.
+            'lazy' defers them to the first operation sending a request, and
+            'background' runs them in a background thread, which the first
+            operation waits for. In both deferred modes the configuration is
+            validated and applied right away, and reverted if a writer
+            process turns out to be running. (default = 'eager')
+        trace : bool or str, optional
+            If set, the configure(), start(), stop(), kill() and blocking
+            flush_cam_stream() calls and every run are traced: the time of
+            their events (request sent, server acknowledgment, first
+            'receiving' status, first frame received, end of the run) is
+            recorded in `tracer`, see :class:`Tracer`. A string is used as the
+            path of a JSON lines file the spans are appended to.
+            (default = None, no tracing)
         """
 
         # Note: the tcp://129.129.99.104:8080 connection address corresponds
         #       to the 1G copper link on x02da-pco-4
         #       (last updated: 2020-09-31)
-        
+
+        self._owns_session = session is None
+        if session is None:
+            session = PcoSession()
+        self.session = session
+        self.cache = ResponseCache(cache_ttl)
+        self._monitor = None
+        self._stream_drain = None
+        self.flush_handle = None
+        self.history = StatisticsHistory()
+        self.record_statistics = record_statistics
+        self.recorder = None
+        self.tracer = None
+        if trace:
+            self.tracer = Tracer(None if trace is True else trace)
+        if polling_policy is None:
+            polling_policy = FixedPolling()
+        self.polling_policy = polling_policy
+        self.statistics_monitor_address = None
+        if statistics_monitor_address:
+            self.statistics_monitor_address = validate_connection_address(
+                statistics_monitor_address, 'statistics_monitor_address')
+
         self.flask_api_address = validate_rest_api_address(
             flask_api_address, 'flask_api_address')
         self.writer_api_address = validate_rest_api_address(
             writer_api_address, 'writer_api_address')
 
-        if not self.is_connected():
-            print("WARNING: The writer server is not responding!")
-            print("A connection attempt with the following network address "
-                  "failed:\n  {}".format(self.flask_api_address))
-
         # set default values for configuration items
-        self.connection_address = ''
-        self.output_file = ''
-        self.dataset_name = ''
-        self.n_frames = 0
-        self.max_frames_per_file = 0
-        self.user_id = -1
+        self._reset_configuration()
 
         # set some start values
         self.last_run_id = 0
         self.previous_statistics = None
-        self.status = 'unconfigured'
 
-        if not debug:
-            if not self.is_running():
+        self.connect_mode = connect
+        self._configuration_args = dict(
+            output_file=output_file, dataset_name=dataset_name,
+            n_frames=n_frames, connection_address=connection_address,
+            user_id=user_id, max_frames_per_file=max_frames_per_file)
+        self._debug = debug
+        self._connect_lock = threading.RLock()
+        self._connect_threads = set()
+        self._connect_thread = None
+        self._connected = connect == 'eager'
+
+        if connect == 'eager':
+            self._apply_initial_configuration(self._probe_server())
+        elif connect in ('lazy', 'background'):
+            # apply the configuration now, it is reverted should a writer
+            # process turn out to be running
+            self._apply_initial_configuration(False)
+            if connect == 'background':
+                self._connect_thread = threading.Thread(
+                    target=self._ensure_connected)
+                self._connect_thread.daemon = True
+                self._connect_thread.start()
+        else:
+            raise PcoError("Problem with the connect mode:\n  {} is not one "
+                           "of 'eager', 'lazy' or 'background'".format(
+                               connect))
+
+    def __str__(self):
+        return("Proxy Class to control the PCO writer. It communicates with "
+               "the flask server running on xbl-daq-32 and the writer process "
+               "service (pco_writer_1).")
+
+    def _apply_initial_configuration(self, running):
+        """
+        Apply the configuration passed to the constructor, unless a writer
+        process is running.
+        """
+
+        args = self._configuration_args
+        if not self._debug:
+            if not running:
                 self.connection_address = validate_connection_address(
-                    connection_address, 'connection_address')
-                if output_file:
+                    args['connection_address'], 'connection_address')
+                if args['output_file']:
                     self.output_file = validate_output_file(
-                        output_file, 'output_file')
-                if dataset_name:
+                        args['output_file'], 'output_file')
+                if args['dataset_name']:
                     self.dataset_name = validate_dataset_name(
-                        dataset_name, "dataset_name")
-                if n_frames >= 0:
+                        args['dataset_name'], "dataset_name")
+                if args['n_frames'] >= 0:
                     self.n_frames = validate_nonneg_int_parameter(
-                        n_frames, 'n_frames')
-                if max_frames_per_file > 0:
+                        args['n_frames'], 'n_frames')
+                if args['max_frames_per_file'] > 0:
                     self.max_frames_per_file = validate_nonneg_int_parameter(
-                        max_frames_per_file, 'max_frames_per_file')
-                if user_id >= 0:
+                        args['max_frames_per_file'], 'max_frames_per_file')
+                if args['user_id'] >= 0:
                     self.user_id = validate_nonneg_int_parameter(
-                        user_id,'user_id')
+                        args['user_id'],'user_id')
                 if self.validate_configuration():
                     self.assert_filenumber_placeholder()
                     self.status = 'configured'
@@ -300,19 +428,341 @@ class PcoWriter(object):
                 "http://localhost:9555", 'writer_api_address')
             self.connection_address = validate_connection_address(
                 "tcp://pc9808:9999", 'connection_address')
-            self.output_file = validate_output_file(output_file, 'output_file')
+            self.output_file = validate_output_file(args['output_file'],
+                                                    'output_file')
             self.user_id = validate_nonneg_int_parameter(0, 'user_id')
-            self.n_frames = validate_nonneg_int_parameter(n_frames, 'n_frames')
+            self.n_frames = validate_nonneg_int_parameter(args['n_frames'],
+                                                          'n_frames')
             self.dataset_name = validate_dataset_name(
-                dataset_name, "dataset_name")
+                args['dataset_name'], "dataset_name")
             self.max_frames_per_file = validate_nonneg_int_parameter(
-                max_frames_per_file, 'max_frames_per_file')
+                args['max_frames_per_file'], 'max_frames_per_file')
             self.status = 'configured'
 
-    def __str__(self):
-        return("Proxy Class to control the PCO writer. It communicates with "
-               "the flask server running on xbl-daq-32 and the writer process "
-               "service (pco_writer_1).")
+    def _cancel_flush(self):
+        """
+        Cancel a background flush of the camera stream and wait for its end.
+        """
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle.join()
+
+    def _check_record_path(self):
+        """
+        Raise a PcoError if the statistics cannot be recorded.
+        """
+
+        path = self._get_record_path()
+        if path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory) or not os.access(directory, os.W_OK):
+            raise PcoError("The statistics cannot be recorded to {}: the "
+                           "directory does not exist or is not "
+                           "writable.".format(path))
+
+    def _close_recorder(self):
+        """
+        Close the statistics recording, if any.
+        """
+
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return
+        try:
+            recorder.close()
+        except OSError as e:
+            self._recording_failed(recorder, e)
+
+    def _ensure_connected(self):
+        """
+        Run the server checks deferred by the 'lazy' and 'background' connect
+        modes, once, before the first request.
+        """
+
+        if self._connected or threading.get_ident() in self._connect_threads:
+            return
+        with self._connect_lock:
+            if self._connected:
+                return
+            # the requests of the checks themselves must not wait for them
+            self._connect_threads.add(threading.get_ident())
+            try:
+                try:
+                    running = self._probe_server()
+                except Exception:
+                    # the operation itself reports the unreachable server
+                    running = False
+                if running:
+                    self._reset_configuration()
+                    self._apply_initial_configuration(True)
+                self._connected = True
+            finally:
+                self._connect_threads.discard(threading.get_ident())
+
+    def _fetch_snapshot(self):
+        """
+        Retrieve a snapshot from the writer server, bypassing the monitor.
+
+        The snapshot is not recorded, the caller records it (once) with
+        :meth:`_record_snapshot`.
+        """
+
+        return run_steps(self._fetch_snapshot_steps())
+
+    def _fetch_snapshot_steps(self):
+        stats = yield Call(self.get_statistics_writer)
+        if stats is None:
+            # without statistics of the running writer, only the status of
+            # the server tells whether a writer process is running; the
+            # statistics of the last run are asked for at the same time
+            status, last_stats = yield Parallel(
+                Call(self.get_status_writer),
+                Call(self.get_statistics_last_run))
+            snapshot = WriterSnapshot(status, None)
+            if not snapshot.is_running:
+                snapshot = WriterSnapshot(status, last_stats)
+            return snapshot
+        status = stats.get('status', None)
+        if status is None:
+            status = yield Call(self.get_status_writer)
+        return WriterSnapshot(status, stats)
+
+    def _fetch_statistics_steps(self, verbose=False):
+        stats = yield Call(self.get_statistics_writer, verbose=verbose)
+        if stats is None:
+            stats = yield Call(self.get_statistics_last_run, verbose=verbose)
+        return stats
+
+    def _flush_in_background(self, timeout):
+        """
+        Start a background flush of the camera stream whatever the state of
+        the writer, e.g. while a run writes its last frames.
+
+        The handle is kept in `flush_handle`, see :meth:`flush_cam_stream`.
+        """
+
+        if self._stream_drain is None:
+            self._stream_drain = StreamDrain()
+        self._cancel_flush()
+        self.flush_handle = FlushHandle(
+            self._stream_drain, self.connection_address, timeout=timeout)
+        return self.flush_handle
+
+    def _get_monitor_snapshot(self):
+        """
+        Return the latest snapshot of the running monitor, if any.
+        """
+
+        if self._monitor is None or not self._monitor.is_alive():
+            return None
+        return self._monitor.get_snapshot()
+
+    def _get_record_path(self):
+        """
+        Return the path of the statistics recordings, without run number.
+        """
+
+        if not self.record_statistics:
+            return None
+        if self.record_statistics is True:
+            return get_record_path(self.output_file)
+        return self.record_statistics
+
+    def _next_snapshot_steps(self, subscriber, interval):
+        """
+        Wait for the next snapshot of a poll loop.
+
+        While a statistics monitor is running, its next update (or its latest
+        snapshot after `interval` seconds) is used. With a statistics
+        subscriber, the next pushed statistics update is used. The REST api is
+        polled after `interval` seconds if there is no subscriber, or if the
+        statistics stream stays silent for as long (e.g. because the run has
+        ended and the writer stopped publishing).
+        """
+
+        if self._get_monitor_snapshot() is not None:
+            snapshot = yield Call(self._monitor.wait_update, interval)
+            return snapshot
+        if subscriber is not None:
+            stats = yield Call(subscriber.receive,
+                               min(interval, subscriber.timeout))
+            if stats is not None and 'status' in stats:
+                snapshot = WriterSnapshot(stats['status'], stats)
+                self._record_snapshot(snapshot)
+                return snapshot
+        else:
+            yield Sleep(interval)
+        snapshot = yield from self._get_snapshot_steps()
+        return snapshot
+
+    def _open_statistics_subscriber(self):
+        """
+        Subscribe to the statistics monitor, if configured and not already
+        consumed by a running monitor.
+        """
+
+        if (not self.statistics_monitor_address or
+                self._get_monitor_snapshot() is not None):
+            return None
+        return StatisticsSubscriber(resolve_monitor_address(
+            self.statistics_monitor_address, self.writer_api_address))
+
+    def _probe_server(self):
+        """
+        Check the connection to the writer server and whether a writer
+        process is running, with both requests sent concurrently.
+
+        Returns True if a writer process is running (never in debug mode).
+        """
+
+        result = {}
+
+        def check_connection():
+            self._connect_threads.add(threading.get_ident())
+            try:
+                result['connected'] = self.is_connected()
+            except Exception:
+                result['connected'] = False
+            finally:
+                self._connect_threads.discard(threading.get_ident())
+
+        thread = threading.Thread(target=check_connection)
+        thread.daemon = True
+        thread.start()
+        try:
+            if self._debug:
+                return False
+            return self.is_running()
+        finally:
+            thread.join()
+            if not result.get('connected'):
+                print("WARNING: The writer server is not responding!")
+                print("A connection attempt with the following network "
+                      "address failed:\n  {}".format(self.flask_api_address))
+
+    def _progress_message(self, snapshot):
+        """
+        Return the progress message of a snapshot with the current throughput.
+        """
+
+        msg = snapshot.get_progress_message()
+        if snapshot.is_running:
+            throughput = format_throughput(self.get_throughput())
+            if throughput:
+                msg = "{}, {}".format(msg, throughput)
+        return msg
+
+    def _record_snapshot(self, snapshot):
+        """
+        Add a snapshot to the statistics history and the recording, if any.
+        """
+
+        self.history.add_snapshot(snapshot)
+        recorder = self.recorder
+        if recorder is not None:
+            try:
+                recorder.add_snapshot(snapshot)
+            except OSError as e:
+                self.recorder = None
+                self._recording_failed(recorder, e)
+        if self.tracer is not None:
+            self.tracer.observe_snapshot(snapshot)
+
+    def _recording_failed(self, recorder, error):
+        """
+        Report a failed statistics recording, which is given up.
+        """
+
+        print("WARNING: Recording the statistics to {} failed, the recording "
+              "is stopped: {!r}".format(recorder.path, error))
+
+    def _refresh_monitor(self):
+        """
+        Let a running monitor publish the writer state after a state change.
+        """
+
+        if self._monitor is not None and self._monitor.is_alive():
+            self._monitor.refresh()
+
+    def _request(self, method, address, route, **kwargs):
+        """
+        Send a request to one of the ROUTES through the pooled session.
+        """
+
+        self._ensure_connected()
+        return self.session.request(method, address, ROUTES[route],
+                                    route=route, **kwargs)
+
+    def _request_json(self, method, address, route, cached=False,
+                      **kwargs):
+        """
+        Send a request to one of the ROUTES and decode the json response.
+
+        With `cached` set, the response may be served from (and is stored in)
+        the status cache.
+        """
+
+        if cached:
+            response = self.cache.get(
+                (address, route),
+                lambda: self._request(method, address, route, **kwargs).json())
+        else:
+            response = self._request(method, address, route, **kwargs).json()
+        if self.tracer is not None and route == "status":
+            self.tracer.observe_status(response.get('status'))
+        return response
+
+    def _reset_configuration(self):
+        """
+        Set the configuration items to their unconfigured values.
+        """
+
+        self.connection_address = ''
+        self.output_file = ''
+        self.dataset_name = ''
+        self.n_frames = 0
+        self.max_frames_per_file = 0
+        self.user_id = -1
+        self.status = 'unconfigured'
+
+    @contextlib.contextmanager
+    def _trace(self, name, **fields):
+        """
+        Trace the enclosed operation in a span, if tracing.
+
+        The open span is returned by the context manager, None if not
+        tracing. An exception ends the span with its `error`.
+        """
+
+        if self.tracer is None:
+            yield None
+            return
+        span = self.tracer.begin(name, **fields)
+        try:
+            yield span
+        except BaseException as e:
+            self.tracer.end(span, error=repr(e))
+            raise
+        self.tracer.end(span)
+
+    def _trace_mark(self, event, *spans):
+        """
+        Mark an event of the trace spans opened by :meth:`_trace`.
+        """
+
+        for span in spans:
+            if span is not None:
+                self.tracer.mark(span, event)
+
+    def _trace_update(self, span, **fields):
+        """
+        Add information to a trace span opened by :meth:`_trace`.
+        """
+
+        if span is not None:
+            span.fields.update(fields)
 
     def assert_filenumber_placeholder(self):
         """
@@ -333,6 +783,29 @@ class PcoWriter(object):
                 self.output_file = insert_placeholder(
                     self.output_file, len(self.output_file)-3)
 
+    def close(self):
+        """
+        Close the pooled connections to the writer servers.
+
+        A session passed to the constructor is shared and therefore left open.
+        A running statistics monitor is stopped, a statistics recording and
+        the trace are completed and the stream receiver of flush_cam_stream()
+        is closed (a background flush is cancelled).
+
+        """
+
+        if self._monitor is not None:
+            self._monitor.stop()
+        self._close_recorder()
+        if self.tracer is not None:
+            self.tracer.close()
+        self._cancel_flush()
+        if self._stream_drain is not None:
+            self._stream_drain.close()
+            self._stream_drain = None
+        if self._owns_session:
+            self.session.close()
+
     def configure(self, output_file=None, dataset_name=None, n_frames=None,
                   connection_address=None, user_id=None,
                   max_frames_per_file=None, verbose=False):
@@ -379,7 +852,10 @@ class PcoWriter(object):
 
         """
 
-        if not self.is_running():
+        with self._trace('configure') as span:
+            running = self.is_running()
+            self._trace_update(span, running=running)
+        if not running:
             if output_file is not None:
                 self.output_file = validate_output_file(
                     output_file, 'output_file')
@@ -418,10 +894,22 @@ class PcoWriter(object):
                     "configuration.\n")
         return None
 
-    def flush_cam_stream(self, timeout=500, verbose=False):
+    def connect(self):
+        """
+        Contact the writer server now, if the 'lazy' or 'background' connect
+        mode has deferred it (waits for the checks running in background).
+        """
+
+        self._ensure_connected()
+
+    def flush_cam_stream(self, timeout=500, verbose=False, summary=False,
+                         background=False):
         """
         Flush the ZMQ stream.
 
+        The frames are drained without copying and in batches by a receiver
+        kept for the lifetime of the client, see :class:`StreamDrain`.
+
         Parameters
         ----------
         timeout : float, optional
@@ -431,39 +919,64 @@ class PcoWriter(object):
             be terminated with a KeyboardInterrupt (Ctrl-C) signal.
             (default = 500)
         verbose : bool, optional
-            Show verbose information durign the flushing operation.
+            Show verbose information durign the flushing operation. The header
+            of every frame is decoded and printed. (default = False)
+        summary : bool, optional
+            Return a :class:`FlushSummary` (frames, bytes, duration, first and
+            last frame id) instead of the number of packets. (default = False)
+        background : bool, optional
+            Flush in a background thread and return a :class:`FlushHandle`
+            right away, which reports the progress and can cancel() or join()
+            the flush. The handle is also kept in `flush_handle`; start()
+            cancels the flush before starting the writer. A flush that is
+            not in background while a background flush is running waits for
+            the end of the background flush and reports its frames.
             (default = False)
 
+        Returns
+        -------
+        result : int or FlushSummary or FlushHandle or None
+            The number of packets (headers and data) received, the summary of
+            the flush, or the handle of the background flush. None if the
+            writer is running.
+
         """
         if not self.is_running():
-            try:
-                if verbose:
-                    print("Flushing camera stream ... (Ctrl-C to stop)")
-                    if timeout > 0:
-                        print("Flush will terminate after {} ms of inactivity on "
-                            "the data stream.".format(timeout))
-                context = zmq.Context()
-                socket = context.socket(zmq.PULL)
-                socket.connect(self.connection_address)
-                packets_counter = 0
-                if timeout > 0:
-                        receiving = bool(socket.poll(timeout))
-                else:
-                    receiving = True
-                while receiving:
-                    string = socket.recv()
-                    if packets_counter % 2 != 1:
+            if self._stream_drain is None:
+                self._stream_drain = StreamDrain()
+            if background:
+                return self._flush_in_background(timeout)
+            result = FlushSummary()
+            handle = self.flush_handle
+            with self._trace('flush', timeout=timeout) as span:
+                try:
+                    if handle is not None and not handle.done():
+                        # the background flush holds the stream
+                        result = handle.summary
                         if verbose:
-                            d = json.loads(string.decode())
-                            print(packets_counter, d)
-                    packets_counter+=1
-                    if timeout > 0:
-                        receiving = bool(socket.poll(timeout))
-                socket.close()
-                context.term()
-            except KeyboardInterrupt:
-                pass
-            return packets_counter
+                            print("Waiting for the background flush ... "
+                                  "(Ctrl-C to stop)")
+                        handle.join()
+                    else:
+                        if verbose:
+                            print("Flushing camera stream ... "
+                                  "(Ctrl-C to stop)")
+                            if timeout > 0:
+                                print("Flush will terminate after {} ms of "
+                                      "inactivity on the data "
+                                      "stream.".format(timeout))
+                        self._stream_drain.drain(
+                            self.connection_address, timeout=timeout,
+                            decode_headers=verbose,
+                            on_header=print if verbose else None,
+                            summary=result)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    self._trace_update(span, n_frames=result.n_frames)
+            if summary:
+                return result
+            return result.n_messages
         return None
 
     def get_configuration(self, verbose=False):
@@ -488,25 +1001,11 @@ class PcoWriter(object):
         Return a string indicating the current progress of the writer.
         """
 
-        stats = self.get_statistics()
-        if stats is None:
-            msg = "Writer: Status not available"
-        else:
-            status = stats.get('status', "unknown")
-            n_req = stats.get('n_frames', -1)
-            n_rcvd = stats.get('n_received_frames', 0)
-            n_wrtn = stats.get('n_written_frames', 0)
-            if n_req > 0: 
-                pc_rcvd = float(n_rcvd) / n_req * 100.0
-                pc_wrtn = float(n_wrtn) / n_req * 100.0
-                msg = ("Writer: {}, #received: {:4d} ({:.1f}%), "
-                        "#written: {:4d} ({:.1f}%)".format(
-                        status, n_rcvd, pc_rcvd, n_wrtn, pc_wrtn))
-            else:
-                msg = ("Writer: {}, #received: {:4d}, "
-                        "#written: {:4d}".format(
-                        status, n_rcvd, n_wrtn))
-        return msg
+        return run_steps(self._get_progress_message_steps())
+
+    def _get_progress_message_steps(self):
+        snapshot = yield from self._get_snapshot_steps()
+        return self._progress_message(snapshot)
 
     def get_server_log(self, verbose=False):
         """
@@ -518,9 +1017,9 @@ class PcoWriter(object):
             The last 10 lines of the writer server.
 
         """
-        request_url = self.flask_api_address+ROUTES["server_log"]
         try:
-            response = requests.get(request_url).json()
+            response = self._request(
+                'GET', self.flask_api_address, "server_log").json()
             if 'success' in response:
                 if verbose:
                     print("\nPCO writer server log:")
@@ -540,9 +1039,10 @@ class PcoWriter(object):
             The uptime of the writer server service.
 
         """
-        request_url = self.flask_api_address+ROUTES["server_uptime"]
         try:
-            response = requests.get(request_url, data={"key": "uptime"}).json()
+            response = self._request('GET', self.flask_api_address,
+                                     "server_uptime",
+                                     data={"key": "uptime"}).json()
             if 'success' in response:
                 if verbose:
                     print("\nPCO writer server log:")
@@ -552,6 +1052,36 @@ class PcoWriter(object):
             return None
         return None
 
+    def get_snapshot(self):
+        """
+        Retrieve the status and statistics of the writer in one go.
+
+        The statistics of a running writer process contain its status, so a
+        single request is sufficient to determine whether the writer is
+        running, its progress and the number of frames written. Otherwise the
+        status of the writer server is requested, and only if it reports no
+        running writer process, the statistics of the last run as well.
+
+        While a statistics monitor is running (see :meth:`monitor`), the
+        latest snapshot of the monitor is returned without contacting the
+        writer server.
+
+        Returns
+        -------
+        snapshot : WriterSnapshot
+            The status and statistics of the writer at the time of the call.
+
+        """
+
+        return run_steps(self._get_snapshot_steps())
+
+    def _get_snapshot_steps(self):
+        snapshot = self._get_monitor_snapshot()
+        if snapshot is None:
+            snapshot = yield from self._fetch_snapshot_steps()
+            self._record_snapshot(snapshot)
+        return snapshot
+
     def get_statistics(self, verbose=False):
         """
         Get the statistics of the writer.
@@ -560,6 +1090,9 @@ class PcoWriter(object):
         returned, otherwise the statistics from the last writer process are
         returned.
 
+        While a statistics monitor is running (see :meth:`monitor`), the
+        statistics of its latest snapshot are returned.
+
         Returns
         -------
         stats : dict or None
@@ -568,9 +1101,13 @@ class PcoWriter(object):
 
         """
 
-        stats = self.get_statistics_writer(verbose=verbose)
-        if stats is None:
-            stats = self.get_statistics_last_run(verbose=verbose)
+        return run_steps(self._get_statistics_steps(verbose=verbose))
+
+    def _get_statistics_steps(self, verbose=False):
+        snapshot = self._get_monitor_snapshot()
+        if snapshot is not None:
+            return snapshot.statistics
+        stats = yield from self._fetch_statistics_steps(verbose=verbose)
         return stats
 
     def get_statistics_last_run(self, verbose=False):
@@ -585,9 +1122,9 @@ class PcoWriter(object):
 
         """
 
-        request_url = self.flask_api_address+ROUTES["finished"]
         try:
-            response = requests.get(request_url, timeout=3).json()
+            response = self._request_json(
+                'GET', self.flask_api_address, "finished", cached=True)
             self.previous_statistics = response
             if verbose:
                 print("\nPCO writer statistics:\n")
@@ -612,9 +1149,9 @@ class PcoWriter(object):
 
         """
 
-        request_url = self.writer_api_address + ROUTES["statistics"]
         try:
-            response = requests.get(request_url).json()
+            response = self._request_json(
+                'GET', self.writer_api_address, "statistics", cached=True)
             if validate_statistics_response(response):
                 if verbose:
                     print("\nPCO writer statistics:\n")
@@ -625,7 +1162,7 @@ class PcoWriter(object):
                 print("PCO writer did not return a validated statistics "
                         "response")
             return None
-        except requests.ConnectionError:
+        except (requests.ConnectionError, requests.Timeout):
             # We expect a timeout error if the writer is not running, so return
             # None
             if verbose:
@@ -687,9 +1224,9 @@ class PcoWriter(object):
 
         """
 
-        request_url = self.flask_api_address+ROUTES["finished"]
         try:
-            response = requests.get(request_url, timeout=3).json()
+            response = self._request_json(
+                'GET', self.flask_api_address, "finished", cached=True)
             return response['status']
         except requests.ConnectionError:
             raise PcoError("The writer server seems to be disconnected and is "
@@ -708,9 +1245,9 @@ class PcoWriter(object):
 
         """
 
-        request_url = self.flask_api_address+ROUTES["status"]
         try:
-            response = requests.get(request_url, timeout=3).json()
+            response = self._request_json(
+                'GET', self.flask_api_address, "status", cached=True)
             return(response['status'])
         except requests.ConnectionError:
             raise PcoError("The writer server seems to be disconnected and is "
@@ -718,6 +1255,35 @@ class PcoWriter(object):
         except:
             raise
 
+    def get_throughput(self, window=5.0):
+        """
+        Estimate the throughput of the current run.
+
+        The estimate is computed locally from the statistics history, which
+        records every snapshot of the running writer retrieved by this client
+        (by wait(), wait_nframes(), get_snapshot(), get_progress_message() or
+        a running monitor, see :meth:`monitor`).
+
+        Parameters
+        ----------
+        window : float, optional
+            The length [s] of the most recent time window used to fit the
+            rates. (default = 5.0)
+
+        Returns
+        -------
+        throughput : dict
+            The smoothed receive and write rates ("receive_fps",
+            "write_fps"), the receive-minus-write "backlog" and its growth
+            rate "backlog_rate", the rate of lost frames "lost_fps" and the
+            estimated time "eta" [s] until all n_frames frames are written,
+            see :meth:`StatisticsHistory.get_throughput`.
+
+        """
+
+        return self.history.get_throughput(n_frames=self.n_frames,
+                                           window=window)
+
     def get_written_frames(self):
         """
         Return the number of frames written to file.
@@ -735,7 +1301,10 @@ class PcoWriter(object):
 
         """
 
-        stats = self.get_statistics()
+        return run_steps(self._get_written_frames_steps())
+
+    def _get_written_frames_steps(self):
+        stats = yield from self._get_statistics_steps()
         if stats is not None:
             return stats.get('n_written_frames', None)
         return None
@@ -745,9 +1314,9 @@ class PcoWriter(object):
         Verify whether a connection to the writer service is available.
         """
 
-        request_url = self.flask_api_address+ROUTES["ack"]
         try:
-            response = requests.get(request_url, timeout=3).json()
+            response = self._request(
+                'GET', self.flask_api_address, "ack").json()
             if 'success' in response:
                 return True
         except requests.ConnectionError:
@@ -759,9 +1328,9 @@ class PcoWriter(object):
         Verify wether a writer process is currently running.
         """
 
-        request_url = self.flask_api_address+ROUTES["status"]
         try:
-            response = requests.get(request_url, timeout=3).json()
+            response = self._request_json(
+                'GET', self.flask_api_address, "status", cached=True)
             return bool(response['status'] in ('receiving', 'writing'))
         except requests.ConnectionError:
             raise PcoError("The writer server seems to be disconnected and is "
@@ -781,39 +1350,129 @@ class PcoWriter(object):
 
         """
 
-        # check if writer is running before killing it
-        response = 0
-        if self.is_running():
-            self.status = 'killing'
-            request_url = self.writer_api_address + ROUTES["kill"]
-            try:
-                response = requests.get(request_url).json()
-                if validate_kill_response(response):
-                    if verbose:
-                        print("\nPCO writer process successfully killed.\n")
-                else:
-                    print("\nPCO writer kill() failed.")
-            except requests.ConnectionError:
-                raise PcoError("The writer server seems to be disconnected "
-                               "and is not responding.")
-            except:
-                raise
-        else:
-            if verbose:
-                print("\nWriter is not running, impossible to kill(). Please "
-                      "start it using the start() method.\n")
-        self.status = self.get_status()
+        with self._trace('kill') as span:
+            # check if writer is running before killing it
+            response = 0
+            if self.is_running():
+                self.status = 'killing'
+                try:
+                    self._trace_mark('request_sent', span)
+                    response = self._request(
+                        'GET', self.writer_api_address, "kill").json()
+                    self._trace_mark('server_ack', span)
+                    self.cache.invalidate()
+                    if validate_kill_response(response):
+                        if verbose:
+                            print("\nPCO writer process successfully "
+                                  "killed.\n")
+                    else:
+                        print("\nPCO writer kill() failed.")
+                except requests.ConnectionError:
+                    raise PcoError("The writer server seems to be "
+                                   "disconnected and is not responding.")
+                except:
+                    raise
+            else:
+                if verbose:
+                    print("\nWriter is not running, impossible to kill(). "
+                          "Please start it using the start() method.\n")
+            self._refresh_monitor()
+            self.status = self.get_status()
         return response
 
-    def reset(self):
+    def milestones(self, frame_counts, field='n_written_frames',
+                   interval=0.5):
+        """
+        Register frame-count milestones of the current or next run.
+
+        Instead of blocking in several wait_nframes() calls, all milestones
+        of an acquisition can be registered up front. They are resolved by
+        the single background monitor of the writer (started with the given
+        `interval` if not already running, see :meth:`monitor`).
+
+        Parameters
+        ----------
+        frame_counts : iterable of int
+            The frame counts to wait for.
+        field : str, optional
+            The statistics field to compare, 'n_written_frames' or
+            'n_received_frames'. (default = 'n_written_frames')
+        interval : float, optional
+            The poll interval [s] of the monitor, if it needs to be started.
+            (default = 0.5)
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            One future per frame count, resolved with the snapshot that
+            reached the milestone, or failing with a MilestoneError if the run
+            ends before.
+
+        Examples
+        --------
+        >>> first, middle = pco_controller.milestones([100, 500])
+        >>> pco_controller.start()
+        >>> first.result(timeout=60)
+        >>> middle.result(timeout=60)
+
+        """
+
+        return self.monitor(interval=interval).add_milestones(
+            frame_counts, field=field)
+
+    def monitor(self, interval=0.5):
+        """
+        Start a background monitor of the writer statistics.
+
+        A single background thread polls the writer (or subscribes to its
+        statistics monitor stream, see `statistics_monitor_address`) and keeps
+        the latest statistics. While the monitor is running, get_snapshot(),
+        get_statistics(), get_progress_message() as well as the progress
+        reports of wait() and wait_nframes() are served from the monitor's
+        snapshot instead of contacting the writer server. Callbacks for
+        status changes and frame-count thresholds can be registered with the
+        returned monitor.
+
+        Calling monitor() again returns the already running monitor.
+
+        Parameters
+        ----------
+        interval : float, optional
+            The time [s] between two REST api polls of the monitor.
+            (default = 0.5)
+
+        Returns
+        -------
+        monitor : StatisticsMonitor
+            The running monitor. Stop it with its stop() method or with
+            close().
+
+        """
+
+        if self._monitor is None or not self._monitor.is_alive():
+            self._monitor = StatisticsMonitor(self, interval=interval)
+            self._monitor.refresh()
+            self._monitor.start()
+        return self._monitor
+
+    def reset(self, background_flush=False):
         """
         Reset the writer client object.
+
+        Parameters
+        ----------
+        background_flush : bool, optional
+            Flush the camera stream in the background, see
+            :meth:`flush_cam_stream`, instead of waiting for one second of
+            inactivity on the stream. (default = False)
+
         """
 
         self.kill()
-        self.flush_cam_stream(timeout=1000)
+        self.flush_cam_stream(timeout=1000, background=background_flush)
         self.last_run_id = 0
         self.previous_statistics = None
+        self.cache.invalidate()
         if self.validate_configuration():
             self.status = 'configured'
         else:
@@ -836,44 +1495,92 @@ class PcoWriter(object):
             (default = False)
 
         """
+
+        return run_steps(self._start_steps(wait=wait, timeout=timeout,
+                                           verbose=verbose))
+
+    def _start_recorder(self):
+        """
+        Open a new statistics recording for the run that has just started.
+        """
+
+        self._close_recorder()
+        path = self._get_record_path()
+        if path is not None:
+            self.recorder = StatisticsRecorder(
+                get_run_record_path(path, self.last_run_id))
+
+    def _start_steps(self, wait=True, timeout=10, verbose=False,
+                     before_start=None):
+        # `before_start` is called right before the start request is sent,
+        # once the writer is known not to be running
         if not self.validate_configuration():
             raise PcoError("PCO writer is not properly configured! "
                 "Please configure the writer by calling the "
                 "configure() command before you start()")
-        response = 0
-        if not self.is_running():
-            request_url = self.flask_api_address + ROUTES["start_pco"]
-            try:
-                self.status = 'starting'
-                data_json = json.dumps(self.get_configuration())
-                response = requests.post(request_url, data=data_json).json()
-                if validate_response(response):
-                    self.last_run_id += 1
-                    if verbose:
-                        print("\nPCO writer trigger start successfully "
-                              "submitted to the server.\n")
-                else:
-                    print("\nPCO writer trigger start failed. "
-                          "Server response: %s\n" % (response))
-            except requests.ConnectionError:
-                raise PcoError("The writer server seems to be disconnected "
-                               "and is not responding.")
-            except:
-                raise
-        else:
-            print("\nWriter is already running, impossible to start() "
-                  "again.\n")
-        # waits for is_running if wait=True
-        if 'success' in response and wait:
-            timeout_limit = time.time() + timeout
-            while not self.is_running():
-                if time.time() > timeout_limit:
-                    print("WARNING!\n"
-                          "PCO writer did not report reaching the running "
-                          "state within the timeout of {} s. ".format(timeout))
-                    break
-                time.sleep(0.15)
-        self.status = self.get_status()
+        self._check_record_path()
+        with self._trace('start', dataset_name=self.dataset_name) as span:
+            response = 0
+            if not (yield Call(self.is_running)):
+                # the flush would receive the frames meant for the writer
+                yield Call(self._cancel_flush)
+                run_span = None
+                run_error = None
+                try:
+                    self.status = 'starting'
+                    data_json = json.dumps(self.get_configuration())
+                    if self.tracer is not None:
+                        run_span = self.tracer.begin_run(
+                            output_file=self.output_file,
+                            dataset_name=self.dataset_name,
+                            n_frames=self.n_frames)
+                    if before_start is not None:
+                        yield Call(before_start)
+                    self._trace_mark('request_sent', span, run_span)
+                    response = yield Call(
+                        self._request_json, 'POST', self.flask_api_address,
+                        "start_pco", data=data_json)
+                    self._trace_mark('server_ack', span, run_span)
+                    self.cache.invalidate()
+                    if validate_response(response):
+                        self.last_run_id += 1
+                        self._start_recorder()
+                        if verbose:
+                            print("\nPCO writer trigger start successfully "
+                                  "submitted to the server.\n")
+                    else:
+                        run_error = "start failed: {}".format(response)
+                        print("\nPCO writer trigger start failed. "
+                              "Server response: %s\n" % (response))
+                except requests.ConnectionError as e:
+                    run_error = repr(e)
+                    raise PcoError("The writer server seems to be "
+                                   "disconnected and is not responding.")
+                except BaseException as e:
+                    run_error = repr(e)
+                    raise
+                finally:
+                    # the run has not begun, its end will not be observed
+                    if run_span is not None and run_error is not None:
+                        self.tracer.end(run_span, final_status='failed',
+                                        error=run_error)
+            else:
+                print("\nWriter is already running, impossible to start() "
+                      "again.\n")
+            # waits for is_running if wait=True
+            if 'success' in response and wait:
+                timeout_limit = time.time() + timeout
+                schedule = self.polling_policy.schedule('start')
+                while not (yield Call(self.is_running)):
+                    if time.time() > timeout_limit:
+                        print("WARNING!\n"
+                              "PCO writer did not report reaching the running "
+                              "state within the timeout of {} s. ".format(
+                                  timeout))
+                        break
+                    yield Sleep(schedule.next_interval())
+            yield Call(self._refresh_monitor)
+            self.status = yield Call(self.get_status)
         return response
 
     def stop(self, wait=True, timeout=10,verbose=False):
@@ -888,41 +1595,53 @@ class PcoWriter(object):
 
         """
 
-        # check if writer is running before stopping it
-        response = 0
-        if self.is_running():
-            self.status = 'stopping'
-            request_url = self.writer_api_address + ROUTES["stop"]
-            try:
-                response = requests.get(request_url).json()
-                if validate_response(response):
-                    if verbose:
-                        print("\nPCO writer trigger stop successfully "
-                              "submitted to the server.\n")
-                else:
-                    print("\nPCO writer stop writer failed. Server response: "
-                          "%s\n" % (response))
-            except requests.ConnectionError:
-                raise PcoError("The writer server seems to be disconnected "
-                               "and is not responding.")
-            except:
-                raise
-        else:
-            if verbose:
-                print("\nWriter is not running, impossible to stop(). "
-                      "Please start it using the start() method.\n")
-        # waits for is_running if wait=True
-        if response != 0:
-            if 'success' in response and wait:
-                timeout_limit = time.time() + timeout
-                while self.is_running():
-                    if time.time() > timeout_limit:
-                        print("WARNING!\n"
-                            "PCO writer did not report reaching the finished "
-                            "state within the timeout of {} s. ".format(timeout))
-                        break
-                    time.sleep(0.15)
-        self.status = self.get_status()
+        return run_steps(self._stop_steps(wait=wait, timeout=timeout,
+                                          verbose=verbose))
+
+    def _stop_steps(self, wait=True, timeout=10, verbose=False):
+        with self._trace('stop') as span:
+            # check if writer is running before stopping it
+            response = 0
+            if (yield Call(self.is_running)):
+                self.status = 'stopping'
+                try:
+                    self._trace_mark('request_sent', span)
+                    response = yield Call(
+                        self._request_json, 'GET', self.writer_api_address,
+                        "stop")
+                    self._trace_mark('server_ack', span)
+                    self.cache.invalidate()
+                    if validate_response(response):
+                        if verbose:
+                            print("\nPCO writer trigger stop successfully "
+                                  "submitted to the server.\n")
+                    else:
+                        print("\nPCO writer stop writer failed. Server "
+                              "response: %s\n" % (response))
+                except requests.ConnectionError:
+                    raise PcoError("The writer server seems to be "
+                                   "disconnected and is not responding.")
+                except:
+                    raise
+            else:
+                if verbose:
+                    print("\nWriter is not running, impossible to stop(). "
+                          "Please start it using the start() method.\n")
+            # waits for is_running if wait=True
+            if response != 0:
+                if 'success' in response and wait:
+                    timeout_limit = time.time() + timeout
+                    schedule = self.polling_policy.schedule('stop')
+                    while (yield Call(self.is_running)):
+                        if time.time() > timeout_limit:
+                            print("WARNING!\n"
+                                "PCO writer did not report reaching the "
+                                "finished state within the timeout of {} "
+                                "s. ".format(timeout))
+                            break
+                        yield Sleep(schedule.next_interval())
+            yield Call(self._refresh_monitor)
+            self.status = yield Call(self.get_status)
         return response
 
     def validate_configuration(self):
@@ -967,7 +1686,11 @@ class PcoWriter(object):
 
         """
 
-        if not self.is_running():
+        return run_steps(self._wait_steps(verbose=verbose))
+
+    def _wait_steps(self, verbose=False):
+        snapshot = yield from self._get_snapshot_steps()
+        if not snapshot.is_running:
             if verbose:
                 print("\nWriter is not running, nothing to wait().\n")
             return
@@ -976,24 +1699,29 @@ class PcoWriter(object):
             print("Waiting for the writer to finish")
             print("  (Press Ctrl-C to stop waiting)")
         spinner = itertools.cycle(['-', '/', '|', '\\'])
-        msg = self.get_progress_message()
-        sys.stdout.write(msg)
+        sys.stdout.write(self._progress_message(snapshot))
         sys.stdout.flush()
+        subscriber = self._open_statistics_subscriber()
+        schedule = self.polling_policy.schedule('wait')
         try:
-            while self.is_running():
-                msg = ("{} {}".format(self.get_progress_message(),
-                                      (next(spinner))))
+            while snapshot.is_running:
+                msg = "{} {}".format(self._progress_message(snapshot),
+                                     next(spinner))
                 sys.stdout.write('\r\033[K')
                 sys.stdout.write(msg)
                 sys.stdout.flush()
-                time.sleep(0.1)
+                snapshot = yield from self._next_snapshot_steps(
+                    subscriber, schedule.next_interval(snapshot))
         except KeyboardInterrupt:
             pass
+        finally:
+            if subscriber is not None:
+                subscriber.close()
         print("\n")
-        self.status = self.get_status()
+        self.status = yield Call(self.get_status)
 
         if verbose:
-            if not self.is_running():
+            if not snapshot.is_running:
                 print("\nWriter is not running anymore, exiting wait().\n")
             else:
                 print("\nWriter is still running, exiting wait().\n")
@@ -1030,8 +1758,14 @@ class PcoWriter(object):
             out, False otherwise.
 
         """
-        
-        if not self.is_running():
+
+        return run_steps(self._wait_nframes_steps(
+            nframes, inactivity_timeout=inactivity_timeout, verbose=verbose))
+
+    def _wait_nframes_steps(self, nframes, inactivity_timeout=-1,
+                            verbose=False):
+        snapshot = yield from self._get_snapshot_steps()
+        if not snapshot.is_running:
             if verbose:
                 print("\nWriter is not running, nothing to wait().\n")
             return
@@ -1041,7 +1775,7 @@ class PcoWriter(object):
                   "frames".format(nframes))
             print("  (Press Ctrl-C to stop waiting)")
         spinner = itertools.cycle(['-', '/', '|', '\\'])
-        nframes_proc = self.get_written_frames()
+        nframes_proc = snapshot.n_written_frames
         perc_done = nframes_proc * 100.0 / nframes
         msg = ("Processed {} of {} frames ({:.1f}% done)".format(
             nframes_proc, nframes, perc_done))
@@ -1049,9 +1783,13 @@ class PcoWriter(object):
         sys.stdout.flush()
         last_update_time = time.time()
         nframes_old = 0
+        subscriber = self._open_statistics_subscriber()
+        schedule = self.polling_policy.schedule('wait', target=nframes)
         try:
-            while nframes_proc < nframes:
-                nframes_proc = self.get_written_frames()
+            while nframes_proc < nframes and snapshot.is_running:
+                snapshot = yield from self._next_snapshot_steps(
+                    subscriber, schedule.next_interval(snapshot))
+                nframes_proc = snapshot.n_written_frames
                 perc_done = nframes_proc * 100.0 / nframes
                 msg = ("Processed {} of {} frames ({:.1f}% done)".format(
                     nframes_proc, nframes, perc_done))
@@ -1068,16 +1806,18 @@ class PcoWriter(object):
                     print(" *** WARNING: Writer did not receive all requested "
                         "images!")
                     print("     Giving up after {} seconds of inactivity "
-                        "...").format(inactivity_timeout)
+                        "...".format(inactivity_timeout))
                     return(False)
-                time.sleep(0.1)
         except KeyboardInterrupt:
             pass
+        finally:
+            if subscriber is not None:
+                subscriber.close()
 
-        self.status = self.get_status()
+        self.status = yield Call(self.get_status)
 
         if verbose:
-            if not self.is_running():
+            if not snapshot.is_running:
                 print("\nWriter is not running anymore, exiting wait().\n")
             else:
                 print("\nWriter is still running, exiting wait().\n")
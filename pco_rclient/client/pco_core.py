@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Execution core shared by the blocking and the asyncio PCO writer clients.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import time
+
+
+class Call(object):
+    """
+    Step calling a (blocking) function.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class Parallel(object):
+    """
+    Step evaluating to the list of the results of several independent calls.
+
+    The asyncio driver makes the calls concurrently, :func:`execute_step`
+    makes them one after the other. An exception of a call is raised.
+    """
+
+    def __init__(self, *calls):
+        self.calls = calls
+
+
+class Sleep(object):
+    """
+    Step pausing for a number of seconds.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+def execute_step(step):
+    """
+    Execute a single step synchronously and return its value.
+    """
+
+    if isinstance(step, Call):
+        return step()
+    if isinstance(step, Sleep):
+        time.sleep(step.seconds)
+        return None
+    if isinstance(step, Parallel):
+        return [call() for call in step.calls]
+    raise TypeError("Unknown step: {!r}".format(step))
+
+
+def run_steps(steps, execute=execute_step):
+    """
+    Drive a step generator to completion.
+
+    Parameters
+    ----------
+    steps : generator
+        The generator yielding the steps of an operation.
+    execute : callable, optional
+        The function executing a single step and returning its value.
+        (default = :func:`execute_step`)
+
+    Returns
+    -------
+    result : object
+        The return value of the step generator.
+
+    """
+
+    value = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                step = steps.send(value)
+            else:
+                step, error = steps.throw(error), None
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value = execute(step)
+        except BaseException as e:
+            value, error = None, e
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming average of the dark and flat-field runs of the PCO writer.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import os
+import re
+import threading
+
+import numpy as np
+
+from pco_rclient.client.pco_monitor import END_STATUSES
+
+
+# Dataset names of the dark and the flat-field runs.
+DARK_DATASETS = ('data_black', 'data_dark')
+FLAT_DATASETS = ('data_white', 'data_flat')
+
+
+def get_reference_kind(dataset_name):
+    """
+    Return 'dark', 'flat' or None for the dataset name of a run.
+    """
+
+    if dataset_name in DARK_DATASETS:
+        return 'dark'
+    if dataset_name in FLAT_DATASETS:
+        return 'flat'
+    return None
+
+
+def get_reference_path(output_file, dataset_name, directory=None):
+    """
+    Return the default path of the average of a run.
+
+    The output file is written by the server, whereas the average is saved
+    by the client: it is placed in a local directory and named after the
+    output file without its file number placeholder, e.g. the run of
+    "/data/scan_%03d.h5" with the dataset "data_black" is averaged to
+    "scan_data_black.npz".
+
+    Parameters
+    ----------
+    output_file : str
+        The output file of the writer.
+    dataset_name : str
+        The dataset name of the run.
+    directory : str, optional
+        The local directory of the average. If None, the current working
+        directory is used. (default = None)
+
+    Returns
+    -------
+    path : str
+        The path of the average.
+
+    """
+
+    base = re.sub(r'_?%(\d|)+d', '',
+                  os.path.basename(os.path.splitext(output_file)[0]))
+    return os.path.join(directory or os.getcwd(),
+                        "{}_{}.npz".format(base, dataset_name))
+
+
+class FrameAccumulator(object):
+    """
+    Running mean and variance of the frames of a run.
+
+    The sums of the frames and of their squares are accumulated in float64,
+    shifted by the first frame of the run, which keeps the variance
+    numerically stable (the deviations from the first frame are of the order
+    of the noise, not of the signal). The updates are vectorized over the
+    pixels and work in place on preallocated arrays, so the memory used is
+    constant (four float64 frames) whatever the number of frames.
+
+    Register :meth:`process` as a consumer of a :class:`StreamTap`. To
+    average the dark and flat-field runs of a writer automatically,
+    :meth:`attach` the accumulator to the statistics monitor of the writer
+    (and to the tap).
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialize the accumulator.
+
+        Parameters
+        ----------
+        path : str, optional
+            The path of the .npz files written at the end of the runs of an
+            attached monitor. If None, the files are written to the current
+            working directory and named after the output file and dataset
+            name of the run, see :func:`get_reference_path`. The run number
+            is appended to the path, e.g. "dark_003.npz" for "dark.npz", so
+            every run has its own file. (default = None)
+
+        """
+
+        self.path = path
+        self.monitor = None
+        self.n_frames = 0
+        self.shape = None
+        self._shift = None
+        self._sum = None
+        self._sum_squares = None
+        self._work = None
+        self._run = None
+        self._lock = threading.Lock()
+
+    def _get_run_path(self):
+        """
+        Return the path of the average of the current run.
+        """
+
+        if self._run is None and self.monitor is None:
+            return self.path
+        if self._run is not None:
+            output_file, dataset_name, run_id = self._run
+        else:
+            writer = self.monitor.writer
+            output_file, dataset_name, run_id = (
+                writer.output_file, writer.dataset_name, writer.last_run_id)
+        path = self.path
+        if path is None:
+            path = get_reference_path(output_file, dataset_name)
+        base, ext = os.path.splitext(path)
+        return "{}_{:03d}{}".format(base, run_id, ext or '.npz')
+
+    def _on_status_change(self, monitor, datasets, snapshot, previous_status):
+        """
+        Note the run when it starts, save and restart the average at its end.
+        """
+
+        if snapshot.is_running and self._run is None:
+            # the run of the writer's configuration at its start, which may
+            # be changed for the next run before the end is handled
+            writer = monitor.writer
+            self._run = (writer.output_file, writer.dataset_name,
+                         writer.last_run_id)
+        elif self._run is not None and snapshot.status in END_STATUSES:
+            if ((datasets is None or self._run[1] in datasets) and
+                    self.n_frames):
+                self.save(self._get_run_path())
+            self._run = None
+            self.reset()
+
+    def attach(self, monitor, tap=None,
+               datasets=DARK_DATASETS + FLAT_DATASETS):
+        """
+        Average the runs followed by a statistics monitor.
+
+        The frames are accumulated from the moment the accumulator receives
+        the stream, so the first frames of a run are included even if they
+        arrive before the monitor reports the run. When the writer reports
+        the end of a run, its average is saved to a file of its own (see
+        the `path` of the accumulator) and the accumulator is reset for the
+        next run.
+
+        Parameters
+        ----------
+        monitor : StatisticsMonitor
+            The monitor of the writer, see :meth:`PcoWriter.monitor`.
+        tap : StreamTap, optional
+            The tap of the camera stream, :meth:`process` is registered as
+            its consumer. (default = None, registered by the caller)
+        datasets : tuple of str or None, optional
+            Only the runs writing to one of these datasets are saved. None
+            to save all runs. (default = the dark and flat datasets)
+
+        Raises
+        ------
+        ValueError
+            If the directory of the `path` of the accumulator does not exist
+            or is not writable.
+
+        """
+
+        if self.path is None:
+            directory = os.getcwd()
+        else:
+            directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory) or not os.access(directory, os.W_OK):
+            raise ValueError("The averages cannot be saved to {}: the "
+                             "directory does not exist or is not "
+                             "writable.".format(self.path or directory))
+        self.reset()
+        self._run = None
+        self.monitor = monitor
+        monitor.on_status_change(
+            lambda snapshot, previous_status: self._on_status_change(
+                monitor, datasets, snapshot, previous_status))
+        if tap is not None:
+            tap.add_callback(self.process)
+
+    def get_mean(self):
+        """
+        Return a copy of the mean frame, or None if no frame was received.
+        """
+
+        with self._lock:
+            if not self.n_frames:
+                return None
+            return self._shift + self._sum / self.n_frames
+
+    def get_variance(self, ddof=1):
+        """
+        Return the variance of every pixel.
+
+        Parameters
+        ----------
+        ddof : int, optional
+            The delta degrees of freedom, 1 for the sample variance.
+            (default = 1)
+
+        Returns
+        -------
+        variance : numpy.ndarray or None
+            The variance, or None if not enough frames were received.
+
+        """
+
+        with self._lock:
+            if self.n_frames <= ddof:
+                return None
+            variance = self._sum * self._sum
+            variance /= -self.n_frames
+            variance += self._sum_squares
+            variance /= self.n_frames - ddof
+            return np.maximum(variance, 0.0, out=variance)
+
+    def process(self, header, image):
+        """
+        Add a frame to the average.
+
+        Parameters
+        ----------
+        header : dict
+            The header of the frame.
+        image : numpy.ndarray
+            The image of the frame.
+
+        """
+
+        with self._lock:
+            if not self.n_frames:
+                if self.shape != image.shape:
+                    self.shape = image.shape
+                    self._shift = np.empty(image.shape, dtype=np.float64)
+                    self._sum = np.zeros(image.shape, dtype=np.float64)
+                    self._sum_squares = np.zeros(image.shape,
+                                                 dtype=np.float64)
+                    self._work = np.empty(image.shape, dtype=np.float64)
+                self._shift[...] = image
+            elif self.shape != image.shape:
+                raise ValueError(
+                    "Frame shape {} does not match the average {}".format(
+                        image.shape, self.shape))
+            work = self._work
+            np.subtract(image, self._shift, out=work)
+            self._sum += work
+            work *= work
+            self._sum_squares += work
+            self.n_frames += 1
+
+    def reset(self):
+        """
+        Discard the frames received so far.
+        """
+
+        with self._lock:
+            self.n_frames = 0
+            if self._sum is not None:
+                self._sum.fill(0.0)
+                self._sum_squares.fill(0.0)
+
+    def save(self, path=None):
+        """
+        Save the average to a .npz file.
+
+        The file holds the arrays "mean" and "variance" (float32) and the
+        number of frames "n_frames".
+
+        Parameters
+        ----------
+        path : str, optional
+            The path of the file. If None, the path of the current run of
+            the attached monitor's writer is used, see the `path` of the
+            accumulator, or that `path` itself if the accumulator is not
+            attached. (default = None)
+
+        Returns
+        -------
+        path : str
+            The path of the file written.
+
+        Raises
+        ------
+        ValueError
+            If no frame was received, or there is no path.
+
+        """
+
+        if not self.n_frames:
+            raise ValueError("No frame to average")
+        if path is None:
+            path = self._get_run_path()
+        if path is None:
+            raise ValueError("No path to save the average to")
+        mean = self.get_mean()
+        variance = self.get_variance()
+        if variance is None:
+            variance = np.zeros_like(mean)
+        np.savez(path, mean=mean.astype(np.float32),
+                 variance=variance.astype(np.float32),
+                 n_frames=self.n_frames)
+        return path
@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+"""
+Local emulator of the PCO writer servers.
+
+Usage::
+
+    python -m pco_rclient.client.pco_emulator [--fps 100] [--latency 0.001]
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import argparse
+import collections
+import json
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import zmq
+
+from pco_rclient.client.pco_client import ROUTES
+from pco_rclient.client.pco_stream import StreamGenerator
+
+
+# Routes served by the flask server and by the writer server.
+FLASK_ROUTES = ('start_pco', 'status', 'server_log', 'server_uptime', 'ack',
+                'finished')
+WRITER_ROUTES = ('statistics', 'stop', 'kill')
+
+# Keys required in the configuration posted to /start_pco_writer.
+CONFIGURATION_KEYS = ('connection_address', 'output_file', 'n_frames',
+                      'user_id', 'dataset_name', 'max_frames_per_file')
+
+# Failure modes, see WriterEmulator.inject_failure().
+FAILURE_MODES = ('drop', 'error', 'timeout')
+
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    """
+    Dispatch the requests to the routes of the emulator.
+    """
+
+    # HTTP/1.1 is required for the client to keep the connection alive
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid Nagle/delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def _handle(self, method):
+        emulator = self.server.emulator
+        route = self.server.routes.get(self.path.split('?')[0])
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        body = self.rfile.read(length) if length else b''
+        if route is None:
+            self._reply(404, {"success": False,
+                              "value": "Unknown route {}".format(self.path)})
+            return
+        result = emulator.handle(method, route, body)
+        if result is None:
+            # the connection is dropped, e.g. the writer is not running
+            self.close_connection = True
+            return
+        self._reply(*result)
+
+    def _reply(self, code, response):
+        body = json.dumps(response).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting, e.g. an injected timeout
+            self.close_connection = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, *args):
+        pass
+
+
+class EmulatorServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server serving a subset of the ROUTES of the emulator.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, emulator, routes, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), EmulatorHandler)
+        self.emulator = emulator
+        self.routes = {ROUTES[route]: route for route in routes}
+
+    @property
+    def address(self):
+        return "http://{}:{}".format(*self.server_address)
+
+
+class WriterEmulator(object):
+    """
+    Emulator of the flask and writer servers of the PCO writer service.
+
+    A run started by a POST to /start_pco_writer goes through the states
+    "starting" (for `start_delay` seconds), "receiving" (while frames arrive
+    at `frame_rate`) and "writing" (while the frames received are still being
+    written at `write_rate`), and ends as "finished", or "killed" after a
+    /kill request. A /stop request ends the reception of frames; the writer
+    finishes after writing the frames received and `stop_delay` seconds.
+
+    The writer api only answers while a run is in progress. Otherwise, as
+    the writer process of the real service, it is not reachable and the
+    connection is dropped.
+
+    Every response is delayed by `latency` seconds. Failures can be injected
+    randomly with `failure_rate` or for the next requests of a route with
+    :meth:`inject_failure`.
+    """
+
+    def __init__(self, host='127.0.0.1', flask_port=0, writer_port=0,
+                 frame_rate=100.0, write_rate=None, start_delay=0.1,
+                 stop_delay=0.05, latency=0.0, failure_rate=0.0,
+                 failure_mode='drop', timeout_delay=5.0,
+                 statistics_port=None, statistics_interval=0.1,
+                 stream_address=None, frame_shape=(64, 64),
+                 frame_dtype='uint16', receiving_status='receiving',
+                 seed=None):
+        """
+        Initialize the emulator. Call :meth:`start` to serve requests.
+
+        Parameters
+        ----------
+        host : str, optional
+            The host to bind the servers to. (default = '127.0.0.1')
+        flask_port, writer_port : int, optional
+            The ports of the flask and the writer api. 0 selects a free port.
+            (default = 0)
+        frame_rate : float, optional
+            The rate [frames/s] at which frames are received. (default = 100)
+        write_rate : float, optional
+            The rate [frames/s] at which frames are written. If None, frames
+            are written as fast as they are received. (default = None)
+        start_delay : float, optional
+            The time [s] between the start request and the first frame.
+            (default = 0.1)
+        stop_delay : float, optional
+            The time [s] the writer takes to finish after the last frame has
+            been written. (default = 0.05)
+        latency : float, optional
+            The time [s] by which each response is delayed. (default = 0.0)
+        failure_rate : float, optional
+            The probability that a request fails with `failure_mode`.
+            (default = 0.0)
+        failure_mode : str, optional
+            The mode of the random failures, see :meth:`inject_failure`.
+            (default = 'drop')
+        timeout_delay : float, optional
+            The time [s] a request failing in the 'timeout' mode is delayed.
+            (default = 5.0)
+        statistics_port : int, optional
+            If set, the statistics of a running writer are published on a ZMQ
+            PUB socket bound to this port (0 selects a free port), the same
+            way as the statistics monitor of the writer, and once more when
+            the run has ended. (default = None)
+        statistics_interval : float, optional
+            The interval [s] between two published statistics.
+            (default = 0.1)
+        stream_address : str, optional
+            If set, a PUSH socket is bound to this address and the frames of
+            each run are pushed as header/data message pairs, like the camera
+            stream the writer receives from its `connection_address`.
+            (default = None)
+        frame_shape : tuple of int, optional
+            The shape of the pushed frames. (default = (64, 64))
+        frame_dtype : str, optional
+            The data type of the pushed frames. (default = 'uint16')
+        receiving_status : str, optional
+            The status reported while frames arrive. Writer versions writing
+            while they receive report 'writing'. (default = 'receiving')
+        seed : int, optional
+            The seed of the random failures. (default = None)
+
+        """
+
+        self.frame_rate = float(frame_rate)
+        self.write_rate = float(write_rate or frame_rate)
+        self.start_delay = start_delay
+        self.stop_delay = stop_delay
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.timeout_delay = timeout_delay
+        self.statistics_interval = statistics_interval
+        self.stream_address = stream_address
+        self.receiving_status = receiving_status
+
+        self.request_counts = collections.Counter()
+        self.log = collections.deque(maxlen=100)
+        self._random = random.Random(seed)
+        self._failures = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self._run = None
+        self._last_statistics = None
+        self._t_started = time.time()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.flask_server = EmulatorServer(self, FLASK_ROUTES, host,
+                                           flask_port)
+        self.writer_server = EmulatorServer(self, WRITER_ROUTES, host,
+                                            writer_port)
+        self._server_threads = []
+
+        self._context = None
+        self._statistics_socket = None
+        self.statistics_monitor_address = None
+        self.stream = None
+        if statistics_port is not None or stream_address:
+            self._context = zmq.Context()
+        if statistics_port is not None:
+            self._statistics_socket = self._context.socket(zmq.PUB)
+            self._statistics_socket.setsockopt(zmq.LINGER, 0)
+            address = "tcp://{}".format(host)
+            if statistics_port:
+                self._statistics_socket.bind(
+                    "{}:{}".format(address, statistics_port))
+            else:
+                statistics_port = \
+                    self._statistics_socket.bind_to_random_port(address)
+            self.statistics_monitor_address = "{}:{}".format(address,
+                                                             statistics_port)
+        if stream_address:
+            # the camera drops the frames nobody receives
+            self.stream = StreamGenerator(
+                stream_address, frame_shape=frame_shape,
+                frame_dtype=frame_dtype, block=False, context=self._context,
+                seed=seed)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _get_statistics(self, now):
+        """
+        Return the statistics of the current run at time `now`.
+        """
+
+        run = self._run
+        t_receive = now - run['t_started'] - self.start_delay
+        if run['t_stopped'] is not None:
+            t_receive = min(t_receive, run['t_stopped'] - run['t_started'] -
+                            self.start_delay)
+        n_received = int(max(t_receive, 0) * self.frame_rate)
+        if run['n_frames'] > 0:
+            n_received = min(n_received, run['n_frames'])
+        n_written = min(n_received, int(max(now - run['t_started'] -
+                                            self.start_delay, 0) *
+                                        self.write_rate))
+
+        receiving = run['t_stopped'] is None and (
+            run['n_frames'] <= 0 or n_received < run['n_frames'])
+        if run['status'] == 'killed':
+            status = 'killed'
+        elif t_receive < 0 and receiving:
+            status = 'starting'
+        elif receiving:
+            status = self.receiving_status
+        elif n_written < n_received:
+            status = 'writing'
+        else:
+            if run['t_done'] is None:
+                run['t_done'] = now
+            if now - run['t_done'] < self.stop_delay:
+                status = 'writing'
+            else:
+                status = 'finished'
+
+        elapsed = max(now - run['t_started'] - self.start_delay, 1e-9)
+        return {
+            "status": status,
+            "n_frames": run['n_frames'],
+            "n_received_frames": n_received,
+            "n_written_frames": n_written,
+            "n_lost_frames": 0,
+            "receiving_rate": self.frame_rate if receiving else 0,
+            "writing_rate": (self.write_rate
+                             if status in ('receiving', 'writing') else 0),
+            "avg_receiving_rate": n_received / elapsed,
+            "avg_writing_rate": n_written / elapsed,
+            "output_file": run['output_file'],
+            "dataset_name": run['dataset_name'],
+            "start_time": run['t_started'],
+            "end_time": None,
+        }
+
+    def _log(self, message):
+        self.log.append("{} {}".format(
+            time.strftime("%Y-%m-%d %H:%M:%S"), message))
+
+    def _publish(self):
+        """
+        Publish the statistics and push the frames of the current run.
+
+        The statistics are published while the run receives or writes, and
+        once more with the end status when the run is over.
+        """
+
+        n_pushed = 0
+        t_published = 0.0
+        running = False
+        while not self._stopping.wait(0.005):
+            stats = self.get_statistics()
+            if stats is None or stats['status'] not in ('receiving',
+                                                         'writing'):
+                if (running and stats is not None and
+                        self._statistics_socket is not None):
+                    self._statistics_socket.send_json(stats)
+                running = False
+                n_pushed = 0
+                continue
+            running = True
+            if self.stream is not None:
+                while n_pushed < stats['n_received_frames']:
+                    self.stream.send_frame(n_pushed)
+                    n_pushed += 1
+            now = time.time()
+            if (self._statistics_socket is not None and
+                    now - t_published >= self.statistics_interval):
+                self._statistics_socket.send_json(stats)
+                t_published = now
+
+    def _route_ack(self, method, body):
+        return 200, {"success": True}
+
+    def _route_finished(self, method, body):
+        stats = self._last_statistics
+        if stats is None:
+            return 200, {"success": True, "status": "unknown"}
+        response = dict(stats, success=True)
+        return 200, response
+
+    def _route_kill(self, method, body):
+        with self._lock:
+            if self._run is None:
+                return None
+            self._run['status'] = 'killed'
+        self.get_statistics()
+        return 200, {"success": True, "status": "killed"}
+
+    def _route_server_log(self, method, body):
+        return 200, {"success": True, "log": "\n".join(list(self.log)[-10:])}
+
+    def _route_server_uptime(self, method, body):
+        uptime = int(time.time() - self._t_started)
+        return 200, {"success": True, "uptime": "{:d}:{:02d}:{:02d}".format(
+            uptime // 3600, uptime // 60 % 60, uptime % 60)}
+
+    def _route_start_pco(self, method, body):
+        if method != 'POST':
+            return 405, {"success": False, "value": "POST required"}
+        try:
+            config = json.loads(body.decode())
+            missing = [key for key in CONFIGURATION_KEYS if key not in config]
+            if missing:
+                raise ValueError("Missing configuration: {}".format(
+                    ", ".join(missing)))
+            n_frames = int(config['n_frames'])
+        except ValueError as e:
+            return 200, {"success": False, "value": str(e)}
+        if self.get_statistics() is not None:
+            return 200, {"success": False, "value": "Writer already running"}
+        with self._lock:
+            self._run = {"t_started": time.time(), "t_stopped": None,
+                         "t_done": None, "status": None,
+                         "n_frames": n_frames,
+                         "output_file": config['output_file'],
+                         "dataset_name": config['dataset_name']}
+            self._log("Writer process started: {} frames to {}.".format(
+                n_frames, config['output_file']))
+        return 200, {"success": True, "value": "Writer started"}
+
+    def _route_statistics(self, method, body):
+        stats = self.get_statistics()
+        if stats is None:
+            return None
+        return 200, dict(stats, success=True)
+
+    def _route_status(self, method, body):
+        return 200, {"success": True, "status": self.get_status()}
+
+    def _route_stop(self, method, body):
+        with self._lock:
+            if self._run is None:
+                return None
+            if self._run['t_stopped'] is None:
+                self._run['t_stopped'] = time.time()
+        self._log("Writer process stopped.")
+        return 200, {"success": True, "value": "Writer stopping"}
+
+    @property
+    def flask_api_address(self):
+        return self.flask_server.address
+
+    def get_statistics(self):
+        """
+        Return the statistics of the current run, or None if not running.
+        """
+
+        with self._lock:
+            if self._run is None:
+                return None
+            stats = self._get_statistics(time.time())
+            if stats['status'] in ('finished', 'killed'):
+                stats['end_time'] = time.time()
+                self._last_statistics = stats
+                self._run = None
+                self._log("Writer process {}: {} frames written.".format(
+                    stats['status'], stats['n_written_frames']))
+            return stats
+
+    def get_status(self):
+        """
+        Return the status of the writer, like the /status route.
+        """
+
+        stats = self.get_statistics()
+        if stats is not None:
+            return stats['status']
+        if self._last_statistics is not None:
+            return self._last_statistics['status']
+        return 'unknown'
+
+    def handle(self, method, route, body):
+        """
+        Answer a request.
+
+        Parameters
+        ----------
+        method : str
+            The HTTP method.
+        route : str
+            The name of the route, see ROUTES.
+        body : bytes
+            The body of the request.
+
+        Returns
+        -------
+        result : tuple or None
+            The HTTP status code and the response, or None if the connection
+            is to be dropped.
+
+        """
+
+        with self._lock:
+            self.request_counts[route] += 1
+            failure = None
+            if self._failures[route]:
+                failure = self._failures[route].popleft()
+            elif self.failure_rate and \
+                    self._random.random() < self.failure_rate:
+                failure = self.failure_mode
+        if self.latency:
+            time.sleep(self.latency)
+        if failure == 'drop':
+            return None
+        if failure == 'error':
+            return 500, {"success": False, "value": "Injected failure"}
+        if failure == 'timeout':
+            time.sleep(self.timeout_delay)
+        return getattr(self, '_route_' + route)(method, body)
+
+    def inject_failure(self, route, mode='drop', count=1):
+        """
+        Let the next requests of a route fail.
+
+        Parameters
+        ----------
+        route : str
+            The name of the route, see ROUTES.
+        mode : str, optional
+            How the requests fail:
+
+            * 'drop': the connection is closed without a response,
+            * 'error': the server answers with HTTP 500 and
+              ``{"success": false}``,
+            * 'timeout': the response is delayed by `timeout_delay`.
+
+            (default = 'drop')
+        count : int, optional
+            The number of failing requests. (default = 1)
+
+        """
+
+        if route not in ROUTES:
+            raise ValueError("Unknown route: {}".format(route))
+        if mode not in FAILURE_MODES:
+            raise ValueError("Unknown failure mode: {}".format(mode))
+        with self._lock:
+            self._failures[route].extend([mode] * count)
+
+    def start(self):
+        """
+        Start serving requests in background threads.
+
+        Returns
+        -------
+        emulator : WriterEmulator
+            The emulator itself.
+
+        """
+
+        for server in (self.flask_server, self.writer_server):
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._server_threads.append(thread)
+        if self._context is not None:
+            self._thread = threading.Thread(target=self._publish)
+            self._thread.daemon = True
+            self._thread.start()
+        self._log("Emulator started.")
+        return self
+
+    def stop(self):
+        """
+        Stop serving requests and release the sockets.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        for server in (self.flask_server, self.writer_server):
+            server.shutdown()
+            server.server_close()
+        if self._context is not None:
+            self._context.destroy(linger=0)
+
+    @property
+    def writer_api_address(self):
+        return self.writer_server.address
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Emulate the PCO writer servers locally.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--flask-port', type=int, default=9901)
+    parser.add_argument('--writer-port', type=int, default=9555)
+    parser.add_argument('--fps', type=float, default=100.0,
+                        help="frame rate of the emulated runs")
+    parser.add_argument('--write-fps', type=float, default=None,
+                        help="writing rate (default: the frame rate)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="response delay [s]")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help="probability that a request fails")
+    parser.add_argument('--failure-mode', choices=FAILURE_MODES,
+                        default='drop')
+    parser.add_argument('--statistics-port', type=int, default=None,
+                        help="publish the statistics on this ZMQ port")
+    parser.add_argument('--stream-address', default=None,
+                        help="push the camera stream to this ZMQ address")
+    arguments = parser.parse_args()
+
+    emulator = WriterEmulator(
+        host=arguments.host, flask_port=arguments.flask_port,
+        writer_port=arguments.writer_port, frame_rate=arguments.fps,
+        write_rate=arguments.write_fps, latency=arguments.latency,
+        failure_rate=arguments.failure_rate,
+        failure_mode=arguments.failure_mode,
+        statistics_port=arguments.statistics_port,
+        stream_address=arguments.stream_address).start()
+    print("PCO writer emulator running (Ctrl-C to stop):")
+    print("  flask_api_address:  {}".format(emulator.flask_api_address))
+    print("  writer_api_address: {}".format(emulator.writer_api_address))
+    if emulator.statistics_monitor_address:
+        print("  statistics_monitor_address: {}".format(
+            emulator.statistics_monitor_address))
+    if emulator.stream_address:
+        print("  connection_address: {}".format(emulator.stream_address))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,963 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the PCO writer client against the local writer emulator.
+"""
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+import requests
+import zmq
+
+from pco_rclient.client.pco_async import AsyncPcoWriter
+from pco_rclient.client.pco_client import PcoError, PcoWriter
+from pco_rclient.client.pco_capture import (Capture, CaptureRecorder,
+                                            CaptureReplayer)
+from pco_rclient.client.pco_darkflat import (FrameAccumulator,
+                                             get_reference_path)
+from pco_rclient.client.pco_emulator import WriterEmulator
+from pco_rclient.client.pco_group import PcoWriterGroup
+from pco_rclient.client.pco_history import StatisticsHistory
+from pco_rclient.client.pco_monitor import WriterSnapshot, _Milestone
+from pco_rclient.client.pco_polling import AdaptivePolling
+from pco_rclient.client.pco_preview import (PreviewPublisher,
+                                            PreviewSubscriber, bin_image)
+from pco_rclient.client.pco_queue import AcquisitionQueue
+from pco_rclient.client.pco_session import CircuitOpenError, PcoSession
+from pco_rclient.client.pco_shm import SharedFrameReader, SharedStreamReceiver
+from pco_rclient.client.pco_stream import (StreamDrain, StreamGenerator,
+                                           make_header)
+from pco_rclient.client.pco_tap import StreamTap
+
+
+def get_free_address():
+    """
+    Return a local tcp address with a free port.
+    """
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "tcp://127.0.0.1:{}".format(port)
+
+
+def wait_for(condition, timeout=5.0):
+    """
+    Wait until `condition()` is true, return its last value.
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+class EmulatorTestCase(unittest.TestCase):
+    """
+    Base class of the tests talking to a :class:`WriterEmulator`.
+    """
+
+    emulator_kwargs = {}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.emulators = []
+        self.writers = []
+        self.emulator = self.create_emulator()
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.close()
+        for emulator in self.emulators:
+            emulator.stop()
+        shutil.rmtree(self.directory)
+
+    def create_emulator(self, **kwargs):
+        config = dict(frame_rate=1000, start_delay=0.02, stop_delay=0.01)
+        config.update(self.emulator_kwargs)
+        config.update(kwargs)
+        emulator = WriterEmulator(**config).start()
+        self.emulators.append(emulator)
+        return emulator
+
+    def create_writer(self, emulator=None, **kwargs):
+        emulator = emulator or self.emulator
+        config = dict(
+            output_file=os.path.join(self.directory, 'test.h5'),
+            dataset_name='data', n_frames=100,
+            connection_address=(emulator.stream_address or
+                                'tcp://127.0.0.1:8080'),
+            flask_api_address=emulator.flask_api_address,
+            writer_api_address=emulator.writer_api_address)
+        config.update(kwargs)
+        writer = PcoWriter(**config)
+        self.writers.append(writer)
+        return writer
+
+
+class TestWriterLifecycle(EmulatorTestCase):
+
+    def test_get_snapshot(self):
+        writer = self.create_writer(n_frames=0)
+        writer.start()
+        self.emulator.request_counts.clear()
+        snapshot = writer.get_snapshot()
+        self.assertTrue(snapshot.is_running)
+        # the statistics of the running writer hold its status
+        self.assertEqual(dict(self.emulator.request_counts),
+                         {'statistics': 1})
+        writer.stop()
+
+    def test_kill(self):
+        writer = self.create_writer(n_frames=0)
+        writer.start()
+        response = writer.kill()
+        self.assertTrue(response['success'])
+        self.assertFalse(writer.is_running())
+        self.assertEqual(writer.get_status_last_run(), 'killed')
+
+    def test_lazy_connect(self):
+        running = self.create_writer(n_frames=0)
+        running.start()
+        self.emulator.request_counts.clear()
+        writer = self.create_writer(connect='lazy')
+        self.assertEqual(sum(self.emulator.request_counts.values()), 0)
+        writer.connect()
+        # the checks found the running writer and reset the configuration
+        self.assertTrue(writer._connected)
+        self.assertEqual(writer.status, 'unconfigured')
+        running.stop()
+
+    def test_record_statistics(self):
+        path = os.path.join(self.directory, 'stats.npy')
+        writer = self.create_writer(n_frames=200, record_statistics=path)
+        for _ in range(2):
+            writer.start()
+            writer.wait()
+        writer.close()
+        # every run has its own recording
+        for name in ('stats_001.npy', 'stats_002.npy'):
+            self.assertTrue(os.path.exists(
+                os.path.join(self.directory, name)))
+
+    def test_record_statistics_failure(self):
+        path = os.path.join(self.directory, 'missing', 'stats.npy')
+        writer = self.create_writer(n_frames=200, record_statistics=path)
+        with self.assertRaises(PcoError):
+            writer.start()
+        self.assertFalse(writer.is_running())
+        # a directory removed during the run stops the recording
+        os.mkdir(os.path.dirname(path))
+        writer.start()
+        shutil.rmtree(os.path.dirname(path))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            writer.wait()
+        self.assertEqual(writer.get_status(), 'finished')
+        self.assertIsNone(writer.recorder)
+        self.assertIn("Recording the statistics", output.getvalue())
+
+    def test_start_wait(self):
+        writer = self.create_writer(n_frames=200)
+        response = writer.start()
+        self.assertTrue(response['success'])
+        writer.wait()
+        self.assertFalse(writer.is_running())
+        self.assertEqual(writer.get_status(), 'finished')
+        self.assertEqual(writer.get_statistics()['n_written_frames'], 200)
+
+    def test_stop(self):
+        writer = self.create_writer(n_frames=0)
+        writer.start()
+        time.sleep(0.05)
+        response = writer.stop()
+        self.assertTrue(response['success'])
+        self.assertFalse(writer.is_running())
+        self.assertGreater(writer.get_statistics()['n_written_frames'], 0)
+
+    def test_wait_nframes(self):
+        writer = self.create_writer(n_frames=1000)
+        writer.start()
+        writer.wait_nframes(100)
+        self.assertGreaterEqual(writer.get_written_frames(), 100)
+        self.assertTrue(writer.is_running())
+        writer.stop()
+
+
+class TestAsyncWriter(EmulatorTestCase):
+
+    emulator_kwargs = {'timeout_delay': 0.4}
+
+    def run_until_complete(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_parallel_requests(self):
+        writer = self.create_writer()
+        async_writer = AsyncPcoWriter(writer)
+        # without a running writer, the status and the statistics of the
+        # last run are independent requests
+        self.emulator.inject_failure('status', 'timeout')
+        self.emulator.inject_failure('finished', 'timeout')
+        t_start = time.monotonic()
+        snapshot = self.run_until_complete(async_writer.get_snapshot())
+        elapsed = time.monotonic() - t_start
+        self.assertFalse(snapshot.is_running)
+        self.assertLess(elapsed, 0.7)
+
+    def test_statistics_fallback(self):
+        writer = self.create_writer(n_frames=0)
+        async_writer = AsyncPcoWriter(writer)
+        writer.start()
+        self.emulator.request_counts.clear()
+        statistics = self.run_until_complete(async_writer.get_statistics())
+        self.assertIn(statistics['status'], ('receiving', 'writing'))
+        # the last run is only asked for if the running writer has no answer
+        self.assertEqual(self.emulator.request_counts['finished'], 0)
+        writer.stop()
+
+
+class TestSession(EmulatorTestCase):
+
+    def count_connections(self, session, address):
+        adapter = session.get_session(address).get_adapter(address)
+        pools = adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def test_one_session_per_address(self):
+        session = PcoSession()
+        flask_address = self.emulator.flask_api_address
+        self.assertIs(session.get_session(flask_address),
+                      session.get_session(flask_address + '/'))
+        self.assertIsNot(session.get_session(flask_address),
+                         session.get_session(
+                             self.emulator.writer_api_address))
+        session.close()
+
+    def test_pooled_connection(self):
+        session = PcoSession()
+        address = self.emulator.flask_api_address
+        for _ in range(5):
+            session.get(address, '/status', route='status')
+        # the requests reused the connection of the first one
+        self.assertEqual(self.count_connections(session, address), 1)
+        session.close()
+
+    def test_shared_session(self):
+        session = PcoSession()
+        address = self.emulator.flask_api_address
+        writer = self.create_writer(session=session)
+        n_connections = self.count_connections(session, address)
+        # a second writer on the same servers reuses the open connections
+        other = self.create_writer(session=session)
+        other.get_status_writer()
+        self.assertEqual(self.count_connections(session, address),
+                         n_connections)
+        # the writers leave the shared session open
+        writer.close()
+        other.get_status_writer()
+        session.close()
+
+
+class TestFailureInjection(EmulatorTestCase):
+
+    emulator_kwargs = {'timeout_delay': 0.5}
+
+    def test_circuit_breaker(self):
+        session = PcoSession(route_timeouts={'status': 0.1},
+                             adaptive_timeouts=False, failure_threshold=2,
+                             reset_timeout=60)
+        self.emulator.inject_failure('status', 'timeout', count=2)
+        for _ in range(2):
+            with self.assertRaises(requests.Timeout):
+                session.get(self.emulator.flask_api_address, '/status',
+                            route='status')
+        with self.assertRaises(CircuitOpenError):
+            session.get(self.emulator.flask_api_address, '/status',
+                        route='status')
+        self.assertEqual(self.emulator.request_counts['status'], 2)
+        session.close()
+
+    def test_fixed_timeouts(self):
+        session = PcoSession(min_timeout=0.05)
+        address = self.emulator.flask_api_address
+        # a slow answer to a state-changing request, or while the writer is
+        # busy, is waited for
+        for route in ('statistics', 'status', 'stop'):
+            for _ in range(5):
+                session.get(address, '/status', route=route)
+            self.emulator.inject_failure('status', 'timeout')
+            response = session.get(address, '/status', route=route)
+            self.assertEqual(response.status_code, 200)
+        session.close()
+
+    def test_refused_probe(self):
+        address = get_free_address().replace('tcp://', 'http://')
+        session = PcoSession(failure_threshold=1, reset_timeout=0.05)
+        breaker = session.get_breaker(address)
+        # refused connections leave a closed circuit closed
+        with self.assertRaises(requests.ConnectionError):
+            session.get(address, '/status', route='status')
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        time.sleep(0.1)
+        # the probe is refused: the circuit opens again
+        with self.assertRaises(requests.ConnectionError) as context:
+            session.get(address, '/status', route='status')
+        self.assertNotIsInstance(context.exception, CircuitOpenError)
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.get_info()['reset_timeout'], 0.1)
+        with self.assertRaises(CircuitOpenError):
+            session.get(address, '/status', route='status')
+        session.close()
+
+    def test_dropped_ack(self):
+        writer = self.create_writer()
+        self.emulator.inject_failure('ack', 'drop')
+        self.assertFalse(writer.is_connected())
+        self.assertTrue(writer.is_connected())
+
+    def test_dropped_statistics(self):
+        writer = self.create_writer(n_frames=0)
+        writer.start()
+        self.emulator.inject_failure('statistics', 'drop')
+        self.assertIsNone(writer.get_statistics_writer())
+        self.assertIsNotNone(writer.get_statistics_writer())
+        writer.stop()
+
+    def test_dropped_statistics_wait(self):
+        writer = self.create_writer(n_frames=50)
+        writer.start()
+        writer.wait()
+        writer.configure(n_frames=500)
+        writer.start()
+        # the statistics of the last run must not end the wait
+        self.emulator.inject_failure('statistics', 'drop', count=3)
+        writer.wait()
+        self.assertEqual(writer.get_status(), 'finished')
+        self.assertEqual(writer.get_statistics()['n_written_frames'], 500)
+
+
+class TestResponseCache(EmulatorTestCase):
+
+    def test_cached_status(self):
+        writer = self.create_writer(cache_ttl=1.0)
+        writer.cache.invalidate()
+        self.emulator.request_counts.clear()
+        writer.get_status_writer()
+        writer.get_status_writer()
+        self.assertEqual(self.emulator.request_counts['status'], 1)
+        # starting the writer invalidates the cache
+        writer.start()
+        self.assertTrue(writer.is_running())
+        writer.stop()
+
+    def test_reset(self):
+        writer = self.create_writer(cache_ttl=10.0)
+        writer.get_status_writer()
+        self.emulator.request_counts.clear()
+        writer.reset()
+        writer.get_status_writer()
+        self.assertEqual(self.emulator.request_counts['status'], 1)
+
+
+class TestMonitor(EmulatorTestCase):
+
+    def test_milestones(self):
+        writer = self.create_writer(n_frames=300)
+        monitor = writer.monitor(interval=0.01)
+        statuses = []
+        monitor.on_status_change(
+            lambda snapshot, previous: statuses.append(snapshot.status))
+        futures = writer.milestones([100, 200], interval=0.01)
+        writer.start()
+        for future in futures:
+            snapshot = future.result(timeout=5)
+            self.assertGreaterEqual(snapshot.n_written_frames, 100)
+        writer.wait()
+        self.assertTrue(wait_for(lambda: 'finished' in statuses))
+        self.assertIn('receiving', statuses)
+
+
+    def test_failed_polls(self):
+        writer = self.create_writer(n_frames=300)
+        monitor = writer.monitor(interval=0.01)
+        statuses = []
+        running = []
+
+        def on_update(snapshot):
+            if snapshot.is_running:
+                running.append(snapshot)
+
+        monitor.on_status_change(
+            lambda snapshot, previous: statuses.append(snapshot.status))
+        monitor.on_update(on_update)
+        writer.start()
+        self.emulator.inject_failure('statistics', 'drop', count=3)
+        self.emulator.inject_failure('status', 'drop', count=3)
+        writer.wait()
+        self.assertTrue(wait_for(lambda: 'finished' in statuses))
+        # the failed polls are skipped
+        self.assertEqual(statuses[statuses.index('receiving'):],
+                         ['receiving', 'writing', 'finished'])
+        # every snapshot of the run is recorded once
+        self.assertEqual(len(writer.history), len(running))
+
+
+    def test_milestone_end_status(self):
+        milestone = _Milestone(100, 'n_written_frames')
+        self.assertIsNone(milestone.update(WriterSnapshot(
+            'receiving', {'n_written_frames': 10})))
+        # only a reported end of the run misses the milestone
+        self.assertIsNone(milestone.update(WriterSnapshot('unknown')))
+        self.assertFalse(milestone.update(WriterSnapshot(
+            'killed', {'n_written_frames': 50})))
+
+
+class TestStatisticsFeed(EmulatorTestCase):
+
+    emulator_kwargs = {'statistics_port': 0}
+
+    def test_wait_latency(self):
+        writer = self.create_writer(
+            n_frames=200, statistics_monitor_address=(
+                self.emulator.statistics_monitor_address))
+        writer.start()
+        writer.wait()
+        t_returned = time.time()
+        # the wait ends with the run, not after a silent stream timeout
+        t_finished = self.emulator._last_statistics['end_time']
+        self.assertEqual(writer.get_status(), 'finished')
+        self.assertLess(t_returned - t_finished, 0.3)
+
+
+class TestTracing(EmulatorTestCase):
+
+    def test_run_span(self):
+        writer = self.create_writer(n_frames=300, trace=True)
+        writer.start()
+        self.emulator.inject_failure('statistics', 'drop', count=3)
+        writer.wait()
+        writer.get_snapshot()
+        spans = writer.tracer.get_spans('run')
+        self.assertEqual(len(spans), 1)
+        # the failed polls do not end the run span early
+        self.assertEqual(spans[0].fields['final_status'], 'finished')
+        self.assertEqual(spans[0].fields['n_written_frames'], 300)
+        self.assertLess(spans[0].events['receiving'],
+                        spans[0].events['finished'])
+        self.assertEqual([span.name for span in writer.tracer.get_spans()
+                          if span.name != 'run'], ['start'])
+
+    def test_failed_start(self):
+        writer = self.create_writer(trace=True)
+        self.emulator.inject_failure('start_pco', 'error')
+        writer.start(wait=False)
+        self.emulator.inject_failure('start_pco', 'drop')
+        with self.assertRaises(PcoError):
+            writer.start()
+        # the spans of the runs that have not begun are ended right away
+        spans = writer.tracer.get_spans('run')
+        self.assertEqual([span.fields['final_status'] for span in spans],
+                         ['failed', 'failed'])
+        self.assertIn("success", spans[0].fields['error'])
+        self.assertIn("ConnectionError", spans[1].fields['error'])
+
+
+class TestWriterGroup(EmulatorTestCase):
+
+    def test_start_wait(self):
+        writers = {name: self.create_writer(self.create_emulator(),
+                                            n_frames=100)
+                   for name in ('top', 'side')}
+        group = PcoWriterGroup(writers)
+        result = group.start()
+        result.raise_errors()
+        self.assertLess(group.start_skew, 0.5)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            group.wait(verbose=True, interval=0.05).raise_errors()
+        # only the group prints, a line per writer
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertRegex(line, r'^(top|side): Writer: ')
+        statistics = group.get_aggregated_statistics()
+        self.assertEqual(statistics['n_written_frames'], 200)
+        group._executor.shutdown()
+
+
+class TestAcquisitionQueue(EmulatorTestCase):
+
+    def test_run(self):
+        writer = self.create_writer()
+        queue = AcquisitionQueue(writer, [
+            {'dataset_name': 'data_dark', 'n_frames': 50},
+            {'dataset_name': 'data_white'},
+            {'dataset_name': 'data', 'n_frames': 100}], flush_timeout=0)
+        runs = queue.run()
+        self.assertEqual([run.status for run in runs], ['finished'] * 3)
+        self.assertEqual([run.n_written_frames for run in runs],
+                         [50, 50, 100])
+        self.assertEqual(len(queue.get_summary()['dead_times']), 2)
+
+    def test_flush_overlap(self):
+        emulator = self.create_emulator(stream_address=get_free_address(),
+                                        write_rate=200)
+        writer = self.create_writer(emulator, n_frames=50)
+        queue = AcquisitionQueue(writer, [{}, {}], flush_timeout=100)
+        runs = queue.run()
+        self.assertEqual([run.status for run in runs], ['finished'] * 2)
+        # the flush for the second run was started while the first one wrote
+        handle = writer.flush_handle
+        self.assertIsNotNone(handle)
+        self.assertTrue(handle.done())
+        self.assertIsNone(handle.error)
+
+    def test_flush_join(self):
+        emulator = self.create_emulator(stream_address=get_free_address())
+        writer = self.create_writer(emulator)
+        handle = writer.flush_cam_stream(timeout=300, background=True)
+        # a blocking flush waits for the background flush holding the stream
+        result = writer.flush_cam_stream(timeout=100, summary=True)
+        self.assertTrue(handle.done())
+        self.assertIs(result, handle.summary)
+
+    def test_prepare_after_reception(self):
+        # the writer reports 'writing' while it still receives
+        emulator = self.create_emulator(frame_rate=500,
+                                        receiving_status='writing')
+        writer = self.create_writer(emulator, n_frames=100)
+        queue = AcquisitionQueue(writer, [{}, {}], flush_timeout=0)
+        n_received = []
+        prepare = queue._prepare
+
+        def record_prepare(record):
+            n_received.append(emulator.get_statistics()['n_received_frames'])
+            prepare(record)
+
+        queue._prepare = record_prepare
+        runs = queue.run()
+        self.assertEqual([run.status for run in runs], ['finished'] * 2)
+        self.assertEqual(n_received, [100])
+
+
+class TestStreamTap(EmulatorTestCase):
+
+    def setUp(self):
+        # a run long enough for start() to observe it running
+        self.emulator_kwargs = {'stream_address': get_free_address(),
+                                'frame_shape': (16, 16), 'frame_rate': 200}
+        EmulatorTestCase.setUp(self)
+
+    def test_frames(self):
+        writer = self.create_writer(n_frames=100)
+        tap = StreamTap(self.emulator.stream_address).start()
+        try:
+            # let the connection be established before the first frame
+            time.sleep(0.1)
+            writer.start()
+            writer.wait()
+            self.assertTrue(wait_for(lambda: tap.n_frames == 100))
+            self.assertEqual(tap.n_missing, 0)
+            self.assertEqual(tap.last_frame_id, 99)
+        finally:
+            tap.close()
+
+    def test_frame_accumulator(self):
+        writer = self.create_writer(n_frames=100, dataset_name='data_black')
+        monitor = writer.monitor(interval=0.05)
+        tap = StreamTap(self.emulator.stream_address).start()
+        accumulator = FrameAccumulator(os.path.join(self.directory,
+                                                    'dark.npz'))
+        accumulator.attach(monitor, tap)
+        try:
+            time.sleep(0.1)
+            for _ in range(2):
+                writer.start()
+                writer.wait()
+            self.assertTrue(wait_for(lambda: os.path.exists(
+                os.path.join(self.directory, 'dark_002.npz'))))
+            # the monitor thread has saved the averages once stopped
+            monitor.stop()
+            # every run is averaged from its first frame to its own file
+            for name in ('dark_001.npz', 'dark_002.npz'):
+                with np.load(os.path.join(self.directory, name)) as average:
+                    self.assertEqual(int(average['n_frames']), 100)
+                    self.assertEqual(average['mean'].shape, (16, 16))
+        finally:
+            tap.close()
+
+    def test_callback_error(self):
+        writer = self.create_writer(n_frames=100)
+        tap = StreamTap(self.emulator.stream_address)
+        tap.add_callback(lambda header, image: 1 / 0)
+        output = io.StringIO()
+        try:
+            tap.start()
+            time.sleep(0.1)
+            with contextlib.redirect_stdout(output):
+                writer.start()
+                writer.wait()
+                # a failing consumer does not stop the inspection
+                self.assertTrue(wait_for(lambda: tap.n_frames == 100))
+        finally:
+            tap.close()
+        self.assertEqual(tap.get_summary()['n_callback_errors'], 100)
+        self.assertIn("ZeroDivisionError", output.getvalue())
+
+    def test_frame_accumulator_path(self):
+        writer = self.create_writer()
+        monitor = writer.monitor(interval=0.05)
+        path = os.path.join(self.directory, 'missing', 'dark.npz')
+        accumulator = FrameAccumulator(path)
+        with self.assertRaises(ValueError):
+            accumulator.attach(monitor)
+        accumulator.process({}, np.ones((4, 4)))
+        with self.assertRaises(OSError):
+            accumulator.save()
+        # the default average is saved locally, not next to the output file
+        self.assertEqual(
+            get_reference_path('/data/scan_%03d.h5', 'data_black'),
+            os.path.join(os.getcwd(), 'scan_data_black.npz'))
+        monitor.stop()
+
+    def test_forward(self):
+        writer = self.create_writer(n_frames=100)
+        forward_address = get_free_address()
+        tap = StreamTap(self.emulator.stream_address,
+                        forward_address=forward_address).start()
+        consumer = zmq.Context.instance().socket(zmq.PULL)
+        consumer.setsockopt(zmq.LINGER, 0)
+        try:
+            time.sleep(0.1)
+            writer.start()
+            writer.wait()
+            # without a consumer the tap waits instead of dropping frames
+            self.assertEqual(tap.n_frames, 0)
+            consumer.connect(forward_address)
+            frame_ids = []
+            while len(frame_ids) < 100 and consumer.poll(1000):
+                header, _ = consumer.recv_multipart()
+                frame_ids.append(json.loads(header.decode())['frame'])
+            self.assertEqual(frame_ids, list(range(100)))
+            self.assertTrue(wait_for(lambda: tap.n_frames == 100))
+            self.assertEqual(tap.n_dropped, 0)
+        finally:
+            consumer.close()
+            tap.close()
+
+    def test_forward_close(self):
+        writer = self.create_writer(n_frames=100)
+        tap = StreamTap(self.emulator.stream_address,
+                        forward_address=get_free_address()).start()
+        time.sleep(0.1)
+        writer.start()
+        writer.wait()
+        # a tap waiting for a consumer is closed right away
+        t_close = time.monotonic()
+        tap.close()
+        self.assertLess(time.monotonic() - t_close, 1.0)
+        self.assertEqual(tap.n_dropped, 1)
+
+class TestAdaptivePolling(unittest.TestCase):
+
+    def test_backoff_and_reset(self):
+        schedule = AdaptivePolling(min_interval=0.02, max_interval=0.1,
+                                   backoff=2.0).schedule('wait')
+        receiving = WriterSnapshot('receiving', {'n_frames': 0})
+        intervals = [schedule.next_interval(receiving) for _ in range(5)]
+        # without a target the interval grows up to the maximum
+        self.assertEqual(intervals, [0.02, 0.04, 0.08, 0.1, 0.1])
+        # and a status change polls fast again
+        writing = WriterSnapshot('writing', {'n_frames': 0})
+        self.assertEqual(schedule.next_interval(writing), 0.02)
+        self.assertEqual(schedule.next_interval(writing), 0.04)
+
+    def test_extrapolated_end(self):
+        schedule = AdaptivePolling(min_interval=0.02,
+                                   max_interval=2.0).schedule('wait')
+        stats = {'n_frames': 1000, 'writing_rate': 100}
+        schedule.next_interval(WriterSnapshot(
+            'receiving', dict(stats, n_written_frames=0)))
+        # half of the extrapolated time until the last frame, bounded
+        self.assertEqual(schedule.next_interval(WriterSnapshot(
+            'receiving', dict(stats, n_written_frames=0))), 2.0)
+        self.assertAlmostEqual(schedule.next_interval(WriterSnapshot(
+            'receiving', dict(stats, n_written_frames=900))), 0.5)
+        self.assertEqual(schedule.next_interval(WriterSnapshot(
+            'receiving', dict(stats, n_written_frames=999))), 0.02)
+
+    def test_fast_period(self):
+        policy = AdaptivePolling(min_interval=0.02, backoff=2.0,
+                                 fast_period=0.05)
+        schedule = policy.schedule('start')
+        self.assertEqual(schedule.next_interval(), 0.02)
+        time.sleep(0.05)
+        # after the fast period the interval backs off
+        self.assertEqual([schedule.next_interval() for _ in range(2)],
+                         [0.04, 0.08])
+
+
+class TestStatisticsHistory(unittest.TestCase):
+
+    def test_new_run(self):
+        history = StatisticsHistory()
+        for t in range(3):
+            history.add_snapshot(WriterSnapshot(
+                'receiving', {'n_received_frames': 10 * t}, timestamp=t))
+        history.add_snapshot(WriterSnapshot('finished', timestamp=3))
+        history.add_snapshot(WriterSnapshot(
+            'receiving', {'n_received_frames': 50}, timestamp=4))
+        # the first snapshot after the end of a run starts a new history
+        self.assertEqual(history.get_samples()[:, 0].tolist(), [4])
+
+    def test_throughput(self):
+        history = StatisticsHistory()
+        for t, jitter in enumerate([0, 2, -2, -2, 2, 0]):
+            history.add_sample(t, 100 * t + jitter, 80 * t)
+        throughput = history.get_throughput(n_frames=1000, window=10)
+        # the least-squares rates smooth the jitter of the counts
+        self.assertAlmostEqual(throughput['receive_fps'], 100)
+        self.assertAlmostEqual(throughput['write_fps'], 80)
+        self.assertEqual(throughput['backlog'], 100)
+        self.assertAlmostEqual(throughput['eta'], 600 / 80.0)
+        # only the samples of the time window are fitted
+        history.add_sample(6, 700, 480)
+        self.assertAlmostEqual(
+            history.get_throughput(window=1)['receive_fps'], 200)
+
+    def test_wrap_around(self):
+        history = StatisticsHistory(size=4)
+        for t in range(6):
+            history.add_sample(t, 10 * t, 10 * t)
+        samples = history.get_samples()
+        # the oldest samples were overwritten, the order is kept
+        self.assertEqual(len(history), 4)
+        self.assertEqual(samples[:, 0].tolist(), [2, 3, 4, 5])
+        self.assertEqual(samples[:, 2].tolist(), [20, 30, 40, 50])
+        self.assertAlmostEqual(history.get_throughput()['write_fps'], 10)
+        # samples not newer than the last one are ignored
+        history.add_sample(5, 60, 60)
+        self.assertEqual(history.get_samples()[-1, 1], 50)
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.address = get_free_address()
+        self.generator = StreamGenerator(self.address, frame_shape=(4, 8),
+                                         gap_every=3, gap_size=2)
+        self.drain = StreamDrain()
+
+    def tearDown(self):
+        self.generator.close()
+        self.drain.close()
+
+    def test_drain(self):
+        self.generator.start(n_frames=20)
+        headers = []
+        summary = self.drain.drain(
+            self.address, timeout=200,
+            on_header=lambda index, header: headers.append(header))
+        frame_ids = [i + 2 * (i // 3) for i in range(20)]
+        n_header_bytes = sum(len(make_header(frame_id, (4, 8), 'uint16'))
+                             for frame_id in frame_ids)
+        self.assertEqual((summary.n_frames, summary.n_messages), (20, 40))
+        self.assertEqual(summary.n_bytes, n_header_bytes + 20 * 4 * 8 * 2)
+        self.assertEqual((summary.first_frame_id, summary.last_frame_id),
+                         (0, frame_ids[-1]))
+        # the flush ends after the inactivity timeout
+        self.assertGreaterEqual(summary.duration, 0.2)
+        # the headers are only decoded on request
+        self.assertEqual(headers, [])
+        # the drain is reused, and ends early when cancelled
+        cancel = threading.Event()
+        threading.Timer(0.1, cancel.set).start()
+        summary = self.drain.drain(self.address, timeout=0, cancel=cancel)
+        self.assertEqual(summary.n_frames, 0)
+        self.assertLess(summary.duration, 1.0)
+
+    def test_generator(self):
+        self.generator.start(n_frames=7)
+        headers = []
+        summary = self.drain.drain(
+            self.address, timeout=300, decode_headers=True,
+            on_header=lambda index, header: headers.append(header))
+        # two frame ids are skipped after every third frame
+        self.assertEqual([header['frame'] for header in headers],
+                         [0, 1, 2, 5, 6, 7, 10])
+        self.assertEqual(headers[0]['shape'], [4, 8])
+        self.assertEqual(headers[0]['type'], 'uint16')
+        self.assertEqual((summary.n_frames, summary.n_messages), (7, 14))
+        self.assertEqual((summary.first_frame_id, summary.last_frame_id),
+                         (0, 10))
+        self.assertEqual(self.generator.n_sent, 7)
+        self.assertEqual(self.generator.n_bytes, 7 * 4 * 8 * 2)
+
+
+class TestPreview(unittest.TestCase):
+
+    def test_bin_image(self):
+        image = np.arange(30, dtype=np.uint16).reshape(5, 6)
+        # the last row is cropped, the means are rounded
+        np.testing.assert_array_equal(
+            bin_image(image, 2), [[4, 6, 8], [16, 18, 20]])
+        self.assertEqual(bin_image(image, 2).dtype, np.uint16)
+        np.testing.assert_array_equal(
+            bin_image(image, 2, mode='subsample'), [[0, 2, 4], [12, 14, 16]])
+        np.testing.assert_array_equal(
+            bin_image(image.astype(np.float32), 3), [[7.0, 10.0]])
+        self.assertIs(bin_image(image, 1), image)
+        with self.assertRaises(ValueError):
+            bin_image(image, 2, mode='median')
+
+    def test_rate_limit(self):
+        address = get_free_address()
+        preview = PreviewPublisher(address, every=2, binning=2, max_rate=10)
+        subscriber = PreviewSubscriber(address)
+        try:
+            image = np.ones((8, 8), dtype=np.uint16)
+            time.sleep(0.2)
+            published = [preview.process({"frame": frame_id}, image)
+                         for frame_id in range(10)]
+            # every other frame is considered, at most 10 per second
+            self.assertEqual(published, [True] + [False] * 9)
+            self.assertEqual(subscriber.receive()[0]["frame"], 0)
+            time.sleep(0.1)
+            self.assertTrue(preview.process({"frame": 10}, image))
+            self.assertFalse(preview.process({"frame": 11}, image))
+            self.assertEqual((preview.n_frames, preview.n_published), (12, 2))
+            header, thumbnail = subscriber.receive()
+            self.assertEqual(header["frame"], 10)
+            self.assertEqual(header["source_shape"], [8, 8])
+            self.assertEqual(thumbnail.shape, (4, 4))
+        finally:
+            subscriber.close()
+            preview.close()
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'capture.seg')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_replay(self):
+        address = get_free_address()
+        generator = StreamGenerator(address, frame_shape=(16, 16),
+                                    gap_every=5, pool_size=3, seed=0)
+        # a small chunk size and index buffer exercise the growth of the
+        # segment file and the blocks of the index
+        recorder = CaptureRecorder(self.path, address, chunk_size=4096,
+                                   index_buffer_size=4).start()
+        try:
+            generator.run(n_frames=12)
+            self.assertTrue(wait_for(lambda: recorder.n_frames == 12))
+        finally:
+            recorder.close()
+            generator.close()
+
+        capture = Capture(self.path)
+        frame_ids = [i + i // 5 for i in range(12)]
+        self.assertEqual(len(capture), 12)
+        self.assertEqual(capture.n_bytes, 12 * 16 * 16 * 2)
+        for index, frame_id in enumerate(frame_ids):
+            header, data = capture.get_frame(index)
+            self.assertEqual(json.loads(bytes(header).decode())['frame'],
+                             frame_id)
+            np.testing.assert_array_equal(
+                np.frombuffer(data, dtype=np.uint16).reshape(16, 16),
+                generator.frames[frame_id % 3])
+
+        # the replay sends the recorded frames unchanged
+        address = get_free_address()
+        replayer = CaptureReplayer(capture, address, speed=0)
+        drain = StreamDrain()
+        headers = []
+        try:
+            replayer.start()
+            summary = drain.drain(
+                address, timeout=300, decode_headers=True,
+                on_header=lambda index, header: headers.append(header))
+        finally:
+            replayer.close()
+            drain.close()
+        self.assertEqual([header['frame'] for header in headers], frame_ids)
+        self.assertEqual(summary.n_bytes - sum(
+            len(make_header(frame_id, (16, 16), 'uint16'))
+            for frame_id in frame_ids), capture.n_bytes)
+        self.assertEqual(replayer.n_sent, 12)
+
+
+class TestSharedMemory(unittest.TestCase):
+
+    def test_overrun(self):
+        address = get_free_address()
+        name = 'pco_test_ring_{}'.format(os.getpid())
+        generator = StreamGenerator(address, frame_shape=(16, 16),
+                                    pool_size=3, seed=0)
+        receiver = SharedStreamReceiver(address, name, n_slots=4,
+                                        slot_size=16 * 16 * 2).start()
+        reader = SharedFrameReader(name)
+        try:
+            generator.run(n_frames=2)
+            self.assertTrue(wait_for(lambda: receiver.n_frames == 2))
+            frame = reader.read()
+            self.assertEqual(frame.seq, 1)
+            self.assertEqual(frame.header['frame'], 0)
+            self.assertTrue(frame.is_valid())
+            np.testing.assert_array_equal(frame.image, generator.frames[0])
+
+            # the receiver laps the reader and overwrites the frame read
+            generator.run(n_frames=8)
+            self.assertTrue(wait_for(lambda: receiver.n_frames == 10))
+            self.assertFalse(frame.is_valid())
+
+            # the reader skips ahead to the latest frame
+            frame = reader.read()
+            self.assertEqual(frame.seq, 10)
+            self.assertEqual(frame.header['frame'], 9)
+            self.assertEqual(reader.n_skipped, 8)
+            self.assertEqual(reader.n_read, 2)
+            np.testing.assert_array_equal(frame.image, generator.frames[0])
+            self.assertIsNone(reader.read(timeout=0.05))
+
+            # a reader starting with the oldest frame skips the slot that
+            # may be being rewritten
+            oldest = SharedFrameReader(name, start='oldest')
+            try:
+                self.assertEqual(
+                    [oldest.read().seq for _ in range(3)], [8, 9, 10])
+            finally:
+                oldest.close()
+        finally:
+            reader.close()
+            receiver.close()
+            generator.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Control of several PCO writers at once.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+import threading
+import time
+
+from pco_rclient.client.pco_client import PcoError
+from pco_rclient.client.pco_core import Call, run_steps
+
+
+# Statistics fields summed over the writers of a group.
+SUMMED_STATISTICS = ('n_frames', 'n_received_frames', 'n_written_frames',
+                     'n_lost_frames', 'receiving_rate', 'writing_rate',
+                     'avg_receiving_rate', 'avg_writing_rate')
+
+
+def aggregate_statistics(statistics):
+    """
+    Combine the statistics of several writers.
+
+    Parameters
+    ----------
+    statistics : dict
+        The statistics (dict or None) per writer name.
+
+    Returns
+    -------
+    aggregate : dict
+        The sums of the :data:`SUMMED_STATISTICS` fields over the writers
+        reporting statistics, the number of writers "n_writers", of writers
+        reporting statistics "n_reporting", and the "status" of every writer.
+
+    """
+
+    aggregate = dict.fromkeys(SUMMED_STATISTICS, 0)
+    aggregate["n_writers"] = len(statistics)
+    aggregate["n_reporting"] = 0
+    aggregate["status"] = {}
+    for name, stats in statistics.items():
+        if not stats:
+            aggregate["status"][name] = None
+            continue
+        aggregate["n_reporting"] += 1
+        aggregate["status"][name] = stats.get("status")
+        for field in SUMMED_STATISTICS:
+            # the statistics of the last run report the counts as strings
+            try:
+                aggregate[field] += float(stats.get(field) or 0)
+            except (TypeError, ValueError):
+                pass
+    for field in SUMMED_STATISTICS:
+        if field.startswith('n_'):
+            aggregate[field] = int(aggregate[field])
+    return aggregate
+
+
+class MemberResult(object):
+    """
+    Outcome of an operation on one writer of a group.
+
+    Attributes
+    ----------
+    value : object
+        The return value of the operation, None if it failed.
+    error : Exception or None
+        The exception raised by the operation.
+    duration : float
+        The duration [s] of the operation.
+
+    """
+
+    def __init__(self, value=None, error=None, duration=0.0):
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    def __repr__(self):
+        if self.error is not None:
+            return "MemberResult(error={!r})".format(self.error)
+        return "MemberResult(value={!r}, duration={:.3f})".format(
+            self.value, self.duration)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class GroupResult(dict):
+    """
+    The :class:`MemberResult` of an operation per writer name.
+    """
+
+    @property
+    def errors(self):
+        """
+        The exceptions of the failed writers, per writer name.
+        """
+
+        return {name: result.error for name, result in self.items()
+                if result.error is not None}
+
+    @property
+    def ok(self):
+        """
+        True if the operation succeeded on all writers.
+        """
+
+        return all(result.ok for result in self.values())
+
+    def raise_errors(self):
+        """
+        Raise a :class:`PcoError` listing the failed writers, if any.
+        """
+
+        errors = self.errors
+        if errors:
+            raise PcoError("The operation failed on {} of {} writers: "
+                           "{}".format(len(errors), len(self), errors))
+
+    @property
+    def results(self):
+        """
+        The return values of the operation, per writer name.
+        """
+
+        return {name: result.value for name, result in self.items()}
+
+
+class PcoWriterGroup(object):
+    """
+    Group of PCO writers controlled together.
+
+    Every operation is run on all writers concurrently and returns a
+    :class:`GroupResult`; an error of one writer does not prevent the
+    operation on the others. :meth:`start` prepares all writers in parallel
+    (configuration and running-state checks) and sends the start requests
+    only once every writer is ready, through a :class:`threading.Barrier`.
+    The spread of the moments the start requests were sent is available as
+    `start_skew`.
+    """
+
+    def __init__(self, writers):
+        """
+        Initialize the group.
+
+        Parameters
+        ----------
+        writers : dict or list of PcoWriter
+            The writers, by name. The writers of a list are named by their
+            index.
+
+        """
+
+        if not isinstance(writers, dict):
+            writers = dict(enumerate(writers))
+        if not writers:
+            raise PcoError("A writer group needs at least one writer.")
+        self.writers = writers
+        self.start_times = {}
+        # one thread per writer, as all of them meet at the start barrier
+        self._executor = ThreadPoolExecutor(max_workers=len(writers))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.writers)
+
+    def _map(self, operation, arguments=None):
+        """
+        Run `operation(writer, **kwargs)` on all writers concurrently.
+
+        `arguments` optionally holds the keyword arguments per writer name.
+        """
+
+        futures = self._submit(operation, arguments)
+        return GroupResult((name, future.result())
+                           for name, future in futures.items())
+
+    def _start_writer(self, writer, barrier, wait, timeout, verbose):
+        """
+        Start a writer, sending its start request through the barrier.
+        """
+
+        sent = []
+
+        def before_start():
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                # another writer failed or was too slow; start anyway
+                pass
+            sent.append(time.monotonic())
+
+        try:
+            return run_steps(writer._start_steps(
+                wait=wait, timeout=timeout, verbose=verbose,
+                before_start=before_start)), sent
+        finally:
+            if not sent:
+                # this writer will not start, do not hold up the others
+                barrier.abort()
+
+    def _submit(self, operation, arguments=None):
+        """
+        Submit `operation(writer, **kwargs)` for all writers, see
+        :meth:`_map`, and return the futures of the :class:`MemberResult`
+        per writer name.
+        """
+
+        def run(name, writer):
+            kwargs = (arguments or {}).get(name, {})
+            t_start = time.monotonic()
+            try:
+                value = operation(writer, **kwargs)
+            except Exception as e:
+                return MemberResult(error=e,
+                                    duration=time.monotonic() - t_start)
+            return MemberResult(value, duration=time.monotonic() - t_start)
+
+        return {name: self._executor.submit(run, name, writer)
+                for name, writer in self.writers.items()}
+
+    def _wait_steps(self, writer, snapshots, name):
+        """
+        Wait for a writer to finish, without printing its progress.
+
+        The latest snapshot of the writer is kept in `snapshots[name]`.
+        """
+
+        snapshot = yield from writer._get_snapshot_steps()
+        subscriber = writer._open_statistics_subscriber()
+        schedule = writer.polling_policy.schedule('wait')
+        try:
+            while snapshot.is_running:
+                snapshots[name] = snapshot
+                snapshot = yield from writer._next_snapshot_steps(
+                    subscriber, schedule.next_interval(snapshot))
+        finally:
+            if subscriber is not None:
+                subscriber.close()
+        snapshots[name] = snapshot
+        writer.status = yield Call(writer.get_status)
+        return snapshot
+
+    def close(self):
+        """
+        Close the writers and the thread pool.
+        """
+
+        self._map(lambda writer: writer.close())
+        self._executor.shutdown()
+
+    def configure(self, configurations=None, **kwargs):
+        """
+        Configure all writers.
+
+        Parameters
+        ----------
+        configurations : dict, optional
+            The arguments of :meth:`PcoWriter.configure` per writer name,
+            e.g. the output file of each camera, overriding `kwargs`.
+            (default = None)
+        **kwargs
+            The arguments of :meth:`PcoWriter.configure` common to all
+            writers.
+
+        """
+
+        arguments = {}
+        for name in self.writers:
+            arguments[name] = dict(kwargs)
+            arguments[name].update((configurations or {}).get(name, {}))
+        return self._map(lambda writer, **kw: writer.configure(**kw),
+                         arguments)
+
+    def get_aggregated_statistics(self):
+        """
+        Return the statistics of all writers combined, see
+        :func:`aggregate_statistics`.
+
+        The statistics of the writers that failed to report are None.
+        """
+
+        return aggregate_statistics(self.get_statistics().results)
+
+    def get_statistics(self):
+        """
+        Return the statistics of all writers.
+        """
+
+        return self._map(lambda writer: writer.get_statistics())
+
+    def get_status(self):
+        """
+        Return the status of all writers.
+        """
+
+        return self._map(lambda writer: writer.get_status())
+
+    def is_running(self):
+        """
+        Return whether a writer process is running, for all writers.
+        """
+
+        return self._map(lambda writer: writer.is_running())
+
+    def kill(self, verbose=False):
+        """
+        Kill the writer processes of all writers.
+        """
+
+        return self._map(lambda writer: writer.kill(verbose=verbose))
+
+    def reset(self, background_flush=False):
+        """
+        Reset all writers, see :meth:`PcoWriter.reset`.
+        """
+
+        return self._map(
+            lambda writer: writer.reset(background_flush=background_flush))
+
+    def start(self, wait=True, timeout=10, verbose=False, sync_timeout=5.0):
+        """
+        Start the writer processes of all writers together.
+
+        Each writer is prepared concurrently; the start requests are then
+        released at the same moment. A writer that does not send its start
+        request (e.g. not configured or already running) releases the others
+        immediately, as does a writer not ready within `sync_timeout`.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Wait for the writers to report a running status.
+            (default = True)
+        timeout : float, optional
+            The maximum time [s] to wait for each writer to run.
+            (default = 10)
+        verbose : bool, optional
+            Show verbose information. (default = False)
+        sync_timeout : float, optional
+            The maximum time [s] the ready writers wait for the others.
+            (default = 5.0)
+
+        Returns
+        -------
+        result : GroupResult
+            The responses of the start requests.
+
+        """
+
+        barrier = threading.Barrier(len(self.writers), timeout=sync_timeout)
+        results = self._map(
+            lambda writer: self._start_writer(writer, barrier, wait, timeout,
+                                              verbose))
+        self.start_times = {}
+        for name, result in results.items():
+            if result.ok:
+                result.value, sent = result.value
+                if sent:
+                    self.start_times[name] = sent[0]
+        return results
+
+    @property
+    def start_skew(self):
+        """
+        The time [s] between the first and the last start request sent by
+        the last :meth:`start`.
+        """
+
+        if not self.start_times:
+            return 0.0
+        return max(self.start_times.values()) - min(self.start_times.values())
+
+    def stop(self, wait=True, timeout=10, verbose=False):
+        """
+        Stop the writer processes of all writers.
+        """
+
+        return self._map(lambda writer: writer.stop(
+            wait=wait, timeout=timeout, verbose=verbose))
+
+    def wait(self, verbose=False, interval=1.0):
+        """
+        Wait for all writers to finish writing.
+
+        The writers themselves print nothing while the group waits for them.
+
+        Parameters
+        ----------
+        verbose : bool, optional
+            Print the progress of every writer, prefixed with its name, every
+            `interval` seconds and once all writers have finished.
+            (default = False)
+        interval : float, optional
+            The time [s] between two progress reports. (default = 1.0)
+
+        Returns
+        -------
+        result : GroupResult
+            The last :class:`WriterSnapshot` of every writer.
+
+        """
+
+        snapshots = {}
+        futures = self._submit(
+            lambda writer, name: run_steps(
+                self._wait_steps(writer, snapshots, name)),
+            {name: {'name': name} for name in self.writers})
+        while True:
+            done = not wait_futures(futures.values(), timeout=interval)[1]
+            if verbose:
+                for name, writer in self.writers.items():
+                    if name in snapshots:
+                        print("{}: {}".format(name, writer._progress_message(
+                            snapshots[name])))
+            if done:
+                break
+        return GroupResult((name, future.result())
+                           for name, future in futures.items())
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics history and throughput estimates of the PCO writer.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import threading
+
+import numpy as np
+
+
+# Columns of the history samples.
+HISTORY_FIELDS = ('timestamp', 'n_received_frames', 'n_written_frames',
+                  'n_lost_frames')
+
+
+class StatisticsHistory(object):
+    """
+    Fixed-size ring buffer of the statistics samples of the current run.
+
+    Every sample holds the time stamp and the received, written and lost frame
+    counts of a snapshot of the running writer. The samples are kept in a
+    preallocated array, so recording never allocates memory, and the
+    throughput estimates are computed with vectorized least-squares fits over
+    a recent time window, which smooths the jitter of individual polls.
+
+    The history is cleared automatically when a new run starts.
+    """
+
+    def __init__(self, size=256):
+        """
+        Initialize the history.
+
+        Parameters
+        ----------
+        size : int, optional
+            The maximum number of samples kept. Older samples are overwritten.
+            (default = 256)
+
+        """
+
+        self.size = int(size)
+        self._samples = np.zeros((self.size, len(HISTORY_FIELDS)),
+                                 dtype=np.float64)
+        self._count = 0
+        self._next = 0
+        self._run_ended = True
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self._count
+
+    def add_sample(self, timestamp, n_received_frames, n_written_frames,
+                   n_lost_frames=0):
+        """
+        Append a sample to the history.
+
+        Samples that are not newer than the last sample are ignored. The
+        history is cleared first if the frame counts decreased, which means
+        that a new run has started.
+
+        """
+
+        with self._lock:
+            if self._count:
+                last = self._samples[(self._next - 1) % self.size]
+                if timestamp <= last[0]:
+                    return
+                if (n_received_frames < last[1] or
+                        n_written_frames < last[2]):
+                    self._count = 0
+                    self._next = 0
+            self._samples[self._next] = (timestamp, n_received_frames,
+                                         n_written_frames, n_lost_frames)
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def add_snapshot(self, snapshot):
+        """
+        Append a snapshot of the writer to the history.
+
+        Only snapshots of a running writer are recorded. The first snapshot
+        of a running writer after a snapshot of a stopped writer starts a new
+        run and clears the history.
+
+        Parameters
+        ----------
+        snapshot : WriterSnapshot
+            The snapshot to record.
+
+        """
+
+        with self._lock:
+            if not snapshot.is_running:
+                self._run_ended = True
+                return
+            if self._run_ended:
+                self._run_ended = False
+                self.clear()
+            self.add_sample(snapshot.timestamp, snapshot.n_received_frames,
+                            snapshot.n_written_frames, snapshot.n_lost_frames)
+
+    def clear(self):
+        """
+        Remove all samples.
+        """
+
+        with self._lock:
+            self._count = 0
+            self._next = 0
+
+    def get_samples(self):
+        """
+        Return a copy of the samples, from the oldest to the newest.
+
+        Returns
+        -------
+        samples : numpy.ndarray
+            Array of shape (n_samples, 4) with the columns listed in
+            :data:`HISTORY_FIELDS`.
+
+        """
+
+        with self._lock:
+            if self._count < self.size:
+                return self._samples[:self._count].copy()
+            return np.roll(self._samples, -self._next, axis=0)
+
+    def get_throughput(self, n_frames=0, window=5.0):
+        """
+        Estimate the throughput of the current run.
+
+        Parameters
+        ----------
+        n_frames : int, optional
+            The total number of frames of the run, used for the estimated time
+            of arrival. 0 if undefined. (default = 0)
+        window : float, optional
+            The length [s] of the most recent time window used to fit the
+            rates. (default = 5.0)
+
+        Returns
+        -------
+        throughput : dict
+            With the keys:
+
+            * "receive_fps", "write_fps": the smoothed receive and write rates
+              [frames/s],
+            * "backlog": the number of frames received but not yet written,
+            * "backlog_rate": the growth rate of the backlog [frames/s]; a
+              persistently positive value means that the writer cannot keep
+              up with the incoming data,
+            * "lost_fps": the rate of lost frames [frames/s],
+            * "eta": the estimated time [s] until all `n_frames` frames are
+              written, None if unknown.
+
+            The rates are None if fewer than two samples are available.
+
+        """
+
+        samples = self.get_samples()
+        throughput = {"receive_fps": None, "write_fps": None, "backlog": 0,
+                      "backlog_rate": None, "lost_fps": None, "eta": None}
+        if len(samples) == 0:
+            return throughput
+        last = samples[-1]
+        throughput["backlog"] = int(last[1] - last[2])
+        samples = samples[samples[:, 0] >= last[0] - window]
+        if len(samples) < 2:
+            return throughput
+        # least-squares slopes of all frame counts versus time at once
+        t = samples[:, 0] - samples[:, 0].mean()
+        counts = samples[:, 1:] - samples[:, 1:].mean(axis=0)
+        denominator = np.dot(t, t)
+        if denominator <= 0:
+            return throughput
+        receive_fps, write_fps, lost_fps = np.dot(t, counts) / denominator
+        throughput["receive_fps"] = float(receive_fps)
+        throughput["write_fps"] = float(write_fps)
+        throughput["backlog_rate"] = float(receive_fps - write_fps)
+        throughput["lost_fps"] = float(lost_fps)
+        if n_frames > 0 and write_fps > 0:
+            throughput["eta"] = float(max(n_frames - last[2], 0) / write_fps)
+        return throughput
+
+
+def format_throughput(throughput):
+    """
+    Return a short progress-line suffix for a throughput estimate.
+
+    Parameters
+    ----------
+    throughput : dict
+        The throughput, see :meth:`StatisticsHistory.get_throughput`.
+
+    Returns
+    -------
+    msg : str
+        E.g. "rcv: 100.0 fps, wrt: 98.0 fps, backlog: 12 (+2.0/s),
+        ETA: 10.1 s", or an empty string if no rates are available.
+
+    """
+
+    if throughput["write_fps"] is None:
+        return ""
+    msg = "rcv: {:.1f} fps, wrt: {:.1f} fps, backlog: {:d} ({:+.1f}/s)".format(
+        throughput["receive_fps"], throughput["write_fps"],
+        throughput["backlog"], throughput["backlog_rate"])
+    if throughput["eta"] is not None:
+        msg += ", ETA: {:.1f} s".format(throughput["eta"])
+    return msg
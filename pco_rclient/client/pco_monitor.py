@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+"""
+Live statistics of the PCO writer.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+from concurrent.futures import Future
+import json
+import re
+import threading
+import time
+
+import zmq
+
+
+# Statuses reported by the writer once a run has ended.
+END_STATUSES = ('finished', 'killed', 'stopped')
+
+
+def resolve_monitor_address(monitor_address, api_address):
+    """
+    Return the address to connect to the statistics monitor of the writer.
+
+    The writer configuration specifies the address the writer *binds* its
+    statistics monitor to, typically with a wildcard host (e.g.
+    "tcp://*:8081"). The wildcard is replaced by the host of the writer api
+    address.
+
+    Parameters
+    ----------
+    monitor_address : str
+        The statistics monitor address, e.g. "tcp://*:8081".
+    api_address : str
+        The address of the writer api, e.g. "http://xbl-daq-32:9555".
+
+    Returns
+    -------
+    address : str
+        The address to connect to, e.g. "tcp://xbl-daq-32:8081".
+
+    """
+
+    host = re.sub(r"^[a-z]+://", "", api_address).rsplit(":", 1)[0]
+    return re.sub(r"(?<=://)(\*|0\.0\.0\.0)(?=:)", host, monitor_address)
+
+
+class WriterSnapshot(object):
+    """
+    Status and statistics of the PCO writer at one point in time.
+
+    Attributes
+    ----------
+    status : str
+        The status of the writer, e.g. 'receiving' or 'finished'.
+    statistics : dict or None
+        The statistics of the running writer, or of the last run if no writer
+        process is running. None if no statistics are available.
+    timestamp : float
+        The time [s since the epoch] at which the snapshot was taken.
+    is_running : bool
+        Whether a writer process is running.
+    n_frames : int
+        The number of frames requested (0 if undefined or not available).
+    n_received_frames : int
+        The number of frames received by the writer.
+    n_written_frames : int
+        The number of frames written to file.
+    n_lost_frames : int
+        The number of frames lost by the writer.
+
+    """
+
+    def __init__(self, status, statistics=None, timestamp=None):
+        self.status = status
+        self.statistics = statistics
+        if timestamp is None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+        self.is_running = bool(status in ('receiving', 'writing'))
+        # the statistics of the last run report the frame counts as strings
+        stats = statistics or {}
+        self.n_frames = int(stats.get('n_frames', 0))
+        self.n_received_frames = int(stats.get('n_received_frames', 0))
+        self.n_written_frames = int(stats.get('n_written_frames', 0))
+        self.n_lost_frames = int(stats.get('n_lost_frames', 0))
+
+    def __repr__(self):
+        return "<WriterSnapshot {}: {}>".format(
+            self.status, self.get_progress_message())
+
+    def get_progress_message(self):
+        """
+        Return a string indicating the progress of the writer.
+        """
+
+        if self.statistics is None:
+            return "Writer: Status not available"
+        status = self.statistics.get('status', "unknown")
+        n_req = self.n_frames
+        n_rcvd = self.n_received_frames
+        n_wrtn = self.n_written_frames
+        if n_req > 0:
+            pc_rcvd = float(n_rcvd) / n_req * 100.0
+            pc_wrtn = float(n_wrtn) / n_req * 100.0
+            msg = ("Writer: {}, #received: {:4d} ({:.1f}%), "
+                    "#written: {:4d} ({:.1f}%)".format(
+                    status, n_rcvd, pc_rcvd, n_wrtn, pc_wrtn))
+        else:
+            msg = ("Writer: {}, #received: {:4d}, "
+                    "#written: {:4d}".format(
+                    status, n_rcvd, n_wrtn))
+        return msg
+
+
+class StatisticsSubscriber(object):
+    """
+    Subscriber to the statistics monitor stream published by the writer.
+
+    The writer publishes its statistics as JSON messages with the same fields
+    as the response of the writer's /statistics route. The subscriber only
+    keeps the most recent message, so a slow reader always gets the latest
+    statistics and never a backlog.
+    """
+
+    def __init__(self, address, timeout=1.0, context=None):
+        """
+        Connect to the statistics monitor.
+
+        Parameters
+        ----------
+        address : str
+            The address of the statistics monitor, e.g. "tcp://xbl-daq-32:8081".
+        timeout : float, optional
+            The time [s] without updates after which the stream is considered
+            silent, see :meth:`receive`. (default = 1.0)
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+
+        """
+
+        self.address = address
+        self.timeout = timeout
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.CONFLATE, 1)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+        self.socket.connect(address)
+        # ZMQ sockets are not thread safe, the lock allows closing the
+        # subscriber from another thread than the one waiting in receive()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Disconnect from the statistics monitor.
+        """
+
+        with self._lock:
+            self._closed = True
+            self.socket.close()
+
+    def receive(self, timeout=None):
+        """
+        Wait for the next statistics update.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time [s] to wait. If None, the subscriber's `timeout`
+            is used. (default = None)
+
+        Returns
+        -------
+        stats : dict or None
+            The statistics, or None if no (valid) update arrived in time.
+
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            if self._closed or not self.socket.poll(int(timeout * 1000)):
+                return None
+            message = self.socket.recv()
+        try:
+            stats = json.loads(message.decode())
+        except ValueError:
+            return None
+        if not isinstance(stats, dict):
+            return None
+        return stats
+
+
+class MilestoneError(Exception):
+    """
+    Raised by a milestone future if the run ended before the milestone.
+    """
+
+
+class _Milestone(object):
+    """
+    A frame-count milestone of a run and the future resolving it.
+    """
+
+    def __init__(self, n_frames, field):
+        self.n_frames = int(n_frames)
+        self.field = field
+        self.future = Future()
+        self.seen_running = False
+
+    def update(self, snapshot):
+        """
+        Return True if reached, False if missed, or None if still pending.
+        """
+
+        value = getattr(snapshot, self.field)
+        if snapshot.is_running:
+            self.seen_running = True
+            if value >= self.n_frames:
+                return True
+        elif self.seen_running and snapshot.status in END_STATUSES:
+            # the run has ended, its final statistics decide
+            return value >= self.n_frames
+        return None
+
+
+def _call_safely(callback, *args):
+    """
+    Call a monitor callback, printing instead of raising its exceptions.
+    """
+
+    try:
+        callback(*args)
+    except Exception as e:
+        print("StatisticsMonitor: callback {!r} failed: {!r}".format(
+            callback, e))
+
+
+class StatisticsMonitor(object):
+    """
+    Background thread keeping the latest statistics of a PCO writer.
+
+    The monitor polls the writer's REST api, or subscribes to its statistics
+    monitor stream if the writer has a `statistics_monitor_address`, and keeps
+    the most recent :class:`WriterSnapshot`. All consumers (progress display,
+    logging, scan logic, ...) read that shared snapshot locally instead of
+    querying the writer server themselves, and can register callbacks for
+    status changes and frame-count thresholds.
+
+    Frame-count milestones of a run can also be registered up front as
+    futures (see :meth:`add_milestones`), which are all resolved by the
+    monitor.
+
+    A poll that fails (e.g. while the server is unavailable) is skipped, the
+    latest snapshot is kept until the next successful one.
+
+    Callbacks are called from the monitor thread and should return quickly.
+    Exceptions raised by a callback are printed and otherwise ignored.
+
+    Use :meth:`PcoWriter.monitor` to start the monitor of a writer.
+    """
+
+    def __init__(self, writer, interval=0.5):
+        """
+        Initialize the monitor.
+
+        Parameters
+        ----------
+        writer : PcoWriter
+            The writer to monitor.
+        interval : float, optional
+            The time [s] between two REST api polls. When subscribed to the
+            statistics stream, the REST api is only polled if the stream stays
+            silent. (default = 0.5)
+
+        """
+
+        self.writer = writer
+        self.interval = interval
+        self._snapshot = None
+        self._n_updates = 0
+        self._condition = threading.Condition()
+        self._status_callbacks = []
+        self._frame_callbacks = []
+        self._update_callbacks = []
+        self._milestones = []
+        self._rate_sample = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _next_interval(self, snapshot):
+        """
+        Return the time [s] until the next poll.
+
+        The regular interval is shortened while a milestone is pending, so
+        that the poll lands close to the time the milestone is expected to be
+        reached, extrapolated from the observed writing rate.
+        """
+
+        with self._condition:
+            pending = [(getattr(snapshot, m.field), m.n_frames)
+                       for m in self._milestones]
+            sample, self._rate_sample = self._rate_sample, (
+                snapshot.timestamp, snapshot.n_written_frames)
+        remaining = [n_frames - value for value, n_frames in pending
+                     if n_frames > value]
+        if not remaining or sample is None or not snapshot.is_running:
+            return self.interval
+        dt = snapshot.timestamp - sample[0]
+        if dt <= 0:
+            return self.interval
+        rate = (snapshot.n_written_frames - sample[1]) / dt
+        if rate <= 0:
+            return self.interval
+        return min(self.interval, max(0.005, 0.5 * min(remaining) / rate))
+
+    def _notify(self, snapshot, previous):
+        """
+        Call the registered callbacks for a new snapshot.
+        """
+
+        callbacks = []
+        with self._condition:
+            callbacks.extend(
+                (callback, (snapshot,)) for callback in self._update_callbacks)
+            previous_status = None if previous is None else previous.status
+            if snapshot.status != previous_status:
+                callbacks.extend(
+                    (callback, (snapshot, previous_status))
+                    for callback in self._status_callbacks)
+        for callback, args in callbacks:
+            _call_safely(callback, *args)
+        self._notify_frames(snapshot)
+        self._resolve_milestones(snapshot)
+
+    def _notify_frames(self, snapshot):
+        """
+        Call (and unregister) the frame-count callbacks reached by a snapshot.
+        """
+
+        with self._condition:
+            reached = [entry for entry in self._frame_callbacks
+                       if getattr(snapshot, entry[1]) >= entry[0]]
+            self._frame_callbacks = [entry for entry in self._frame_callbacks
+                                     if entry not in reached]
+        for n_frames, field, callback in reached:
+            _call_safely(callback, snapshot)
+
+    def _resolve_milestones(self, snapshot):
+        """
+        Resolve the milestone futures reached (or missed) with a snapshot.
+        """
+
+        resolved = []
+        with self._condition:
+            pending = []
+            for milestone in self._milestones:
+                if milestone.future.cancelled():
+                    continue
+                outcome = milestone.update(snapshot)
+                if outcome is None:
+                    pending.append(milestone)
+                else:
+                    resolved.append((milestone, outcome))
+            self._milestones = pending
+        for milestone, reached in resolved:
+            if not milestone.future.set_running_or_notify_cancel():
+                continue
+            if reached:
+                milestone.future.set_result(snapshot)
+            else:
+                milestone.future.set_exception(MilestoneError(
+                    "The writer finished with {} = {} before reaching the "
+                    "milestone of {} frames.".format(
+                        milestone.field, getattr(snapshot, milestone.field),
+                        milestone.n_frames)))
+
+    def _run(self):
+        subscriber = self.writer._open_statistics_subscriber()
+        try:
+            while not self._stop_event.is_set():
+                snapshot = None
+                if subscriber is not None:
+                    # a silent stream (e.g. after the end of the run) is
+                    # checked through the REST api after the regular interval
+                    stats = subscriber.receive(
+                        min(self.interval, subscriber.timeout))
+                    if stats is not None and 'status' in stats:
+                        snapshot = WriterSnapshot(stats['status'], stats)
+                if snapshot is None:
+                    try:
+                        snapshot = self.writer._fetch_snapshot()
+                    except Exception:
+                        # keep the last snapshot while the server is
+                        # unavailable, and retry after the regular interval
+                        self._stop_event.wait(self.interval)
+                        continue
+                self._update(snapshot)
+                if subscriber is None:
+                    self._stop_event.wait(self._next_interval(snapshot))
+        finally:
+            if subscriber is not None:
+                subscriber.close()
+
+    def _update(self, snapshot):
+        with self._condition:
+            previous = self._snapshot
+            self._snapshot = snapshot
+            self._n_updates += 1
+            self._condition.notify_all()
+        self.writer._record_snapshot(snapshot)
+        self._notify(snapshot, previous)
+
+    def add_milestones(self, frame_counts, field='n_written_frames'):
+        """
+        Register frame-count milestones of the current or next run.
+
+        Each milestone is represented by a future which is resolved as soon
+        as the monitor sees the running writer reach the frame count. If the
+        writer reports the end of the run (see :data:`END_STATUSES`) before a
+        milestone is reached, its future fails with a
+        :class:`MilestoneError`. Statistics of a previous, already finished
+        run never resolve a milestone. Cancelled futures are dropped.
+
+        Parameters
+        ----------
+        frame_counts : iterable of int
+            The frame counts to register.
+        field : str, optional
+            The snapshot attribute to compare, 'n_written_frames' or
+            'n_received_frames'. (default = 'n_written_frames')
+
+        Returns
+        -------
+        futures : list of concurrent.futures.Future
+            One future per frame count, resolved with the
+            :class:`WriterSnapshot` that reached the milestone.
+
+        """
+
+        milestones = [_Milestone(n_frames, field) for n_frames in frame_counts]
+        with self._condition:
+            self._milestones.extend(milestones)
+            snapshot = self._snapshot
+        if snapshot is not None and snapshot.is_running:
+            self._resolve_milestones(snapshot)
+        return [milestone.future for milestone in milestones]
+
+    def get_snapshot(self):
+        """
+        Return the most recent snapshot of the writer.
+
+        Returns
+        -------
+        snapshot : WriterSnapshot or None
+            The latest snapshot, None if the monitor has not received any
+            statistics yet.
+
+        """
+
+        with self._condition:
+            return self._snapshot
+
+    def get_statistics(self):
+        """
+        Return the most recent statistics of the writer.
+
+        Returns
+        -------
+        stats : dict or None
+            The statistics of the latest snapshot, None if not available.
+
+        """
+
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return None
+        return snapshot.statistics
+
+    def is_alive(self):
+        """
+        Verify whether the monitor thread is running.
+        """
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def on_frames(self, n_frames, callback, field='n_written_frames'):
+        """
+        Register a callback for a frame-count threshold.
+
+        The callback is called once, with the snapshot as argument, as soon as
+        the given frame count reaches `n_frames`.
+
+        Parameters
+        ----------
+        n_frames : int
+            The frame-count threshold.
+        callback : callable
+            The function to call, `callback(snapshot)`.
+        field : str, optional
+            The snapshot attribute to compare, 'n_written_frames' or
+            'n_received_frames'. (default = 'n_written_frames')
+
+        """
+
+        with self._condition:
+            self._frame_callbacks.append((n_frames, field, callback))
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            self._notify_frames(snapshot)
+
+    def on_status_change(self, callback):
+        """
+        Register a callback for status changes of the writer.
+
+        Parameters
+        ----------
+        callback : callable
+            The function to call with the new snapshot and the previous
+            status (None for the first snapshot),
+            `callback(snapshot, previous_status)`.
+
+        """
+
+        with self._condition:
+            self._status_callbacks.append(callback)
+
+    def on_update(self, callback):
+        """
+        Register a callback for every new snapshot.
+
+        Parameters
+        ----------
+        callback : callable
+            The function to call with the new snapshot, `callback(snapshot)`.
+
+        """
+
+        with self._condition:
+            self._update_callbacks.append(callback)
+
+    def refresh(self):
+        """
+        Fetch a snapshot from the writer right away and publish it.
+
+        Returns
+        -------
+        snapshot : WriterSnapshot
+            The new snapshot.
+
+        """
+
+        snapshot = self.writer._fetch_snapshot()
+        self._update(snapshot)
+        return snapshot
+
+    def remove_callback(self, callback):
+        """
+        Unregister a callback registered with any of the on_* methods.
+        """
+
+        with self._condition:
+            self._status_callbacks = [
+                c for c in self._status_callbacks if c is not callback]
+            self._update_callbacks = [
+                c for c in self._update_callbacks if c is not callback]
+            self._frame_callbacks = [
+                e for e in self._frame_callbacks if e[2] is not callback]
+
+    def start(self):
+        """
+        Start the monitor thread.
+        """
+
+        if self.is_alive():
+            return self
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="StatisticsMonitor")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Stop the monitor thread.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time [s] to wait for the thread to finish.
+            (default = None)
+
+        """
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wait_update(self, timeout=None):
+        """
+        Wait for the next snapshot.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time [s] to wait. (default = None)
+
+        Returns
+        -------
+        snapshot : WriterSnapshot or None
+            The latest snapshot after the wait (which is the previous one if
+            no update arrived in time).
+
+        """
+
+        with self._condition:
+            n_updates = self._n_updates
+            self._condition.wait_for(
+                lambda: self._n_updates != n_updates, timeout)
+            return self._snapshot
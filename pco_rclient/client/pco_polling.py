@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Polling policies for the poll loops of the PCO writer client.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import time
+
+
+class FixedPolling(object):
+    """
+    Poll with a fixed interval per phase.
+
+    The default intervals are the ones the client has always used.
+    """
+
+    def __init__(self, start=0.15, stop=0.15, wait=0.1):
+        """
+        Initialize the policy.
+
+        Parameters
+        ----------
+        start : float, optional
+            The poll interval [s] while waiting for the writer to start.
+            (default = 0.15)
+        stop : float, optional
+            The poll interval [s] while waiting for the writer to stop.
+            (default = 0.15)
+        wait : float, optional
+            The poll interval [s] while waiting for frames or the end of the
+            run. (default = 0.1)
+
+        """
+
+        self.intervals = {'start': start, 'stop': stop, 'wait': wait}
+
+    def schedule(self, phase, target=None):
+        """
+        Create the schedule for a poll loop.
+
+        Parameters
+        ----------
+        phase : str
+            The phase of the loop, 'start', 'stop' or 'wait'.
+        target : int, optional
+            The number of written frames the loop waits for, if any.
+            (default = None)
+
+        Returns
+        -------
+        schedule : object
+            Object with a `next_interval(snapshot=None)` method returning the
+            time [s] to sleep before the next poll.
+
+        """
+
+        return _FixedSchedule(self.intervals[phase])
+
+
+class _FixedSchedule(object):
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_interval(self, snapshot=None):
+        return self.interval
+
+
+class AdaptivePolling(object):
+    """
+    Poll fast around expected transitions and back off in between.
+
+    * Right after a start or stop request, the writer is expected to change
+      its state soon: the loop polls with the minimum interval for
+      `fast_period` seconds and then backs off exponentially.
+    * While waiting for frames, the time until the target number of frames
+      (the `n_frames` of the run for :meth:`PcoWriter.wait`) is extrapolated
+      from the writing rate, and the next poll is scheduled for half of that
+      time, so the polls converge on the expected end. Without a usable
+      estimate (no target, no frames being written) the interval grows
+      exponentially, and it is reset to the minimum whenever the writer status
+      changes.
+
+    All intervals are bounded by `min_interval` and `max_interval`.
+    """
+
+    def __init__(self, min_interval=0.02, max_interval=2.0, backoff=1.5,
+                 fast_period=1.0):
+        """
+        Initialize the policy.
+
+        Parameters
+        ----------
+        min_interval : float, optional
+            The shortest poll interval [s]. (default = 0.02)
+        max_interval : float, optional
+            The longest poll interval [s]. (default = 2.0)
+        backoff : float, optional
+            The factor by which the interval grows per poll when backing off.
+            (default = 1.5)
+        fast_period : float, optional
+            The time [s] after the beginning of a start or stop loop during
+            which the minimum interval is used. (default = 1.0)
+
+        """
+
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.fast_period = fast_period
+
+    def schedule(self, phase, target=None):
+        """
+        Create the schedule for a poll loop, see :meth:`FixedPolling.schedule`.
+        """
+
+        return _AdaptiveSchedule(self, phase, target)
+
+
+class _AdaptiveSchedule(object):
+
+    def __init__(self, policy, phase, target):
+        self.policy = policy
+        self.phase = phase
+        self.target = target
+        self.t_begin = time.monotonic()
+        self.interval = policy.min_interval
+        self.last_status = None
+        self.last_sample = None
+
+    def _clamp(self, interval):
+        return min(max(interval, self.policy.min_interval),
+                   self.policy.max_interval)
+
+    def _writing_rate(self, snapshot):
+        """
+        Return the writing rate [frames/s], preferring the writer's own.
+        """
+
+        sample = (snapshot.timestamp, snapshot.n_written_frames)
+        last_sample, self.last_sample = self.last_sample, sample
+        try:
+            rate = float(snapshot.statistics.get('writing_rate', 0))
+        except (AttributeError, TypeError, ValueError):
+            rate = 0.0
+        if rate <= 0 and last_sample is not None:
+            dt = sample[0] - last_sample[0]
+            if dt > 0:
+                rate = (sample[1] - last_sample[1]) / dt
+        return rate
+
+    def next_interval(self, snapshot=None):
+        policy = self.policy
+        backed_off = self._clamp(self.interval * policy.backoff)
+        if self.phase in ('start', 'stop'):
+            if time.monotonic() - self.t_begin < policy.fast_period:
+                return policy.min_interval
+            self.interval = backed_off
+            return self.interval
+
+        if snapshot is None:
+            self.interval = backed_off
+            return self.interval
+        if snapshot.status != self.last_status:
+            # poll fast again after every status change
+            self.last_status = snapshot.status
+            self.interval = policy.min_interval
+            return self.interval
+        target = self.target or snapshot.n_frames
+        rate = self._writing_rate(snapshot)
+        if target > 0 and rate > 0:
+            remaining = max(target - snapshot.n_written_frames, 0)
+            self.interval = self._clamp(0.5 * remaining / rate)
+        else:
+            self.interval = backed_off
+        return self.interval
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Live preview of the camera stream as binned thumbnails.
+
+Usage::
+
+    python -m pco_rclient.client.pco_preview tcp://pco-camera:8080
+        --forward tcp://*:8090 --publish tcp://*:8095 [--binning 4]
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+import zmq
+
+from pco_rclient.client.pco_tap import StreamTap, decode_frame
+
+
+def bin_image(image, binning, mode='mean'):
+    """
+    Reduce the size of an image by an integer factor.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        The 2-dimensional image. Rows and columns beyond a multiple of
+        `binning` are cropped.
+    binning : int
+        The reduction factor along both axes.
+    mode : str, optional
+        'mean' averages the pixels of each bin, 'subsample' keeps the first
+        pixel of each bin (faster, but noisier). (default = 'mean')
+
+    Returns
+    -------
+    thumbnail : numpy.ndarray
+        The reduced image, with the data type of `image`.
+
+    """
+
+    if binning <= 1:
+        return image
+    n_rows = image.shape[0] // binning
+    n_columns = image.shape[1] // binning
+    if mode == 'subsample':
+        return image[:n_rows * binning:binning, :n_columns * binning:binning]
+    if mode != 'mean':
+        raise ValueError("Unknown binning mode: {}".format(mode))
+    bins = image[:n_rows * binning, :n_columns * binning].reshape(
+        n_rows, binning, n_columns, binning)
+    thumbnail = bins.mean(axis=(1, 3), dtype=np.float32)
+    if image.dtype.kind in 'ui':
+        thumbnail = np.rint(thumbnail)
+    return thumbnail.astype(image.dtype)
+
+
+class PreviewPublisher(object):
+    """
+    Publisher of binned thumbnails of the camera stream.
+
+    Register :meth:`process` as a consumer of a :class:`StreamTap`. Frames are
+    skipped cheaply (before any computation) unless they are the n-th frame
+    and the rate limit allows a new thumbnail, so the preview hardly slows
+    down the receiving thread. Thumbnails nobody receives are dropped.
+    """
+
+    def __init__(self, address, every=10, binning=4, mode='mean',
+                 max_rate=5.0, context=None):
+        """
+        Open the PUB socket.
+
+        Parameters
+        ----------
+        address : str
+            The address to bind the PUB socket to, e.g. "tcp://*:8095".
+        every : int, optional
+            Only every n-th frame is considered for the preview.
+            (default = 10)
+        binning : int, optional
+            The binning factor, see :func:`bin_image`. (default = 4)
+        mode : str, optional
+            The binning mode, see :func:`bin_image`. (default = 'mean')
+        max_rate : float, optional
+            The maximum number of thumbnails published per second. 0 for no
+            limit. (default = 5.0)
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+
+        """
+
+        self.address = address
+        self.every = max(int(every), 1)
+        self.binning = int(binning)
+        self.mode = mode
+        self.max_rate = max_rate
+        self.n_frames = 0
+        self.n_published = 0
+        self._t_published = 0.0
+
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # keep only the latest thumbnails for slow subscribers
+        self.socket.setsockopt(zmq.SNDHWM, 4)
+        self.socket.bind(address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the PUB socket.
+        """
+
+        self.socket.close()
+
+    def process(self, header, image):
+        """
+        Consider a frame for the preview.
+
+        Parameters
+        ----------
+        header : dict
+            The header of the frame.
+        image : numpy.ndarray
+            The image of the frame.
+
+        Returns
+        -------
+        published : bool
+            True if a thumbnail of the frame was published.
+
+        """
+
+        self.n_frames += 1
+        if (self.n_frames - 1) % self.every:
+            return False
+        now = time.monotonic()
+        if self.max_rate and now - self._t_published < 1.0 / self.max_rate:
+            return False
+        self._t_published = now
+        thumbnail = np.ascontiguousarray(
+            bin_image(image, self.binning, self.mode))
+        preview_header = {"frame": header.get("frame"),
+                          "shape": list(thumbnail.shape),
+                          "type": thumbnail.dtype.name,
+                          "binning": self.binning,
+                          "source_shape": list(image.shape)}
+        try:
+            self.socket.send(json.dumps(preview_header).encode(),
+                             flags=zmq.SNDMORE | zmq.NOBLOCK)
+            self.socket.send(thumbnail, copy=False)
+        except zmq.Again:
+            return False
+        self.n_published += 1
+        return True
+
+
+class PreviewSubscriber(object):
+    """
+    Receiver of the thumbnails of a :class:`PreviewPublisher`.
+    """
+
+    def __init__(self, address, context=None):
+        """
+        Connect to the preview.
+
+        Parameters
+        ----------
+        address : str
+            The address of the preview, e.g. "tcp://tap-host:8095".
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+
+        """
+
+        self.address = address
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.SUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVHWM, 4)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+        self.socket.connect(address)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Disconnect from the preview.
+        """
+
+        with self._lock:
+            self.socket.close()
+
+    def receive(self, timeout=1.0):
+        """
+        Wait for a thumbnail and return the most recent one.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time [s] to wait. (default = 1.0)
+
+        Returns
+        -------
+        preview : tuple or None
+            The header and the image of the latest thumbnail, or None if no
+            thumbnail arrived in time.
+
+        """
+
+        with self._lock:
+            if not self.socket.poll(int(timeout * 1000)):
+                return None
+            parts = self.socket.recv_multipart()
+            # skip to the latest thumbnail already received
+            while self.socket.poll(0):
+                parts = self.socket.recv_multipart()
+        if len(parts) != 2:
+            return None
+        try:
+            return decode_frame(parts[0], parts[1])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Publish binned thumbnails of the PCO camera stream.")
+    parser.add_argument('address', help="address of the camera stream")
+    parser.add_argument('--publish', default='tcp://*:8095',
+                        help="address of the preview PUB socket")
+    parser.add_argument('--forward', default=None,
+                        help="forward the stream to the writer on this "
+                             "address")
+    parser.add_argument('--every', type=int, default=10)
+    parser.add_argument('--binning', type=int, default=4)
+    parser.add_argument('--mode', choices=('mean', 'subsample'),
+                        default='mean')
+    parser.add_argument('--max-rate', type=float, default=5.0)
+    arguments = parser.parse_args()
+
+    preview = PreviewPublisher(arguments.publish, every=arguments.every,
+                               binning=arguments.binning,
+                               mode=arguments.mode,
+                               max_rate=arguments.max_rate)
+    tap = StreamTap(arguments.address, forward_address=arguments.forward)
+    tap.add_callback(preview.process)
+    tap.start()
+    print("Publishing the preview on {} (Ctrl-C to stop)".format(
+        arguments.publish))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tap.close()
+        preview.close()
+    print("{} frames received, {} thumbnails published".format(
+        tap.n_frames, preview.n_published))
+
+
+if __name__ == "__main__":
+    main()
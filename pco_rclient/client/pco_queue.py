@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""
+Queue of back-to-back acquisitions with a single PCO writer.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import re
+import threading
+import time
+
+from pco_rclient.client.pco_client import (PcoError, insert_placeholder,
+                                           validate_connection_address,
+                                           validate_dataset_name,
+                                           validate_nonneg_int_parameter,
+                                           validate_output_file)
+from pco_rclient.client.pco_core import run_steps
+from pco_rclient.client.pco_monitor import END_STATUSES
+
+
+# Configuration items of a run specification.
+RUN_SPEC_FIELDS = ('output_file', 'dataset_name', 'n_frames',
+                   'connection_address', 'user_id', 'max_frames_per_file')
+
+
+def validate_run_spec(spec, defaults):
+    """
+    Validate a run specification and resolve its configuration.
+
+    Parameters
+    ----------
+    spec : dict
+        The configuration items of the run, see :data:`RUN_SPEC_FIELDS`.
+    defaults : dict
+        The configuration items used where `spec` has none.
+
+    Returns
+    -------
+    configuration : dict
+        The complete configuration of the run. A file number placeholder is
+        inserted into the output file, as :meth:`PcoWriter.configure` does,
+        if the frames are distributed over several files.
+
+    Raises
+    ------
+    PcoError
+        If the specification holds an unknown or invalid item.
+
+    """
+
+    unknown = set(spec) - set(RUN_SPEC_FIELDS)
+    if unknown:
+        raise PcoError("Unknown run configuration items: {}".format(
+            ", ".join(sorted(unknown))))
+    configuration = dict(defaults)
+    configuration.update(spec)
+    configuration['output_file'] = validate_output_file(
+        configuration['output_file'], 'output_file')
+    configuration['dataset_name'] = validate_dataset_name(
+        configuration['dataset_name'], 'dataset_name')
+    configuration['connection_address'] = validate_connection_address(
+        configuration['connection_address'], 'connection_address')
+    for field in ('n_frames', 'user_id', 'max_frames_per_file'):
+        configuration[field] = validate_nonneg_int_parameter(
+            configuration[field], field)
+    output_file = configuration['output_file']
+    if (configuration['max_frames_per_file'] <= configuration['n_frames'] and
+            not re.search(r'%(\d|)+d', output_file)):
+        configuration['output_file'] = insert_placeholder(
+            output_file, len(output_file) - 3)
+    return configuration
+
+
+class RunRecord(object):
+    """
+    Configuration, timing and outcome of a run of an :class:`AcquisitionQueue`.
+
+    Attributes
+    ----------
+    index : int
+        The position of the run in the queue.
+    configuration : dict
+        The validated configuration of the run.
+    status : str
+        'pending', 'running', the final status reported by the writer (e.g.
+        'finished'), 'failed' or 'cancelled'.
+    t_start, t_running, t_finished : float or None
+        The times (time.monotonic) the start request was sent, the writer
+        reported running, and the writer reported the end of the run.
+    dead_time : float or None
+        The time [s] from the end of the previous run to this run running.
+    n_written_frames : int or None
+        The number of frames written, as last reported by the writer.
+    error : Exception or None
+        The error that failed the run.
+
+    """
+
+    def __init__(self, index, configuration):
+        self.index = index
+        self.configuration = configuration
+        self.status = 'pending'
+        self.t_start = None
+        self.t_running = None
+        self.t_finished = None
+        self.dead_time = None
+        self.n_written_frames = None
+        self.error = None
+
+    def __repr__(self):
+        return ("RunRecord(index={}, dataset_name={!r}, status={!r}, "
+                "dead_time={})".format(
+                    self.index, self.configuration['dataset_name'],
+                    self.status, self.dead_time))
+
+    @property
+    def duration(self):
+        """
+        The time [s] from the start request to the end of the run.
+        """
+
+        if self.t_start is None or self.t_finished is None:
+            return None
+        return self.t_finished - self.t_start
+
+
+class AcquisitionQueue(object):
+    """
+    Back-to-back runs of a PCO writer.
+
+    The runs are executed by :meth:`run` (or in a background thread by
+    :meth:`start`). For every run, the writer is configured and started, and
+    its end is awaited on the statistics stream or monitor of the writer if
+    available, otherwise by polling according to the writer's polling policy.
+    When the current run has received all its frames (status 'writing' with
+    all the frames received, or the end of the run), the next run is
+    prepared; the background flush of the camera stream started then is
+    cancelled by the next start.
+    """
+
+    def __init__(self, writer, runs, flush_timeout=500, start_timeout=10,
+                 stop_on_error=True, verbose=False):
+        """
+        Validate the runs.
+
+        Parameters
+        ----------
+        writer : PcoWriter
+            The writer executing the runs.
+        runs : list of dict
+            The run specifications, each holding configuration items (see
+            :data:`RUN_SPEC_FIELDS`). Items not given are taken from the
+            previous run, or from the writer's configuration for the first
+            run.
+        flush_timeout : float, optional
+            The inactivity timeout [ms] of the stream flushes, see
+            :meth:`PcoWriter.flush_cam_stream`. 0 disables the flushes.
+            (default = 500)
+        start_timeout : float, optional
+            The maximum time [s] to wait for each run to start.
+            (default = 10)
+        stop_on_error : bool, optional
+            Cancel the remaining runs if a run fails. (default = True)
+        verbose : bool, optional
+            Print a line at the start and at the end of every run.
+            (default = False)
+
+        Raises
+        ------
+        PcoError
+            If a run specification is invalid.
+
+        """
+
+        self.writer = writer
+        self.flush_timeout = flush_timeout
+        self.start_timeout = start_timeout
+        self.stop_on_error = stop_on_error
+        self.verbose = verbose
+
+        defaults = {field: getattr(writer, field) for field in RUN_SPEC_FIELDS}
+        self.runs = []
+        for index, spec in enumerate(runs):
+            try:
+                configuration = validate_run_spec(spec, defaults)
+            except PcoError as e:
+                raise PcoError("Problem with run {} of the queue: "
+                               "{!r}".format(index, spec)) from e
+            self.runs.append(RunRecord(index, configuration))
+            defaults = dict(defaults, **spec)
+
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def _execute(self, record, previous, next_record):
+        """
+        Start a run, prepare the next one while it finishes, and wait for
+        its end.
+        """
+
+        writer = self.writer
+        if writer.configure(**record.configuration) is None:
+            raise PcoError("The writer could not be configured, a writer "
+                           "process is running.")
+        record.t_start = time.monotonic()
+        response = writer.start(wait=True, timeout=self.start_timeout)
+        if not (response and response.get('success')):
+            raise PcoError("The writer did not start: {}".format(response))
+        record.t_running = time.monotonic()
+        record.status = 'running'
+        if previous is not None and previous.t_finished is not None:
+            record.dead_time = record.t_running - previous.t_finished
+        if self.verbose:
+            print("Run {} started: {} ({} frames)".format(
+                record.index, record.configuration['dataset_name'],
+                record.configuration['n_frames']))
+        snapshot = run_steps(self._wait_steps(record, next_record))
+        record.t_finished = time.monotonic()
+        record.status = snapshot.status
+        if self.verbose:
+            print("Run {} {}: {} frames written".format(
+                record.index, record.status, record.n_written_frames))
+        if record.status != 'finished':
+            raise PcoError("The writer ended the run with the status "
+                           "'{}'.".format(record.status))
+
+    def _prepare(self, record):
+        """
+        Prepare the next run while the current one writes its last frames.
+        """
+
+        if not self.writer.is_connected():
+            return
+        if self.flush_timeout > 0:
+            # flush_cam_stream() refuses to flush while the writer runs
+            self.writer._flush_in_background(self.flush_timeout)
+
+    def _wait_steps(self, record, next_record):
+        writer = self.writer
+        n_frames = record.configuration['n_frames']
+        snapshot = yield from writer._get_snapshot_steps()
+        subscriber = writer._open_statistics_subscriber()
+        schedule = writer.polling_policy.schedule('wait')
+        prepared = next_record is None
+        try:
+            while snapshot.is_running:
+                if snapshot.statistics:
+                    record.n_written_frames = snapshot.n_written_frames
+                # a flush started before the last frame would receive it
+                if (not prepared and snapshot.status == 'writing' and
+                        snapshot.statistics and n_frames > 0 and
+                        snapshot.n_received_frames >= n_frames):
+                    prepared = True
+                    self._prepare(next_record)
+                snapshot = yield from writer._next_snapshot_steps(
+                    subscriber, schedule.next_interval(snapshot))
+        finally:
+            if subscriber is not None:
+                subscriber.close()
+        if snapshot.statistics:
+            record.n_written_frames = snapshot.n_written_frames
+        if not prepared and snapshot.status in END_STATUSES:
+            self._prepare(next_record)
+        return snapshot
+
+    def cancel(self):
+        """
+        Cancel the runs not started yet. The current run is completed.
+        """
+
+        self._cancelled.set()
+
+    def get_summary(self):
+        """
+        Return the timing of the runs.
+
+        Returns
+        -------
+        summary : dict
+            The number of runs "n_runs" and of "n_finished" runs, the
+            "dead_times" [s] between consecutive runs with their "mean_dead_time"
+            and "max_dead_time", and the "total_time" [s] from the first start
+            request to the end of the last run.
+
+        """
+
+        dead_times = [record.dead_time for record in self.runs
+                      if record.dead_time is not None]
+        started = [record for record in self.runs
+                   if record.t_start is not None]
+        finished = [record for record in self.runs
+                    if record.t_finished is not None]
+        total_time = None
+        if started and finished:
+            total_time = finished[-1].t_finished - started[0].t_start
+        return {"n_runs": len(self.runs),
+                "n_finished": sum(record.status == 'finished'
+                                  for record in self.runs),
+                "dead_times": dead_times,
+                "mean_dead_time": (sum(dead_times) / len(dead_times)
+                                   if dead_times else None),
+                "max_dead_time": max(dead_times) if dead_times else None,
+                "total_time": total_time}
+
+    def join(self, timeout=None):
+        """
+        Wait for the runs started by :meth:`start`.
+
+        Returns
+        -------
+        done : bool
+            True if the queue has completed.
+
+        """
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def run(self):
+        """
+        Execute the runs.
+
+        Returns
+        -------
+        runs : list of RunRecord
+            The records of the runs.
+
+        """
+
+        if self.flush_timeout > 0:
+            self.writer.flush_cam_stream(timeout=self.flush_timeout)
+        previous = None
+        for index, record in enumerate(self.runs):
+            if self._cancelled.is_set():
+                record.status = 'cancelled'
+                continue
+            next_record = None
+            if index + 1 < len(self.runs):
+                next_record = self.runs[index + 1]
+            try:
+                self._execute(record, previous, next_record)
+            except Exception as e:
+                record.error = e
+                if record.status in ('pending', 'running'):
+                    record.status = 'failed'
+                if self.verbose:
+                    print("Run {} failed: {}".format(record.index, e))
+                if self.stop_on_error:
+                    self._cancelled.set()
+            previous = record
+        return self.runs
+
+    def start(self):
+        """
+        Execute the runs in a background thread, see :meth:`run`.
+
+        Returns
+        -------
+        queue : AcquisitionQueue
+            The queue itself.
+
+        """
+
+        self._cancelled.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
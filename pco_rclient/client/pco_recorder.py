@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Recorder of the writer statistics of a run to a .npy file.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import os
+import re
+import struct
+import threading
+
+import numpy as np
+
+
+# Fields of the recorded samples.
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'),
+                         ('receiving_rate', '<f4'),
+                         ('writing_rate', '<f4'),
+                         ('n_received_frames', '<i8'),
+                         ('n_written_frames', '<i8'),
+                         ('n_lost_frames', '<i8')])
+
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+_NPY_HEADER_TEMPLATE = ("{{'descr': {!r}, 'fortran_order': False, "
+                        "'shape': ({:d},), }}")
+
+
+def _npy_header(n_samples, dtype=RECORD_DTYPE):
+    """
+    Return the .npy (version 1.0) header of a recording of `n_samples`.
+
+    The header is padded to a fixed size, large enough for any sample count,
+    so it can be rewritten in place whenever samples are appended.
+    """
+
+    descr = np.lib.format.dtype_to_descr(dtype)
+    longest = _NPY_HEADER_TEMPLATE.format(descr, 2**63 - 1)
+    # magic, header length and the terminating newline; aligned to 64 bytes
+    size = -(-(len(_NPY_MAGIC) + 2 + len(longest) + 1) // 64) * 64
+    header_len = size - len(_NPY_MAGIC) - 2
+    header = _NPY_HEADER_TEMPLATE.format(descr, n_samples)
+    header = header.ljust(header_len - 1) + '\n'
+    return _NPY_MAGIC + struct.pack('<H', header_len) + header.encode('latin1')
+
+
+def get_record_path(output_file, directory=None):
+    """
+    Return the default path of the statistics recording of an output file.
+
+    The output file is written by the server, whereas the recording is
+    written by the client: it is placed in a local directory and named after
+    the output file without its file number placeholder, e.g.
+    "/data/scan_%03d.h5" is recorded to "scan_statistics.npy".
+
+    Parameters
+    ----------
+    output_file : str
+        The output file of the writer.
+    directory : str, optional
+        The local directory of the recording. If None, the current working
+        directory is used. (default = None)
+
+    Returns
+    -------
+    path : str
+        The path of the recording.
+
+    """
+
+    name = os.path.basename(os.path.splitext(output_file)[0])
+    name = re.sub(r'_?%(\d|)+d', '', name) + '_statistics.npy'
+    return os.path.join(directory or os.getcwd(), name)
+
+
+def get_run_record_path(path, run_id):
+    """
+    Return the path of the statistics recording of a run.
+
+    The run number is inserted before the extension, e.g. the first run
+    recorded to "/tmp/stats.npy" is recorded to "/tmp/stats_001.npy", so
+    every run has its own recording.
+
+    Parameters
+    ----------
+    path : str
+        The path of the recordings.
+    run_id : int
+        The number of the run.
+
+    Returns
+    -------
+    path : str
+        The path of the recording of the run.
+
+    """
+
+    base, ext = os.path.splitext(path)
+    return "{}_{:03d}{}".format(base, run_id, ext or '.npy')
+
+
+class StatisticsRecorder(object):
+    """
+    Append-only recorder of the statistics samples of one run.
+
+    Samples are collected in a preallocated buffer of `buffer_size` rows,
+    which is appended to the file whenever it is full, on :meth:`flush` and
+    on :meth:`close`. The memory used by the recorder is therefore bounded,
+    independently of the length of the run. After each write the .npy header
+    is updated in place with the number of samples in the file, so a
+    recording can be loaded while the run is still going on.
+    """
+
+    def __init__(self, path, buffer_size=1024):
+        """
+        Initialize the recorder. The file is created with the first write.
+
+        Parameters
+        ----------
+        path : str
+            The path of the .npy file. An existing file is overwritten.
+        buffer_size : int, optional
+            The number of samples kept in memory before they are appended to
+            the file. (default = 1024)
+
+        """
+
+        self.path = path
+        self.n_samples = 0
+        self._buffer = np.zeros(max(int(buffer_size), 1), dtype=RECORD_DTYPE)
+        self._n_buffered = 0
+        self._last_timestamp = None
+        self._recording = False
+        self._file = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_buffer(self):
+        """
+        Append the buffered samples to the file and update its header.
+        """
+
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+            self._file.write(_npy_header(0))
+        if self._n_buffered:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(self._buffer[:self._n_buffered].tobytes())
+            self.n_samples += self._n_buffered
+            self._n_buffered = 0
+            self._file.seek(0)
+            self._file.write(_npy_header(self.n_samples))
+        self._file.flush()
+
+    def add_sample(self, timestamp, statistics):
+        """
+        Record a statistics sample.
+
+        Samples that are not newer than the last recorded sample are ignored.
+
+        Parameters
+        ----------
+        timestamp : float
+            The time of the sample (seconds since the epoch).
+        statistics : dict
+            The statistics of the writer. Missing fields are recorded as 0.
+
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+            if (self._last_timestamp is not None and
+                    timestamp <= self._last_timestamp):
+                return
+            self._last_timestamp = timestamp
+            row = self._buffer[self._n_buffered]
+            row['timestamp'] = timestamp
+            for field in RECORD_DTYPE.names[1:]:
+                try:
+                    row[field] = statistics.get(field, 0) or 0
+                except (TypeError, ValueError):
+                    row[field] = 0
+            self._n_buffered += 1
+            if self._n_buffered == len(self._buffer):
+                self._write_buffer()
+
+    def add_snapshot(self, snapshot):
+        """
+        Record a snapshot of the writer.
+
+        Snapshots of the running writer are recorded. The first snapshot of
+        the stopped writer after a recorded one holds the final counts of the
+        run: it is recorded as well and the recorder is closed.
+
+        Parameters
+        ----------
+        snapshot : WriterSnapshot
+            The snapshot to record.
+
+        """
+
+        if snapshot.statistics is None:
+            return
+        if snapshot.is_running:
+            self._recording = True
+            self.add_sample(snapshot.timestamp, snapshot.statistics)
+        elif self._recording:
+            self.add_sample(snapshot.timestamp, snapshot.statistics)
+            self.close()
+
+    def close(self):
+        """
+        Write the remaining samples and close the file.
+        """
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._n_buffered or self._file is not None:
+                self._write_buffer()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def flush(self):
+        """
+        Append the buffered samples to the file.
+        """
+
+        with self._lock:
+            if not self._closed:
+                self._write_buffer()
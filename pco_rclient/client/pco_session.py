@@ -0,0 +1,677 @@
+# -*- coding: utf-8 -*-
+"""
+Pooled HTTP connections to the PCO writer servers.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Default timeouts [s] per route name (see ROUTES in pco_client). Routes not
+# listed here use the session's default timeout.
+DEFAULT_ROUTE_TIMEOUTS = {
+    "ack": 3,
+    "finished": 3,
+    "kill": 10,
+    "server_log": 10,
+    "server_uptime": 3,
+    "start_pco": 10,
+    "statistics": 3,
+    "status": 3,
+    "stop": 10,
+}
+
+# Routes keeping their configured timeouts: a slow answer must not be
+# mistaken for a failed request when it changes the writer state, or when the
+# writer is busy (status and statistics are slow while it flushes its data).
+FIXED_TIMEOUT_ROUTES = ('kill', 'start_pco', 'statistics', 'status', 'stop')
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    A request refused without being sent, as its server is unreachable.
+
+    Derived from :class:`requests.ConnectionError`, so callers handle it like
+    any other failed connection.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of a server endpoint.
+
+    The circuit opens after `failure_threshold` consecutive failed requests.
+    While it is open, requests fail immediately with a
+    :class:`CircuitOpenError`. After `reset_timeout` seconds the circuit is
+    half-open: a single request is let through as a probe, and the circuit
+    closes if the probe succeeds, or opens again for twice as long (up to
+    `max_reset_timeout`) if it fails.
+
+    Attributes
+    ----------
+    state : str
+        'closed', 'open' or 'half_open'.
+    n_failures : int
+        The number of consecutive failures.
+    n_rejected : int
+        The number of requests refused while the circuit was open.
+
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=5.0,
+                 max_reset_timeout=60.0):
+        """
+        Initialize a closed circuit.
+
+        Parameters
+        ----------
+        failure_threshold : int, optional
+            The number of consecutive failures opening the circuit.
+            (default = 3)
+        reset_timeout : float, optional
+            The time [s] after which an open circuit lets a probe through.
+            (default = 5.0)
+        max_reset_timeout : float, optional
+            The limit [s] of the reset timeout after failed probes.
+            (default = 60.0)
+
+        """
+
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.reset_timeout = float(reset_timeout)
+        self.max_reset_timeout = float(max_reset_timeout)
+        self.state = 'closed'
+        self.n_failures = 0
+        self.n_rejected = 0
+        self._retry_time = 0.0
+        self._current_reset_timeout = self.reset_timeout
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self.state = 'open'
+        self._probing = False
+        self._retry_time = time.monotonic() + self._current_reset_timeout
+
+    def _reopen(self):
+        self._current_reset_timeout = min(
+            2 * self._current_reset_timeout, self.max_reset_timeout)
+        self._open()
+
+    def before_request(self, address=''):
+        """
+        Check whether a request may be sent.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open, or half-open with a probe in progress.
+
+        """
+
+        with self._lock:
+            if self.state == 'closed':
+                return
+            remaining = self._retry_time - time.monotonic()
+            if self.state == 'open' and remaining <= 0:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return
+            self.n_rejected += 1
+            raise CircuitOpenError(
+                "The server {} is not responding ({} failed requests), "
+                "retrying in {:.1f} s.".format(address, self.n_failures,
+                                               max(remaining, 0.0)))
+
+    def get_info(self):
+        """
+        Return the state of the circuit.
+
+        Returns
+        -------
+        info : dict
+            The "state", the number of consecutive "n_failures" and of
+            "n_rejected" requests, and the current "reset_timeout" [s].
+
+        """
+
+        with self._lock:
+            return {"state": self.state, "n_failures": self.n_failures,
+                    "n_rejected": self.n_rejected,
+                    "reset_timeout": self._current_reset_timeout}
+
+    def record_failure(self):
+        """
+        Record a failed request.
+        """
+
+        with self._lock:
+            self.n_failures += 1
+            if self.state == 'half_open':
+                self._reopen()
+            elif (self.state == 'closed' and
+                    self.n_failures >= self.failure_threshold):
+                self._open()
+
+    def record_refused(self):
+        """
+        Record a refused connection.
+
+        A refused probe opens the circuit again; otherwise the circuit is
+        left as it is, a refused connection being fast.
+        """
+
+        with self._lock:
+            if self.state == 'half_open':
+                self.n_failures += 1
+                self._reopen()
+
+    def record_success(self):
+        """
+        Record a successful request, closing the circuit.
+        """
+
+        with self._lock:
+            self.state = 'closed'
+            self.n_failures = 0
+            self._probing = False
+            self._current_reset_timeout = self.reset_timeout
+
+    def release(self):
+        """
+        Let another probe through after a request was interrupted.
+        """
+
+        with self._lock:
+            self._probing = False
+
+    def reset(self):
+        """
+        Close the circuit and forget the failures.
+        """
+
+        self.record_success()
+
+
+class RttEstimator(object):
+    """
+    Round-trip time estimate of a route, giving an adaptive timeout.
+
+    The smoothed round-trip time and its mean deviation are updated with
+    every response, as TCP does for its retransmission timeout (RFC 6298):
+    the timeout is ``srtt + 4 * rttvar``, bounded by `min_timeout` and the
+    configured timeout of the route. Each timed-out request doubles the
+    timeout (up to the configured one) until the next response arrives.
+    """
+
+    def __init__(self, min_timeout=1.0):
+        """
+        Initialize an estimator without samples.
+
+        Parameters
+        ----------
+        min_timeout : float, optional
+            The lower bound [s] of the adaptive timeout. (default = 1.0)
+
+        """
+
+        self.min_timeout = float(min_timeout)
+        self.srtt = None
+        self.rttvar = None
+        self.n_samples = 0
+        self._backoff = 1.0
+        self._lock = threading.Lock()
+
+    def add_sample(self, rtt):
+        """
+        Update the estimate with the round-trip time [s] of a response.
+        """
+
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2.0
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.n_samples += 1
+            self._backoff = 1.0
+
+    def backoff(self):
+        """
+        Double the timeout after a timed-out request.
+        """
+
+        with self._lock:
+            self._backoff = min(2 * self._backoff, 64.0)
+
+    def get_timeout(self, max_timeout):
+        """
+        Return the adaptive timeout [s].
+
+        Parameters
+        ----------
+        max_timeout : float or None
+            The configured timeout of the route, returned as long as no
+            round-trip time has been observed. None for no upper bound.
+
+        """
+
+        with self._lock:
+            if self.srtt is None:
+                return max_timeout
+            timeout = max(self.srtt + 4 * self.rttvar, self.min_timeout)
+            timeout *= self._backoff
+        if max_timeout is not None:
+            timeout = min(timeout, max_timeout)
+        return timeout
+
+
+class _Flight(object):
+    """
+    A request in progress, shared by all callers asking for the same key.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache(object):
+    """
+    Time-to-live cache with single-flight request coalescing.
+
+    A value fetched for a key is reused for `ttl` seconds. While a value is
+    being fetched, other threads asking for the same key wait for that fetch
+    instead of sending an identical request themselves. Errors are passed on
+    to all waiting callers but never cached.
+
+    Attributes
+    ----------
+    hits : int
+        Number of values served from the cache.
+    misses : int
+        Number of values that had to be fetched.
+    coalesced : int
+        Number of callers that waited for a fetch already in progress.
+
+    """
+
+    def __init__(self, ttl=0.0):
+        """
+        Initialize the cache.
+
+        Parameters
+        ----------
+        ttl : float, optional
+            The time [s] for which a fetched value stays valid. The cache is
+            disabled for values <= 0. (default = 0.0)
+
+        """
+
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = {}
+        self._flights = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """
+        Return the cached value for a key, fetching it if necessary.
+
+        Parameters
+        ----------
+        key : hashable
+            The cache key, e.g. the server address and route name.
+        fetch : callable
+            Function called without arguments to fetch the value.
+
+        Returns
+        -------
+        value : object
+            The cached or freshly fetched value.
+
+        """
+
+        if self.ttl <= 0:
+            return fetch()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                generation = self._generation
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = fetch()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                # a value fetched across an invalidation may be outdated
+                if (flight.error is None and
+                        generation == self._generation):
+                    self._entries[key] = (time.monotonic() + self.ttl,
+                                          flight.value)
+            flight.event.set()
+        return flight.value
+
+    def get_info(self):
+        """
+        Return the cache counters.
+
+        Returns
+        -------
+        info : dict
+            The number of "hits", "misses" and "coalesced" requests, and the
+            "ttl" [s].
+
+        """
+
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "coalesced": self.coalesced, "ttl": self.ttl}
+
+    def invalidate(self):
+        """
+        Discard all cached values.
+
+        Fetches in progress are still delivered to the callers already waiting
+        for them, but their values are not cached, and later callers start a
+        new fetch.
+
+        """
+
+        with self._lock:
+            self._entries = {}
+            self._flights = {}
+            self._generation += 1
+
+
+class PcoSession(object):
+    """
+    Keep-alive HTTP connection pools shared by the PCO writer clients.
+
+    One :class:`requests.Session` with its own connection pool is created per
+    server base address (e.g. the flask and the writer api address), so that
+    successive requests to the same server reuse an open TCP connection
+    instead of establishing a new one for every call.
+
+    A single PcoSession can be shared by several client objects talking to the
+    same servers.
+
+    Requests to a server that timed out `failure_threshold` times in a row
+    fail immediately with a :class:`CircuitOpenError` (a
+    :class:`requests.ConnectionError`) until a probe request gets through,
+    see :class:`CircuitBreaker`. Only timeouts count as failures: a refused
+    connection (e.g. the writer api without a running writer) is already
+    fast, but it keeps an open circuit open. With `adaptive_timeouts`, the timeout of each request is derived
+    from the round-trip times observed for its server and route, the
+    configured timeouts being the upper bounds, see :class:`RttEstimator`;
+    the routes changing the writer state and the status and statistics
+    routes (:data:`FIXED_TIMEOUT_ROUTES`) keep their configured timeouts.
+
+    """
+
+    def __init__(self, pool_maxsize=4, keep_alive=True, timeout=10.0,
+                 route_timeouts=None, adaptive_timeouts=True,
+                 min_timeout=1.0, failure_threshold=3, reset_timeout=5.0):
+        """
+        Initialize the session.
+
+        Parameters
+        ----------
+        pool_maxsize : int, optional
+            The maximum number of connections kept open per server.
+            (default = 4)
+        keep_alive : bool, optional
+            Keep connections open between requests. If False, every request
+            asks the server to close the connection after the response.
+            (default = True)
+        timeout : float or None, optional
+            The timeout [s] for routes without a specific entry in
+            `route_timeouts`. None waits forever. (default = 10.0)
+        route_timeouts : dict, optional
+            Timeouts [s] per route name, updating
+            :data:`DEFAULT_ROUTE_TIMEOUTS`. (default = None)
+        adaptive_timeouts : bool, optional
+            Shorten the timeouts according to the observed round-trip times,
+            except for the :data:`FIXED_TIMEOUT_ROUTES`. (default = True)
+        min_timeout : float, optional
+            The lower bound [s] of the adaptive timeouts. (default = 1.0)
+        failure_threshold : int, optional
+            The number of consecutive timeouts opening the circuit of a
+            server. (default = 3)
+        reset_timeout : float, optional
+            The time [s] before an open circuit lets a probe request through.
+            (default = 5.0)
+
+        """
+
+        self.pool_maxsize = int(pool_maxsize)
+        self.keep_alive = bool(keep_alive)
+        self.timeout = timeout
+        self.route_timeouts = dict(DEFAULT_ROUTE_TIMEOUTS)
+        if route_timeouts:
+            self.route_timeouts.update(route_timeouts)
+        self.adaptive_timeouts = bool(adaptive_timeouts)
+        self.min_timeout = float(min_timeout)
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+        self._breakers = {}
+        self._estimators = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
+
+    def get(self, address, path, route=None, **kwargs):
+        """
+        Send a GET request, see :meth:`request`.
+        """
+
+        return self.request('GET', address, path, route=route, **kwargs)
+
+    def get_breaker(self, address):
+        """
+        Return the :class:`CircuitBreaker` of a server address.
+        """
+
+        address = address.rstrip('/')
+        with self._lock:
+            breaker = self._breakers.get(address)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold,
+                                         self.reset_timeout)
+                self._breakers[address] = breaker
+        return breaker
+
+    def get_endpoint_info(self):
+        """
+        Return the state of the circuits and the round-trip time estimates.
+
+        Returns
+        -------
+        info : dict
+            For every server address, the state of its circuit (see
+            :meth:`CircuitBreaker.get_info`) and, under "routes", the smoothed
+            round-trip time "srtt" [s] and current "timeout" [s] per route.
+
+        """
+
+        with self._lock:
+            breakers = dict(self._breakers)
+            estimators = dict(self._estimators)
+        info = {}
+        for address, breaker in breakers.items():
+            info[address] = breaker.get_info()
+            info[address]["routes"] = {}
+        for (address, route), estimator in estimators.items():
+            entry = info.setdefault(address, {"routes": {}})
+            timeout = self.get_timeout(route)
+            if route not in FIXED_TIMEOUT_ROUTES:
+                timeout = estimator.get_timeout(timeout)
+            entry["routes"][route] = {"srtt": estimator.srtt,
+                                      "timeout": timeout}
+        return info
+
+    def get_estimator(self, address, route):
+        """
+        Return the :class:`RttEstimator` of a route of a server address.
+        """
+
+        key = (address.rstrip('/'), route)
+        with self._lock:
+            estimator = self._estimators.get(key)
+            if estimator is None:
+                estimator = RttEstimator(self.min_timeout)
+                self._estimators[key] = estimator
+        return estimator
+
+    def get_session(self, address):
+        """
+        Return the pooled :class:`requests.Session` for a server address.
+
+        Parameters
+        ----------
+        address : str
+            The server base address, e.g. "http://xbl-daq-32:9901".
+
+        Returns
+        -------
+        session : requests.Session
+            The session holding the connection pool for that server.
+
+        """
+
+        address = address.rstrip('/')
+        with self._lock:
+            session = self._sessions.get(address)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self._sessions[address] = session
+        return session
+
+    def get_timeout(self, route):
+        """
+        Return the timeout [s] configured for a route name.
+        """
+
+        return self.route_timeouts.get(route, self.timeout)
+
+    def post(self, address, path, route=None, **kwargs):
+        """
+        Send a POST request, see :meth:`request`.
+        """
+
+        return self.request('POST', address, path, route=route, **kwargs)
+
+    def request(self, method, address, path, route=None, **kwargs):
+        """
+        Send a request through the connection pool of a server.
+
+        Parameters
+        ----------
+        method : str
+            The HTTP method, e.g. 'GET'.
+        address : str
+            The server base address, e.g. "http://xbl-daq-32:9901".
+        path : str
+            The request path, e.g. "/status".
+        route : str, optional
+            The route name used to look up the timeout. If a `timeout`
+            keyword argument is given, it takes precedence.
+            (default = None)
+        **kwargs
+            Passed on to :meth:`requests.Session.request`.
+
+        Returns
+        -------
+        response : requests.Response
+            The server response.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit of the server is open.
+
+        """
+
+        breaker = self.get_breaker(address)
+        breaker.before_request(address)
+        estimator = self.get_estimator(address, route)
+        if 'timeout' not in kwargs:
+            timeout = self.get_timeout(route)
+            if (self.adaptive_timeouts and
+                    route not in FIXED_TIMEOUT_ROUTES):
+                timeout = estimator.get_timeout(timeout)
+            kwargs['timeout'] = timeout
+        session = self.get_session(address)
+        t_start = time.monotonic()
+        try:
+            response = session.request(method, address.rstrip('/') + path,
+                                       **kwargs)
+        except requests.Timeout:
+            estimator.backoff()
+            breaker.record_failure()
+            raise
+        except requests.ConnectionError:
+            breaker.record_refused()
+            raise
+        except BaseException:
+            # e.g. an invalid request or an interrupt, which says nothing
+            # about the server
+            breaker.release()
+            raise
+        estimator.add_sample(time.monotonic() - t_start)
+        breaker.record_success()
+        return response
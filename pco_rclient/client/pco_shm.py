@@ -0,0 +1,621 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory ring buffer of the camera stream for local consumers.
+
+Usage::
+
+    python -m pco_rclient.client.pco_shm tcp://pco-camera:8080 pco_ring
+        [--slots 16] [--slot-size 8388608]
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import argparse
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import zmq
+
+
+# Header of the ring, at the start of the shared memory.
+RING_HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                              ('n_slots', '<u8'),
+                              ('slot_size', '<u8'),
+                              ('header_capacity', '<u8'),
+                              ('write_seq', '<u8'),
+                              ('closed', '<u8')])
+
+# Description of the frame held by a slot, in front of its header and data.
+# `seq` is 0 while the slot is being written.
+SLOT_DTYPE = np.dtype([('seq', '<u8'),
+                       ('frame_id', '<i8'),
+                       ('timestamp', '<f8'),
+                       ('header_size', '<u8'),
+                       ('data_size', '<u8')])
+
+RING_MAGIC = b'PCORING1'
+
+_PAGE_SIZE = 4096
+_SLOT_META_SIZE = 64
+
+
+def _align(offset, alignment):
+    return -(-offset // alignment) * alignment
+
+
+def get_ring_path(name):
+    """
+    Return the path of the shared memory of the ring `name`.
+
+    The ring lives in /dev/shm (POSIX shared memory on Linux), or in the
+    temporary directory where /dev/shm does not exist.
+    """
+
+    directory = '/dev/shm'
+    if not os.path.isdir(directory):
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+class FrameRing(object):
+    """
+    Ring of frame slots in shared memory.
+
+    The memory starts with a page holding the :data:`RING_HEADER_DTYPE`
+    header, followed by `n_slots` page-aligned slots. A slot holds the
+    :data:`SLOT_DTYPE` description of its frame, the raw JSON header and the
+    raw image data. Frame `seq` (counted from 1) is stored in slot
+    ``(seq - 1) % n_slots``. The sequence number of the slot is cleared while
+    the slot is rewritten and set once the frame is complete, so a reader
+    detects a frame overwritten while it was reading it.
+    """
+
+    def __init__(self, name, n_slots=None, slot_size=None,
+                 header_capacity=1024, create=False):
+        """
+        Create or open a ring.
+
+        Parameters
+        ----------
+        name : str
+            The name of the ring, see :func:`get_ring_path`.
+        n_slots : int, optional
+            The number of slots of a new ring. (default = 16)
+        slot_size : int, optional
+            The maximum image size [bytes] of a new ring.
+            (default = 8 MiB, a 2048x2048 uint16 frame)
+        header_capacity : int, optional
+            The maximum header size [bytes] of a new ring. (default = 1024)
+        create : bool, optional
+            Create the ring, replacing an existing one, instead of opening an
+            existing ring read-only. (default = False)
+
+        Raises
+        ------
+        ValueError
+            If the shared memory opened is not a ring.
+
+        """
+
+        self.name = name
+        self.path = get_ring_path(name)
+        self.writable = create
+        if create:
+            n_slots = int(n_slots or 16)
+            slot_size = int(slot_size or 2048 * 2048 * 2)
+            header_capacity = int(header_capacity)
+            stride = (_align(_SLOT_META_SIZE + header_capacity, 64) +
+                      _align(slot_size, _PAGE_SIZE))
+            stride = _align(stride, _PAGE_SIZE)
+            with open(self.path, 'w+b') as ring_file:
+                ring_file.truncate(_PAGE_SIZE + n_slots * stride)
+                self._mmap = mmap.mmap(ring_file.fileno(), 0)
+            self.header = np.ndarray((), RING_HEADER_DTYPE, buffer=self._mmap)
+            self.header['n_slots'] = n_slots
+            self.header['slot_size'] = slot_size
+            self.header['header_capacity'] = header_capacity
+            self.header['write_seq'] = 0
+            self.header['closed'] = 0
+            self.header['magic'] = RING_MAGIC
+        else:
+            with open(self.path, 'rb') as ring_file:
+                self._mmap = mmap.mmap(ring_file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            self.header = np.ndarray((), RING_HEADER_DTYPE, buffer=self._mmap)
+            if self.header['magic'] != RING_MAGIC:
+                self._mmap.close()
+                raise ValueError("Not a frame ring: {}".format(self.path))
+
+        self.n_slots = int(self.header['n_slots'])
+        self.slot_size = int(self.header['slot_size'])
+        self.header_capacity = int(self.header['header_capacity'])
+        self._stride = (len(self._mmap) - _PAGE_SIZE) // self.n_slots
+        self._data_offset = _align(_SLOT_META_SIZE + self.header_capacity, 64)
+        self.slots = np.ndarray((self.n_slots,), SLOT_DTYPE,
+                                buffer=self._mmap, offset=_PAGE_SIZE,
+                                strides=(self._stride,))
+        self._view = memoryview(self._mmap)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the mapping of the shared memory.
+
+        Frames still viewed by a reader keep the mapping alive.
+        """
+
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    @property
+    def closed(self):
+        """
+        True once the receiver has closed the ring.
+        """
+
+        return bool(self.header['closed'])
+
+    def get_data_buffer(self, slot):
+        """
+        Return the image data buffer of a slot.
+        """
+
+        offset = _PAGE_SIZE + slot * self._stride + self._data_offset
+        return self._view[offset:offset + self.slot_size]
+
+    def get_header_buffer(self, slot):
+        """
+        Return the header buffer of a slot.
+        """
+
+        offset = _PAGE_SIZE + slot * self._stride + _SLOT_META_SIZE
+        return self._view[offset:offset + self.header_capacity]
+
+    def get_slot(self, seq):
+        """
+        Return the slot of the frame with the sequence number `seq`.
+        """
+
+        return (seq - 1) % self.n_slots
+
+    def unlink(self):
+        """
+        Remove the shared memory. Mappings already open stay valid.
+        """
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    @property
+    def write_seq(self):
+        """
+        The sequence number of the latest complete frame (0 if none).
+        """
+
+        return int(self.header['write_seq'])
+
+
+class SharedFrame(object):
+    """
+    Frame read from a :class:`FrameRing`.
+
+    Attributes
+    ----------
+    seq : int
+        The sequence number of the frame in the ring.
+    header : dict
+        The header of the frame.
+    image : numpy.ndarray
+        The image, a read-only view of the shared memory. It is overwritten
+        once the receiver has gone around the ring: check :meth:`is_valid`
+        after using the image, or copy it.
+    timestamp : float
+        The reception time (seconds since the epoch).
+
+    """
+
+    def __init__(self, ring, seq, header, image, timestamp):
+        self.ring = ring
+        self.seq = seq
+        self.header = header
+        self.image = image
+        self.timestamp = timestamp
+
+    def is_valid(self):
+        """
+        Return False if the frame has been overwritten in the meantime.
+        """
+
+        return self.ring.slots['seq'][self.ring.get_slot(self.seq)] == self.seq
+
+
+class SharedFrameReader(object):
+    """
+    Reader of the frames of a :class:`FrameRing`.
+
+    Frames are read in sequence with :meth:`read`, or dispatched from a
+    background thread to the consumers registered with :meth:`add_callback`
+    (the callbacks of a :class:`StreamTap` fit). The reader polls the ring
+    every `poll_interval` seconds while no new frame is available.
+    """
+
+    def __init__(self, name, start='latest', poll_interval=0.0005):
+        """
+        Open the ring.
+
+        Parameters
+        ----------
+        name : str
+            The name of the ring.
+        start : str, optional
+            'latest' reads the frames received from now on, 'oldest' starts
+            with the oldest frame still in the ring. (default = 'latest')
+        poll_interval : float, optional
+            The time [s] between checks for a new frame. (default = 0.0005)
+
+        """
+
+        self.ring = FrameRing(name)
+        self.poll_interval = poll_interval
+        write_seq = self.ring.write_seq
+        if start == 'oldest':
+            self.next_seq = max(write_seq - self.ring.n_slots + 2, 1)
+        elif start == 'latest':
+            self.next_seq = write_seq + 1
+        else:
+            raise ValueError("Unknown start: {}".format(start))
+        self.n_read = 0
+        self.n_skipped = 0
+
+        self._callbacks = []
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            frame = self.read(timeout=0.1)
+            if frame is None:
+                continue
+            for callback in list(self._callbacks):
+                try:
+                    callback(frame.header, frame.image)
+                except Exception:
+                    # a failing consumer must not stop the others
+                    pass
+
+    def add_callback(self, callback):
+        """
+        Register a consumer, called as ``callback(header, image)`` from the
+        thread started by :meth:`start` with every frame read.
+        """
+
+        self._callbacks.append(callback)
+
+    def close(self):
+        """
+        Stop reading and close the ring.
+        """
+
+        self.stop()
+        self.ring.close()
+
+    def read(self, timeout=1.0):
+        """
+        Return the next frame.
+
+        If the receiver has overwritten the next frame (the reader is more
+        than a ring behind), the reader skips ahead to the latest frame.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time [s] to wait for a frame. (default = 1.0)
+
+        Returns
+        -------
+        frame : SharedFrame or None
+            The frame, or None if no frame arrived in time or the ring has
+            been closed.
+
+        """
+
+        ring = self.ring
+        deadline = time.monotonic() + timeout
+        while True:
+            write_seq = ring.write_seq
+            if write_seq < self.next_seq:
+                if ring.closed or time.monotonic() >= deadline:
+                    return None
+                time.sleep(self.poll_interval)
+                continue
+            # the slot after the latest frame may be being rewritten
+            if write_seq - self.next_seq >= ring.n_slots - 1:
+                self.n_skipped += write_seq - self.next_seq
+                self.next_seq = write_seq
+            seq = self.next_seq
+            self.next_seq += 1
+            slot = ring.get_slot(seq)
+            meta = ring.slots[slot]
+            if meta['seq'] != seq:
+                self.n_skipped += 1
+                continue
+            header_size = int(meta['header_size'])
+            data_size = int(meta['data_size'])
+            timestamp = float(meta['timestamp'])
+            try:
+                header = json.loads(
+                    bytes(ring.get_header_buffer(slot)[:header_size]))
+                image = np.frombuffer(ring.get_data_buffer(slot),
+                                      dtype=np.dtype(header["type"]),
+                                      count=int(np.prod(header["shape"])))
+                image = image.reshape(header["shape"])
+            except (KeyError, TypeError, ValueError):
+                header, image = None, None
+            if meta['seq'] != seq:
+                # overwritten while decoding
+                self.n_skipped += 1
+                continue
+            if header is None or image.nbytes > data_size:
+                continue
+            self.n_read += 1
+            return SharedFrame(ring, seq, header, image, timestamp)
+
+    def remove_callback(self, callback):
+        """
+        Unregister a consumer.
+        """
+
+        try:
+            self._callbacks.remove(callback)
+        except ValueError:
+            pass
+
+    def start(self):
+        """
+        Dispatch the frames to the callbacks in a background thread.
+
+        Returns
+        -------
+        reader : SharedFrameReader
+            The reader itself.
+
+        """
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop dispatching the frames.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class SharedStreamReceiver(object):
+    """
+    Receiver of the camera stream into a :class:`FrameRing`.
+
+    The header and the image data of every frame are received with
+    ``recv_into`` straight into the next slot of the ring, so the frame is
+    copied once, from the ZMQ message into the shared memory (with pyzmq
+    older than 26.4, which has no ``recv_into``, the message is received and
+    then copied into the slot). Frames whose header or image is larger than
+    the slot are counted in `n_oversized` and dropped.
+    """
+
+    def __init__(self, address, name, n_slots=16, slot_size=2048 * 2048 * 2,
+                 header_capacity=1024, context=None, rcvhwm=100000):
+        """
+        Create the ring. Call :meth:`start` to receive frames.
+
+        Parameters
+        ----------
+        address : str
+            The address of the camera stream.
+        name : str
+            The name of the ring, see :func:`get_ring_path`.
+        n_slots : int, optional
+            The number of frames held by the ring. (default = 16)
+        slot_size : int, optional
+            The maximum image size [bytes]. (default = 8 MiB)
+        header_capacity : int, optional
+            The maximum header size [bytes]. (default = 1024)
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+        rcvhwm : int, optional
+            The receive high water mark [messages]. (default = 100000)
+
+        """
+
+        self.address = address
+        self.ring = FrameRing(name, n_slots=n_slots, slot_size=slot_size,
+                              header_capacity=header_capacity, create=True)
+        self.n_frames = 0
+        self.n_bytes = 0
+        self.n_oversized = 0
+
+        self._header_size = None
+        self._connected = False
+        self._stopping = threading.Event()
+        self._thread = None
+
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.PULL)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        self._has_recv_into = hasattr(self.socket, 'recv_into')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _publish(self, seq, slot, header_size, data_size):
+        """
+        Describe a complete frame in its slot and publish it.
+        """
+
+        ring = self.ring
+        try:
+            header = json.loads(
+                bytes(ring.get_header_buffer(slot)[:header_size]))
+            frame_id = int(header["frame"])
+        except (KeyError, TypeError, ValueError):
+            frame_id = -1
+        meta = ring.slots[slot]
+        meta['frame_id'] = frame_id
+        meta['timestamp'] = time.time()
+        meta['header_size'] = header_size
+        meta['data_size'] = data_size
+        meta['seq'] = seq
+        ring.header['write_seq'] = seq
+        self.n_frames += 1
+        self.n_bytes += data_size
+
+    def _recv_into(self, buffer):
+        """
+        Receive the next message into `buffer`, return the message size.
+        """
+
+        if self._has_recv_into:
+            return self.socket.recv_into(buffer, flags=zmq.NOBLOCK)
+        else:
+            message = self.socket.recv(flags=zmq.NOBLOCK, copy=False)
+            size = len(message.buffer)
+            if size <= len(buffer):
+                buffer[:size] = message.buffer
+            return size
+
+    def _run(self):
+        ring = self.ring
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self._stopping.is_set():
+            if not poller.poll(100):
+                continue
+            # receive everything pending before polling again
+            while self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                seq = ring.write_seq + 1
+                slot = ring.get_slot(seq)
+                try:
+                    if self._header_size is None:
+                        # invalidate the slot before overwriting it
+                        ring.slots['seq'][slot] = 0
+                        self._header_size = self._recv_into(
+                            ring.get_header_buffer(slot))
+                        continue
+                    data_size = self._recv_into(ring.get_data_buffer(slot))
+                except zmq.Again:
+                    break
+                header_size, self._header_size = self._header_size, None
+                if (header_size > ring.header_capacity or
+                        data_size > ring.slot_size):
+                    self.n_oversized += 1
+                    continue
+                self._publish(seq, slot, header_size, data_size)
+
+    def close(self):
+        """
+        Stop receiving, mark the ring as closed and remove it.
+
+        Readers still attached keep their mapping and see the ring closed.
+        """
+
+        self.stop()
+        self.socket.close()
+        self.ring.header['closed'] = 1
+        self.ring.unlink()
+        self.ring.close()
+
+    def start(self):
+        """
+        Connect to the stream and receive in a background thread.
+
+        Returns
+        -------
+        receiver : SharedStreamReceiver
+            The receiver itself.
+
+        """
+
+        if not self._connected:
+            self.socket.connect(self.address)
+            self._connected = True
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop receiving frames.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Receive the PCO camera stream into shared memory.")
+    parser.add_argument('address', help="address of the camera stream")
+    parser.add_argument('name', help="name of the shared-memory ring")
+    parser.add_argument('--slots', type=int, default=16)
+    parser.add_argument('--slot-size', type=int, default=2048 * 2048 * 2,
+                        help="maximum image size [bytes]")
+    arguments = parser.parse_args()
+
+    receiver = SharedStreamReceiver(arguments.address, arguments.name,
+                                    n_slots=arguments.slots,
+                                    slot_size=arguments.slot_size).start()
+    print("Receiving into {} (Ctrl-C to stop)".format(receiver.ring.path))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+    print("{} frames received, {} oversized".format(receiver.n_frames,
+                                                   receiver.n_oversized))
+
+
+if __name__ == "__main__":
+    main()
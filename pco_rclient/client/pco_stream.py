@@ -0,0 +1,640 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic camera stream in the protocol received by the PCO writer.
+
+Usage::
+
+    python -m pco_rclient.client.pco_stream tcp://*:8080 --fps 100
+        [--shape 2048 2048] [--dtype uint16] [--n-frames 1000]
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+import zmq
+
+
+# Poll interval [ms] of a drain checking for its cancellation.
+_CANCEL_POLL_INTERVAL = 100
+
+
+def _decode_header(message):
+    """
+    Decode the JSON header of a frame, or return an empty dict if invalid.
+    """
+
+    try:
+        header = json.loads(message.bytes.decode())
+    except ValueError:
+        return {}
+    if not isinstance(header, dict):
+        return {}
+    return header
+
+
+def make_header(frame_id, shape, dtype):
+    """
+    Return the JSON header of a frame.
+
+    Parameters
+    ----------
+    frame_id : int
+        The id of the frame.
+    shape : tuple of int
+        The shape of the frame.
+    dtype : numpy.dtype or str
+        The data type of the frame.
+
+    Returns
+    -------
+    header : bytes
+        The encoded header.
+
+    """
+
+    return json.dumps({"frame": int(frame_id), "shape": list(shape),
+                       "type": np.dtype(dtype).name}).encode()
+
+
+class FlushSummary(object):
+    """
+    Summary of the frames drained from the camera stream.
+
+    Attributes
+    ----------
+    n_frames : int
+        The number of frames (headers) received.
+    n_messages : int
+        The number of messages (headers and data) received.
+    n_bytes : int
+        The number of bytes received.
+    first_frame_id, last_frame_id : int or None
+        The ids of the first and the last frame received.
+    duration : float
+        The duration [s] of the flush, including the final inactivity
+        timeout.
+
+    """
+
+    def __init__(self):
+        self.n_frames = 0
+        self.n_messages = 0
+        self.n_bytes = 0
+        self.first_frame_id = None
+        self.last_frame_id = None
+        self.duration = 0.0
+
+    def __repr__(self):
+        return ("FlushSummary(n_frames={}, n_bytes={}, duration={:.3f}, "
+                "first_frame_id={}, last_frame_id={})".format(
+                    self.n_frames, self.n_bytes, self.duration,
+                    self.first_frame_id, self.last_frame_id))
+
+    @property
+    def data_rate(self):
+        """
+        The mean data rate [bytes/s] of the flush.
+        """
+
+        return self.n_bytes / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def frame_rate(self):
+        """
+        The mean frame rate [frames/s] of the flush.
+        """
+
+        return self.n_frames / self.duration if self.duration > 0 else 0.0
+
+
+class StreamDrain(object):
+    """
+    Receiver draining the camera stream as fast as possible.
+
+    The ZMQ context (and its I/O threads) is kept for the lifetime of the
+    drain. A socket with large receive queues is only opened while draining:
+    a PULL socket connected to the camera permanently would receive its share
+    of the frames meant for the writer, and reconnecting a socket to the same
+    endpoint races with its previous disconnection. The messages are received
+    without copying in batches, i.e. the socket is polled only when no
+    message is pending, and the headers are only decoded when requested (plus
+    the first and the last one, for the frame ids of the summary).
+    """
+
+    def __init__(self, context=None, rcvhwm=100000, rcvbuf=64 * 1024**2):
+        """
+        Initialize the drain.
+
+        Parameters
+        ----------
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+        rcvhwm : int, optional
+            The receive high water mark [messages] of the socket.
+            (default = 100000)
+        rcvbuf : int, optional
+            The size [bytes] of the kernel receive buffer of the socket,
+            possibly limited by the operating system.
+            (default = 64 MiB)
+
+        """
+
+        if context is None:
+            context = zmq.Context.instance()
+        self.context = context
+        self.rcvhwm = rcvhwm
+        self.rcvbuf = rcvbuf
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the drain, which cannot be used anymore afterwards.
+        """
+
+        self._closed = True
+
+    def drain(self, address, timeout=500, decode_headers=False,
+              on_header=None, summary=None, cancel=None):
+        """
+        Receive and discard the frames of the stream until it is inactive.
+
+        Parameters
+        ----------
+        address : str
+            The address of the camera stream.
+        timeout : int, optional
+            The inactivity time [ms] after which the drain ends. If not
+            positive, the drain only ends when cancelled or with a
+            KeyboardInterrupt. (default = 500)
+        decode_headers : bool, optional
+            Decode every header and pass it to `on_header`. (default = False)
+        on_header : callable, optional
+            Called as ``on_header(message_index, header)`` with every decoded
+            header. (default = None)
+        summary : FlushSummary, optional
+            The summary to update, e.g. to follow the progress from another
+            thread. If None, a new summary is created. (default = None)
+        cancel : threading.Event, optional
+            Ends the drain when set. (default = None)
+
+        Returns
+        -------
+        summary : FlushSummary
+            The summary of the frames drained.
+
+        """
+
+        if summary is None:
+            summary = FlushSummary()
+        if cancel is None:
+            cancel = threading.Event()
+        t_start = time.perf_counter()
+        t_active = t_start
+        last_header = None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The stream drain is closed.")
+            socket = self.context.socket(zmq.PULL)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.setsockopt(zmq.RCVHWM, self.rcvhwm)
+            socket.setsockopt(zmq.RCVBUF, self.rcvbuf)
+            socket.connect(address)
+            try:
+                while not cancel.is_set():
+                    # poll in short slices to notice a cancellation
+                    wait = _CANCEL_POLL_INTERVAL
+                    if timeout > 0:
+                        remaining = timeout - (time.perf_counter() -
+                                               t_active) * 1000
+                        if remaining <= 0:
+                            break
+                        wait = min(wait, remaining)
+                    if not socket.poll(wait):
+                        continue
+                    # receive everything pending before polling again
+                    while True:
+                        try:
+                            parts = socket.recv_multipart(
+                                flags=zmq.NOBLOCK, copy=False)
+                        except zmq.Again:
+                            break
+                        for part in parts:
+                            if summary.n_messages % 2 == 0:
+                                last_header = part
+                                summary.n_frames += 1
+                                if summary.n_frames == 1:
+                                    summary.first_frame_id = \
+                                        _decode_header(part).get("frame")
+                                if decode_headers and on_header is not None:
+                                    on_header(summary.n_messages,
+                                              _decode_header(part))
+                            summary.n_messages += 1
+                            summary.n_bytes += len(part)
+                    t_active = time.perf_counter()
+                    summary.duration = t_active - t_start
+            finally:
+                socket.close()
+                if last_header is not None:
+                    summary.last_frame_id = \
+                        _decode_header(last_header).get("frame")
+                summary.duration = time.perf_counter() - t_start
+        return summary
+
+
+class FlushHandle(object):
+    """
+    Handle of a flush of the camera stream running in a background thread.
+
+    The flush can overlap other preparations of the next acquisition. Its
+    progress is available at any time, and it can be cancelled early.
+    """
+
+    def __init__(self, drain, address, timeout=500):
+        """
+        Start the flush.
+
+        Parameters
+        ----------
+        drain : StreamDrain
+            The drain receiving the frames.
+        address : str
+            The address of the camera stream.
+        timeout : int, optional
+            The inactivity time [ms] after which the flush ends, see
+            :meth:`StreamDrain.drain`. (default = 500)
+
+        """
+
+        self.summary = FlushSummary()
+        self.error = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(drain, address, timeout))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        state = "done" if self.done() else "running"
+        return "FlushHandle({}, {!r})".format(state, self.summary)
+
+    def _run(self, drain, address, timeout):
+        try:
+            drain.drain(address, timeout=timeout, summary=self.summary,
+                        cancel=self._cancel)
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        """
+        End the flush as soon as possible.
+        """
+
+        self._cancel.set()
+
+    def done(self):
+        """
+        Return True if the flush has ended.
+        """
+
+        return not self._thread.is_alive()
+
+    def get_progress(self):
+        """
+        Return the live progress of the flush.
+
+        Returns
+        -------
+        progress : dict
+            The number of frames "n_frames" and bytes "n_bytes" drained so
+            far, the "duration" [s], the mean "frame_rate" [frames/s] and
+            "data_rate" [bytes/s], and whether the flush is "done".
+
+        """
+
+        summary = self.summary
+        return {"n_frames": summary.n_frames, "n_bytes": summary.n_bytes,
+                "duration": summary.duration,
+                "frame_rate": summary.frame_rate,
+                "data_rate": summary.data_rate, "done": self.done()}
+
+    def join(self, timeout=None):
+        """
+        Wait for the end of the flush.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            The maximum time [s] to wait. If None, wait until the flush ends.
+            (default = None)
+
+        Returns
+        -------
+        summary : FlushSummary or None
+            The summary of the flush, or None if it is still running.
+
+        Raises
+        ------
+        Exception
+            The error that ended the flush, if any.
+
+        """
+
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.summary
+
+
+class StreamGenerator(object):
+    """
+    Generator of a synthetic camera stream.
+
+    The image data are taken round-robin from a small pool of frames which is
+    allocated and filled once. The frames are never modified afterwards, so
+    they are handed to ZMQ without copying, and only the short header is
+    created per frame. The sustained rate is therefore limited by the network
+    (or the receiver) rather than by the generator.
+    """
+
+    def __init__(self, address, frame_shape=(2048, 2048),
+                 frame_dtype='uint16', frame_rate=0.0, gap_every=0,
+                 gap_size=1, pool_size=4, bind=True, block=True,
+                 context=None, seed=None):
+        """
+        Open the stream socket.
+
+        Parameters
+        ----------
+        address : str
+            The ZMQ address of the stream, e.g. "tcp://*:8080".
+        frame_shape : tuple of int, optional
+            The shape of the frames. (default = (2048, 2048))
+        frame_dtype : str, optional
+            The data type of the frames. (default = 'uint16')
+        frame_rate : float, optional
+            The rate [frames/s] of :meth:`run`. 0 sends as fast as possible.
+            (default = 0.0)
+        gap_every : int, optional
+            If larger than zero, `gap_size` frame ids are skipped after every
+            `gap_every` frames sent, emulating lost frames. (default = 0)
+        gap_size : int, optional
+            The number of frame ids skipped per gap. (default = 1)
+        pool_size : int, optional
+            The number of distinct preallocated frames. (default = 4)
+        bind : bool, optional
+            Bind the PUSH socket to `address`, as the camera does, instead of
+            connecting to it. (default = True)
+        block : bool, optional
+            If True, sending blocks while no receiver is ready (ZMQ high water
+            mark). Otherwise the frame is dropped and counted in `n_dropped`,
+            as the camera does. (default = True)
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+        seed : int, optional
+            The seed of the random frame contents. (default = None)
+
+        """
+
+        self.address = address
+        self.frame_shape = tuple(int(n) for n in frame_shape)
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.frame_rate = float(frame_rate)
+        self.gap_every = int(gap_every)
+        self.gap_size = int(gap_size)
+        self.block = block
+
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.n_bytes = 0
+        self.next_frame_id = 0
+        self._n_since_gap = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.frames = self._allocate_frames(max(int(pool_size), 1), seed)
+        # only the frame id changes from one header to the next
+        header = make_header(0, self.frame_shape, self.frame_dtype)
+        self._header_prefix = b'{"frame": '
+        self._header_suffix = header[len(self._header_prefix) + 1:]
+
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.PUSH)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # blocking sends wake up regularly to check for stop()
+        self.socket.setsockopt(zmq.SNDTIMEO, 100)
+        if bind:
+            self.socket.bind(address)
+        else:
+            self.socket.connect(address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _allocate_frames(self, pool_size, seed):
+        """
+        Allocate the pool of frames with distinct, detector-like contents.
+        """
+
+        random = np.random.RandomState(seed)
+        if self.frame_dtype.kind in 'ui':
+            maximum = min(np.iinfo(self.frame_dtype).max, 4095)
+        else:
+            maximum = 4095.0
+        frames = []
+        for index in range(pool_size):
+            frame = random.poisson(maximum * (index + 1) / (pool_size + 1),
+                                   self.frame_shape)
+            frames.append(np.ascontiguousarray(
+                np.clip(frame, 0, maximum).astype(self.frame_dtype)))
+        return frames
+
+    def close(self):
+        """
+        Stop a background stream and close the socket.
+        """
+
+        self.stop()
+        self.socket.close()
+
+    @property
+    def frame_size(self):
+        """
+        The size [bytes] of the image data of a frame.
+        """
+
+        return self.frames[0].nbytes
+
+    def run(self, n_frames=0, duration=None):
+        """
+        Send frames at the configured frame rate.
+
+        The frames are scheduled on a fixed time grid, so a delayed frame is
+        followed by a burst that catches up with the nominal rate.
+
+        Parameters
+        ----------
+        n_frames : int, optional
+            The number of frames to send. 0 sends until :meth:`stop` is called
+            or `duration` has passed. (default = 0)
+        duration : float, optional
+            The maximum duration [s] of the stream. (default = None)
+
+        Returns
+        -------
+        n_sent : int
+            The number of frames emitted, including dropped frames.
+
+        """
+
+        period = 1.0 / self.frame_rate if self.frame_rate > 0 else 0.0
+        t_start = time.perf_counter()
+        n_sent = 0
+        while not self._stopping.is_set():
+            if n_frames > 0 and n_sent >= n_frames:
+                break
+            now = time.perf_counter()
+            if duration is not None and now - t_start >= duration:
+                break
+            if period:
+                delay = t_start + n_sent * period - now
+                if delay > 0:
+                    self._stopping.wait(delay)
+                    continue
+            self.send_frame()
+            n_sent += 1
+        return n_sent
+
+    def send_frame(self, frame_id=None, block=None):
+        """
+        Send a single frame.
+
+        Parameters
+        ----------
+        frame_id : int, optional
+            The id of the frame. If None, the next id is used, including the
+            configured gaps. (default = None)
+        block : bool, optional
+            Overrides the `block` setting of the generator. (default = None)
+
+        Returns
+        -------
+        sent : bool
+            False if the frame was dropped because no receiver was ready.
+
+        """
+
+        if frame_id is None:
+            frame_id = self.next_frame_id
+            self._n_since_gap += 1
+            self.next_frame_id += 1
+            if self.gap_every > 0 and self._n_since_gap >= self.gap_every:
+                self._n_since_gap = 0
+                self.next_frame_id += self.gap_size
+        if block is None:
+            block = self.block
+        flags = zmq.SNDMORE if block else zmq.SNDMORE | zmq.NOBLOCK
+        header = (self._header_prefix + str(frame_id).encode() +
+                  self._header_suffix)
+        data = self.frames[frame_id % len(self.frames)]
+        while True:
+            try:
+                self.socket.send(header, flags=flags)
+                break
+            except zmq.Again:
+                if not block or self._stopping.is_set():
+                    self.n_dropped += 1
+                    return False
+        # the header is queued, so the data part can no longer be refused
+        self.socket.send(data, copy=False)
+        self.n_sent += 1
+        self.n_bytes += data.nbytes
+        return True
+
+    def start(self, n_frames=0, duration=None):
+        """
+        Run the stream in a background thread, see :meth:`run`.
+
+        Returns
+        -------
+        generator : StreamGenerator
+            The generator itself.
+
+        """
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.run,
+                                        args=(n_frames, duration))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop a background stream.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Push a synthetic PCO camera stream.")
+    parser.add_argument('address', help="ZMQ address, e.g. tcp://*:8080")
+    parser.add_argument('--shape', type=int, nargs=2, default=(2048, 2048))
+    parser.add_argument('--dtype', default='uint16')
+    parser.add_argument('--fps', type=float, default=0.0,
+                        help="frame rate (default: as fast as possible)")
+    parser.add_argument('--n-frames', type=int, default=1000)
+    parser.add_argument('--gap-every', type=int, default=0,
+                        help="skip frame ids after every so many frames")
+    parser.add_argument('--gap-size', type=int, default=1)
+    parser.add_argument('--connect', action='store_true',
+                        help="connect to the address instead of binding")
+    arguments = parser.parse_args()
+
+    with StreamGenerator(arguments.address, frame_shape=arguments.shape,
+                         frame_dtype=arguments.dtype,
+                         frame_rate=arguments.fps,
+                         gap_every=arguments.gap_every,
+                         gap_size=arguments.gap_size,
+                         bind=not arguments.connect) as generator:
+        t_start = time.perf_counter()
+        try:
+            generator.run(n_frames=arguments.n_frames)
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.perf_counter() - t_start
+    print("Sent {} frames ({:.1f} MB) in {:.2f} s: {:.1f} frames/s, "
+          "{:.1f} MB/s".format(generator.n_sent, generator.n_bytes / 1e6,
+                               elapsed, generator.n_sent / elapsed,
+                               generator.n_bytes / 1e6 / elapsed))
+
+
+if __name__ == "__main__":
+    main()
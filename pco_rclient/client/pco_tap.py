@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+"""
+Inspection of the camera stream: per-frame statistics and frame-id gaps.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+import json
+import threading
+import time
+
+import numpy as np
+import zmq
+
+
+# Fields of the frame log.
+FRAME_LOG_DTYPE = np.dtype([('frame_id', '<i8'),
+                            ('timestamp', '<f8'),
+                            ('min', '<f8'),
+                            ('max', '<f8'),
+                            ('mean', '<f8'),
+                            ('n_saturated', '<i8'),
+                            ('gap', '<i8')])
+
+
+def decode_frame(header_message, data_message):
+    """
+    Decode a frame of the camera stream.
+
+    Parameters
+    ----------
+    header_message : zmq.Frame or bytes
+        The JSON header of the frame.
+    data_message : zmq.Frame or bytes
+        The image data of the frame.
+
+    Returns
+    -------
+    header : dict
+        The decoded header.
+    image : numpy.ndarray
+        The image, a read-only view of the message buffer (no copy).
+
+    Raises
+    ------
+    ValueError
+        If the header is invalid or does not match the image data.
+
+    """
+
+    if isinstance(header_message, zmq.Frame):
+        header_message = header_message.bytes
+    header = json.loads(header_message.decode())
+    if isinstance(data_message, zmq.Frame):
+        data_message = data_message.buffer
+    image = np.frombuffer(data_message, dtype=np.dtype(header["type"]))
+    return header, image.reshape(header["shape"])
+
+
+class FrameLog(object):
+    """
+    Array-backed log of the per-frame statistics.
+
+    The records are stored in a structured numpy array (see
+    :data:`FRAME_LOG_DTYPE`) whose capacity is doubled when full, so
+    appending is amortized constant time and the log costs 56 bytes per
+    frame. Besides the frame id, the reception time and the image statistics,
+    every record holds the `gap` to the previous frame: the number of frame
+    ids skipped before the frame, or a negative number for a repeated or
+    out-of-order frame.
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        Initialize the log.
+
+        Parameters
+        ----------
+        capacity : int, optional
+            The initial number of records allocated. (default = 4096)
+
+        """
+
+        self._records = np.zeros(max(int(capacity), 1),
+                                 dtype=FRAME_LOG_DTYPE)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, frame_id, timestamp, minimum, maximum, mean,
+               n_saturated, gap):
+        """
+        Append the record of a frame.
+        """
+
+        with self._lock:
+            if self._count == len(self._records):
+                records = np.zeros(2 * len(self._records),
+                                   dtype=FRAME_LOG_DTYPE)
+                records[:self._count] = self._records
+                self._records = records
+            self._records[self._count] = (frame_id, timestamp, minimum,
+                                          maximum, mean, n_saturated, gap)
+            self._count += 1
+
+    def clear(self):
+        """
+        Remove all records.
+        """
+
+        with self._lock:
+            self._count = 0
+
+    def get_duplicate_frames(self):
+        """
+        Return the ids of the frames received more than once.
+
+        Returns
+        -------
+        frame_ids : numpy.ndarray
+            The sorted ids of the duplicated frames.
+
+        """
+
+        ids, counts = np.unique(self.get_records()['frame_id'],
+                                return_counts=True)
+        return ids[counts > 1]
+
+    def get_missing_frames(self, first_frame_id=None, last_frame_id=None):
+        """
+        Return the ids of the frames that were not received.
+
+        Parameters
+        ----------
+        first_frame_id : int, optional
+            The id of the first frame expected. If None, the smallest id
+            received. (default = None)
+        last_frame_id : int, optional
+            The id of the last frame expected. If None, the largest id
+            received. (default = None)
+
+        Returns
+        -------
+        frame_ids : numpy.ndarray
+            The sorted ids of the missing frames.
+
+        """
+
+        ids = self.get_records()['frame_id']
+        if len(ids) == 0:
+            return ids
+        if first_frame_id is None:
+            first_frame_id = ids.min()
+        if last_frame_id is None:
+            last_frame_id = ids.max()
+        expected = np.arange(first_frame_id, last_frame_id + 1,
+                             dtype=ids.dtype)
+        return np.setdiff1d(expected, ids)
+
+    def get_records(self):
+        """
+        Return a copy of the records.
+
+        Returns
+        -------
+        records : numpy.ndarray
+            Structured array with the fields of :data:`FRAME_LOG_DTYPE`, in
+            the order of reception.
+
+        """
+
+        with self._lock:
+            return self._records[:self._count].copy()
+
+    def save(self, path):
+        """
+        Save the records to a .npy file.
+        """
+
+        np.save(path, self.get_records())
+
+
+class StreamTap(object):
+    """
+    Receiver inspecting the frames of the camera stream.
+
+    For every frame, the minimum, maximum, mean and the number of pixels at or
+    above the saturation level are computed with numpy on a view of the
+    message buffer and appended to the :class:`FrameLog` `log`, along with
+    the gap to the previous frame id. The frame ids are checked against
+    `first_frame_id`: frames missing before or between the frames received
+    are counted in `n_missing`, repeated or out-of-order ids in
+    `n_duplicates`.
+
+    Additional consumers (e.g. a preview) can be registered with
+    :meth:`add_callback`; they are called with the header and the image of
+    every frame. A failing consumer is reported and counted in
+    `n_callback_errors`, the inspection goes on.
+
+    The camera pushes its frames round-robin to all connected receivers, so
+    to inspect the stream of an acquisition, the tap forwards the frames on
+    a second address the writer receives from. The tap is then inline and
+    not passive: every frame is forwarded before it is inspected, and while
+    the writer does not keep up (or is not connected), the tap waits for it
+    and stops receiving, so the frames queue up towards the camera. Only a
+    frame still waiting to be forwarded when the tap stops is dropped and
+    counted in `n_dropped`.
+
+    Examples
+    --------
+    >>> tap = StreamTap('tcp://pco-camera:8080',
+    ...                 forward_address='tcp://*:8090').start()
+    >>> writer.configure(connection_address='tcp://tap-host:8090')
+
+    """
+
+    def __init__(self, address, forward_address=None, saturation_level=None,
+                 first_frame_id=None, log_capacity=4096, context=None,
+                 rcvhwm=100000, sndhwm=100000):
+        """
+        Initialize the tap. Call :meth:`start` to receive frames.
+
+        Parameters
+        ----------
+        address : str
+            The address of the camera stream.
+        forward_address : str, optional
+            If set, every frame is forwarded unchanged to a PUSH socket bound
+            to this address, from which the writer receives the stream. While
+            no consumer is connected, or `sndhwm` messages are queued, the
+            tap waits before it receives the next frame. (default = None)
+        saturation_level : float, optional
+            The pixel value at or above which a pixel counts as saturated. If
+            None, the maximum value of the data type of the frames.
+            (default = None)
+        first_frame_id : int, optional
+            The id of the first frame expected. If None, the id of the first
+            frame received. (default = None)
+        log_capacity : int, optional
+            The initial capacity of the frame log. (default = 4096)
+        context : zmq.Context, optional
+            The ZMQ context to use. If None, the global context instance is
+            used. (default = None)
+        rcvhwm : int, optional
+            The receive high water mark [messages]. (default = 100000)
+        sndhwm : int, optional
+            The high water mark [messages] of the forward socket, i.e. how
+            far the consumer may fall behind before the tap waits for it.
+            (default = 100000)
+
+        """
+
+        self.address = address
+        self.forward_address = forward_address
+        self.saturation_level = saturation_level
+        self.first_frame_id = first_frame_id
+        self.log = FrameLog(log_capacity)
+
+        self.n_frames = 0
+        self.n_missing = 0
+        self.n_duplicates = 0
+        self.n_invalid = 0
+        self.n_dropped = 0
+        self.n_callback_errors = 0
+        self.last_frame_id = None
+
+        self._callbacks = []
+        self._connected = False
+        self._pending_header = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+        if context is None:
+            context = zmq.Context.instance()
+        self.socket = context.socket(zmq.PULL)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        self.forward_socket = None
+        if forward_address:
+            self.forward_socket = context.socket(zmq.PUSH)
+            self.forward_socket.setsockopt(zmq.LINGER, 0)
+            self.forward_socket.setsockopt(zmq.SNDHWM, sndhwm)
+            # a waiting forward wakes up regularly to check for stop()
+            self.forward_socket.setsockopt(zmq.SNDTIMEO, 100)
+            self.forward_socket.bind(forward_address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _forward(self, header_message, data_message):
+        """
+        Forward a frame, waiting while the consumer does not keep up.
+        """
+
+        while True:
+            try:
+                self.forward_socket.send_multipart(
+                    [header_message, data_message], copy=False)
+                return
+            except zmq.Again:
+                if self._stopping.is_set():
+                    self.n_dropped += 1
+                    return
+
+    def _process(self, header_message, data_message):
+        """
+        Forward, decode and inspect a frame.
+        """
+
+        if self.forward_socket is not None:
+            self._forward(header_message, data_message)
+        try:
+            header, image = decode_frame(header_message, data_message)
+            frame_id = int(header["frame"])
+        except (KeyError, TypeError, ValueError):
+            self.n_invalid += 1
+            return
+
+        if self.last_frame_id is None:
+            if self.first_frame_id is None:
+                self.first_frame_id = frame_id
+            gap = frame_id - self.first_frame_id
+        else:
+            gap = frame_id - self.last_frame_id - 1
+        if gap >= 0:
+            self.n_missing += gap
+            self.last_frame_id = frame_id
+        else:
+            # repeated, out-of-order or before the first frame id
+            self.n_duplicates += 1
+
+        saturation_level = self.saturation_level
+        kind = image.dtype.kind
+        if saturation_level is None:
+            if kind in 'ui':
+                saturation_level = np.iinfo(image.dtype).max
+            else:
+                saturation_level = np.inf
+        if kind in 'ui':
+            # an exact integer sum is faster than a floating-point mean
+            mean = image.sum(dtype=np.uint64 if kind == 'u' else np.int64)
+            mean = float(mean) / image.size
+        else:
+            mean = image.mean()
+        self.log.append(frame_id, time.time(), image.min(), image.max(), mean,
+                        np.count_nonzero(image >= saturation_level), gap)
+        self.n_frames += 1
+
+        for callback in list(self._callbacks):
+            try:
+                callback(header, image)
+            except Exception as e:
+                # a failing consumer must not stop the inspection
+                self.n_callback_errors += 1
+                print("StreamTap: callback {!r} failed: {!r}".format(
+                    callback, e))
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self._stopping.is_set():
+            if not poller.poll(100):
+                continue
+            # receive everything pending before polling again
+            while not self._stopping.is_set():
+                try:
+                    parts = self.socket.recv_multipart(flags=zmq.NOBLOCK,
+                                                       copy=False)
+                except zmq.Again:
+                    break
+                for part in parts:
+                    if self._pending_header is None:
+                        self._pending_header = part
+                    else:
+                        header, self._pending_header = \
+                            self._pending_header, None
+                        self._process(header, part)
+
+    def add_callback(self, callback):
+        """
+        Register a consumer of the frames.
+
+        Parameters
+        ----------
+        callback : callable
+            Called as ``callback(header, image)`` from the receiving thread
+            with every frame. The image is a read-only view of the message
+            buffer, which must be copied to be kept beyond the call.
+
+        """
+
+        self._callbacks.append(callback)
+
+    def close(self):
+        """
+        Stop the tap and close its sockets.
+        """
+
+        self.stop()
+        self.socket.close()
+        if self.forward_socket is not None:
+            self.forward_socket.close()
+
+    def get_summary(self):
+        """
+        Return the counters of the tap.
+
+        Returns
+        -------
+        summary : dict
+            The number of frames received "n_frames", missing "n_missing",
+            duplicated or out of order "n_duplicates", with an invalid header
+            "n_invalid" and not forwarded "n_dropped", the number of failed
+            callbacks "n_callback_errors", and the "first_frame_id" and
+            "last_frame_id".
+
+        """
+
+        return {"n_frames": self.n_frames, "n_missing": self.n_missing,
+                "n_duplicates": self.n_duplicates,
+                "n_invalid": self.n_invalid, "n_dropped": self.n_dropped,
+                "n_callback_errors": self.n_callback_errors,
+                "first_frame_id": self.first_frame_id,
+                "last_frame_id": self.last_frame_id}
+
+    def remove_callback(self, callback):
+        """
+        Unregister a consumer of the frames.
+        """
+
+        try:
+            self._callbacks.remove(callback)
+        except ValueError:
+            pass
+
+    def start(self):
+        """
+        Connect to the stream and inspect the frames in a background thread.
+
+        Returns
+        -------
+        tap : StreamTap
+            The tap itself.
+
+        """
+
+        if not self._connected:
+            self.socket.connect(self.address)
+            self._connected = True
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop receiving frames.
+        """
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Latency tracing of the state-changing operations of a PCO writer.
+"""
+
+
+__copyright__ = 'Copyright (c) 2020, Paul Scherrer Institut'
+__docformat__ = 'restructuredtext en'
+
+
+from collections import OrderedDict, deque
+import json
+import threading
+import time
+
+from pco_rclient.client.pco_monitor import END_STATUSES
+
+
+# Statuses of a running writer process.
+RUNNING_STATUSES = ('receiving', 'writing')
+
+
+def _round(seconds):
+    """
+    Round a time to microseconds for the trace file.
+    """
+
+    if seconds is None:
+        return None
+    return round(seconds, 6)
+
+
+class TraceSpan(object):
+    """
+    Timing of one operation or run of the writer.
+
+    Attributes
+    ----------
+    name : str
+        The kind of span, e.g. 'start' or 'run'.
+    fields : dict
+        Additional information on the span, e.g. the dataset name.
+    timestamp : float
+        The time [s since the epoch] the span began.
+    events : OrderedDict
+        The time [s] of each event since the beginning of the span, in the
+        order the events occurred. Only the first occurrence is kept.
+    duration : float or None
+        The time [s] from the beginning to the end of the span, None while
+        the span is open.
+
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+        self.timestamp = time.time()
+        self.events = OrderedDict()
+        self.duration = None
+        self._seen_running = False
+        self._t_begin = time.monotonic()
+
+    def __repr__(self):
+        return "<TraceSpan {}: {}>".format(self.name, ", ".join(
+            "{} {:.3f} s".format(event, t) for event, t in self.events.items()))
+
+    def elapsed(self):
+        """
+        Return the time [s] since the beginning of the span.
+        """
+
+        return time.monotonic() - self._t_begin
+
+    def end(self, **fields):
+        """
+        End the span, adding `fields` to its information.
+
+        Returns
+        -------
+        ended : bool
+            False if the span had already ended.
+
+        """
+
+        if self.duration is not None:
+            return False
+        self.duration = self.elapsed()
+        self.fields.update(fields)
+        return True
+
+    def get_interval(self, first, second):
+        """
+        Return the time [s] between two events, None if one is missing.
+        """
+
+        if first not in self.events or second not in self.events:
+            return None
+        return self.events[second] - self.events[first]
+
+    def mark(self, event):
+        """
+        Record the current time as the time of `event`, unless the event has
+        already occurred or the span has ended.
+
+        Returns
+        -------
+        marked : bool
+            Whether the event was recorded.
+
+        """
+
+        if self.duration is not None or event in self.events:
+            return False
+        self.events[event] = self.elapsed()
+        return True
+
+    def observe_status(self, status):
+        """
+        Mark the event of a writer status.
+
+        The running statuses are marked as they are observed. The first end
+        status (see :data:`END_STATUSES`) observed after a running one is
+        marked as "finished".
+        """
+
+        if status in RUNNING_STATUSES:
+            self._seen_running = True
+            self.mark(status)
+        elif self._seen_running and status in END_STATUSES:
+            if self.mark('finished'):
+                self.fields['final_status'] = status
+
+    def to_dict(self):
+        """
+        Return the span as a dict, as written to the trace file.
+        """
+
+        span = OrderedDict()
+        span['span'] = self.name
+        span['timestamp'] = self.timestamp
+        span['duration'] = _round(self.duration)
+        span['events'] = OrderedDict(
+            (event, _round(t)) for event, t in self.events.items())
+        span.update(self.fields)
+        return span
+
+
+class Tracer(object):
+    """
+    Collector of the trace spans of a writer.
+
+    Spans are opened with :meth:`begin` and completed with :meth:`end`. All
+    open spans are marked by the writer states reported through
+    :meth:`observe_status` and :meth:`observe_snapshot`. A run span (see
+    :meth:`begin_run`) ends by itself once the end of the run is observed.
+    The last `max_spans` completed spans are kept in memory; with a `path`,
+    every completed span is also appended to that JSON lines file.
+    """
+
+    def __init__(self, path=None, max_spans=1000):
+        """
+        Initialize the tracer.
+
+        Parameters
+        ----------
+        path : str, optional
+            The JSON lines file the spans are appended to. The file is opened
+            with the first completed span. (default = None, no file)
+        max_spans : int, optional
+            The number of completed spans kept in memory. (default = 1000)
+
+        """
+
+        self.path = path
+        self.spans = deque(maxlen=max_spans)
+        self._open = []
+        self._run = None
+        self._file = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _complete(self, span, **fields):
+        """
+        End a span and store it. The lock must be held.
+        """
+
+        if not span.end(**fields):
+            return
+        if span in self._open:
+            self._open.remove(span)
+        if span is self._run:
+            self._run = None
+        self.spans.append(span)
+        if self.path is not None and not self._closed:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(span.to_dict()) + '\n')
+            self._file.flush()
+
+    def begin(self, name, **fields):
+        """
+        Open a span.
+
+        Parameters
+        ----------
+        name : str
+            The kind of span.
+        **fields
+            Additional information on the span.
+
+        Returns
+        -------
+        span : TraceSpan
+            The open span.
+
+        """
+
+        span = TraceSpan(name, **fields)
+        with self._lock:
+            self._open.append(span)
+        return span
+
+    def begin_run(self, **fields):
+        """
+        Open the span of a run, ending that of the previous run if its end
+        was not observed (with the `final_status` "unobserved").
+        """
+
+        span = TraceSpan('run', **fields)
+        with self._lock:
+            if self._run is not None:
+                self._complete(self._run, final_status='unobserved')
+            self._run = span
+            self._open.append(span)
+        return span
+
+    def close(self):
+        """
+        End the open spans and close the trace file.
+        """
+
+        with self._lock:
+            for span in list(self._open):
+                self._complete(span)
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def end(self, span, **fields):
+        """
+        End a span and store it, adding `fields` to its information.
+        """
+
+        with self._lock:
+            self._complete(span, **fields)
+
+    def get_spans(self, name=None):
+        """
+        Return the completed spans, optionally only those of a kind.
+        """
+
+        with self._lock:
+            return [span for span in self.spans
+                    if name is None or span.name == name]
+
+    def mark(self, span, event):
+        """
+        Record the current time as the time of an event of a span, see
+        :meth:`TraceSpan.mark`.
+        """
+
+        with self._lock:
+            return span.mark(event)
+
+    def observe_snapshot(self, snapshot):
+        """
+        Mark the open spans with the state of a writer snapshot.
+
+        Besides the status, the first snapshot reporting a received frame
+        marks "first_frame". The frame counts of the snapshot are added to
+        the run span, which is completed when the end of the run is observed.
+        """
+
+        with self._lock:
+            for span in list(self._open):
+                span.observe_status(snapshot.status)
+                if snapshot.is_running and snapshot.n_received_frames > 0:
+                    span.mark('first_frame')
+            run = self._run
+            if run is not None and snapshot.statistics:
+                run.fields['n_received_frames'] = snapshot.n_received_frames
+                run.fields['n_written_frames'] = snapshot.n_written_frames
+                run.fields['n_lost_frames'] = snapshot.n_lost_frames
+            if run is not None and 'finished' in run.events:
+                self._complete(run)
+
+    def observe_status(self, status):
+        """
+        Mark the open spans with a writer status, completing the run span
+        when the end of the run is observed.
+        """
+
+        with self._lock:
+            for span in list(self._open):
+                span.observe_status(status)
+            if self._run is not None and 'finished' in self._run.events:
+                self._complete(self._run)
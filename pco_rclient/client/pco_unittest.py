@@ -179,6 +179,21 @@ class TestPcoClientMethods(unittest.TestCase):
         # assert if uptime contains 'active'
         self.assertTrue('active' in uptime)
 
+    def test_get_snapshot(self):
+        """
+        Test get_snapshot method
+
+        Asserts
+        ----------
+        is_running : bool
+            the snapshot agrees with is_running while the writer is idle
+        n_written_frames : int
+            the frame counts of the snapshot are integers
+        """
+        snapshot = self.w.get_snapshot()
+        self.assertEqual(snapshot.is_running, self.w.is_running())
+        self.assertIsInstance(snapshot.n_written_frames, int)
+
     def test_get_statistics(self):
         """
         Test get_statistics method
@@ -323,6 +338,24 @@ class TestPcoClientMethods(unittest.TestCase):
         # writer is not running -> returns 0
         self.assertEqual(ret_kill, 0)
 
+    def test_monitor(self):
+        """
+        Test monitor method
+
+        Asserts
+        ----------
+        is_alive : bool
+            the monitor thread is running after monitor() and stopped after
+            stop()
+        snapshot : WriterSnapshot
+            the monitor holds a snapshot right after it was started
+        """
+        monitor = self.w.monitor(interval=0.2)
+        self.assertTrue(monitor.is_alive())
+        self.assertNotEqual(monitor.get_snapshot(), None)
+        monitor.stop()
+        self.assertFalse(monitor.is_alive())
+
     def test_reset(self):
         """
         Test reset method
@@ -2,6 +2,7 @@
 import json
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.exceptions import *
 
 GET  = 'GET'
@@ -30,18 +31,29 @@ class RestClientHTTPError(RestClientError):
 
 class RestClient(object):
 
-    def __init__(self, url, timeout=15):
+    def __init__(self, url, timeout=15, pool_maxsize=4, keep_alive=True):
         self._base_url = url
         if not url.endswith("/"):
             self._base_url += "/"
 
         self._timeout = timeout
 
+        # one keep-alive connection pool per client (and thus per server)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if not keep_alive:
+            self._session.headers['Connection'] = 'close'
+
         # save latest request/response pair for later inspection, debugging
         self._request = None
         self._response = None
 
 
+    def close(self):
+        self._session.close()
+
     def get(self, *args, **kwargs):
         return(self.request(GET, *args, **kwargs))
 
@@ -71,7 +83,7 @@ class RestClient(object):
 
         url = self._base_url + path.lstrip('/')
         try:
-            r = requests.request(method=method, url=url, data=json_payload, timeout=self._timeout, headers=headers, params=query)
+            r = self._session.request(method=method, url=url, data=json_payload, timeout=self._timeout, headers=headers, params=query)
         except (BaseHTTPError, RequestException) as e:
             # python3 only ;-(   raise RestClientError('rest call %s %s %s failed' % (method, url, payload)) from e
             # catch the exception and raise it again here to get a shorter traceback